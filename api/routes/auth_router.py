@@ -1,26 +1,26 @@
 from typing import Union
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from datetime import timedelta
 from fastapi.security import OAuth2PasswordRequestForm
 from core.config import ACCESS_TOKEN_EXPIRE_MINUTES
-from core.database import get_db
+from core.database import DatabaseSession, get_db, primary_session
 from schemas.auth import PasswordResetToken, Token
 from schemas.user import User, UserCreate, UserFromDB
 from services.user_service import UserService
-from utils.security import create_access_token, verify_password
-from psycopg2.extensions import connection as PsycopgConnection
+from utils.responses import TimedRoute
+from utils.security import create_access_token, get_password_hash, verify_password
 
-router = APIRouter(prefix="/auth", tags=["Authentication"])
+router = APIRouter(prefix="/auth", tags=["Authentication"], route_class=TimedRoute)
 
 
 @router.post("/token", response_model=Token)
 async def login_for_access_token(
+    request: Request,
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: PsycopgConnection = Depends(get_db),
 ):
     """Authenticates the user."""
 
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(request, form_data.username, form_data.password)
 
     if not user:
         raise HTTPException(
@@ -36,14 +36,17 @@ async def login_for_access_token(
     return {"access_token": access_token, "token_type": "bearer"}
 
 
-def authenticate_user(
-    db: PsycopgConnection,
+async def authenticate_user(
+    request: Request,
     username: str,
     password: str,
 ) -> Union[User, None]:
-    user = UserService(db, requesting_user=None).get_user(username)
+    # Stays on the primary, a password that was just reset must be seen here.
+    async with primary_session(request) as db:
+        user = await UserService(db, requesting_user=None).get_user(username)
+    # the connection is back in the pool before the slow part, the hash
     if isinstance(user, UserFromDB):
-        if not verify_password(password, user.hashed_password):
+        if not await verify_password(password, user.hashed_password):
             return None
         return user
     return None
@@ -52,10 +55,13 @@ def authenticate_user(
 @router.post("/users/", response_model=User)
 async def create_user(
     user: UserCreate,
-    db: PsycopgConnection = Depends(get_db),
+    request: Request,
 ):
     """Creates a new user in the database."""
-    user_or_exception = UserService(db).create_user(user)
+    # hashed before a connection is checked out, not while holding one
+    hashed_password = await get_password_hash(user.password)
+    async with primary_session(request) as db:
+        user_or_exception = await UserService(db).create_user(user, hashed_password)
     if isinstance(user_or_exception, User):
         return user_or_exception
     else:
@@ -65,11 +71,11 @@ async def create_user(
 @router.get("/confirm_email/")
 async def confirm_email(
     token: str,
-    db: PsycopgConnection = Depends(get_db),
+    db: DatabaseSession = Depends(get_db),
 ):
     """Confirms the user's email."""
 
-    result = UserService(db).confirm_email(token)
+    result = await UserService(db).confirm_email(token)
     if isinstance(result, User):
         return {"message": "Email confirmed successfully"}
     else:
@@ -79,11 +85,11 @@ async def confirm_email(
 @router.post("/request_password_reset/")
 async def request_password_reset(
     email: str,
-    db: PsycopgConnection = Depends(get_db),
+    db: DatabaseSession = Depends(get_db),
 ):
     """Permits the user to request for a password reset."""
 
-    result = UserService(db).request_password_reset(email)
+    result = await UserService(db).request_password_reset(email)
     if not isinstance(result, PasswordResetToken):
         print(f"We don't know the user with such email {email}")
 
@@ -96,10 +102,12 @@ async def request_password_reset(
 async def reset_password(
     token: str,
     new_password: str,
-    db: PsycopgConnection = Depends(get_db),
+    request: Request,
 ):
     """Performs the actual resetting of the user's password."""
-    result = UserService(db).reset_password(token, new_password)
+    hashed_password = await get_password_hash(new_password)
+    async with primary_session(request) as db:
+        result = await UserService(db).reset_password(token, hashed_password)
     if isinstance(result, User):
         return {"message": "Password reset successful"}
     else:
@@ -0,0 +1,32 @@
+from fastapi import APIRouter
+
+from core.database import db_pools
+from utils.emails import SMTP_POOL
+from utils.security import PRINCIPAL_CACHE
+
+# Operational endpoints, kept out of the public OpenAPI docs.
+router = APIRouter(prefix="/internal", tags=["Internal"], include_in_schema=False)
+
+
+@router.get("/metrics/db-pool")
+async def db_pool_metrics():
+    """Reports the connection pools' gauges, counters and timing histograms."""
+    pools = db_pools()
+    return {
+        "primary": pools.primary_metrics.snapshot(),
+        "replicas": {
+            name: metrics.snapshot() for name, metrics in pools.replicas.metrics.items()
+        },
+    }
+
+
+@router.get("/metrics/principal-cache")
+async def principal_cache_metrics():
+    """Reports the hit and miss statistics of the authenticated principal cache."""
+    return PRINCIPAL_CACHE.stats()
+
+
+@router.get("/metrics/smtp-pool")
+async def smtp_pool_metrics():
+    """Reports the SMTP connections and the messages per second of each."""
+    return SMTP_POOL.stats()
@@ -0,0 +1,15 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from utils.metrics import METRICS
+
+# Scraped by Prometheus, kept out of the public OpenAPI docs.
+router = APIRouter(tags=["Internal"], include_in_schema=False)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Reports the metrics of every worker in the Prometheus text format."""
+    return PlainTextResponse(await METRICS.scrape(), media_type=PROMETHEUS_CONTENT_TYPE)
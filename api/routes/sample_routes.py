@@ -4,11 +4,12 @@ from schemas.sample import Item
 from schemas.user import User
 from services.sample_service import ItemService
 from utils.dependencies import has_required_scopes
+from utils.responses import TimedRoute
 from utils.scopes import ItemScope
 from utils.security import get_current_user
 
 
-router = APIRouter(prefix="/items", tags=["Items"])
+router = APIRouter(prefix="/items", tags=["Items"], route_class=TimedRoute)
 
 
 @router.post("/items/", response_model=Item)
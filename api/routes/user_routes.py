@@ -1,26 +1,221 @@
-from fastapi import APIRouter, Depends, Security
-from core.database import get_db
-from schemas.user import ListUsers, User
+from datetime import datetime
+from typing import List, Tuple
+from core.config import USERS_COUNT_STRATEGY, USERS_EXPORT_ITERSIZE
+from fastapi import (
+    APIRouter,
+    Depends,
+    File,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    Security,
+    UploadFile,
+)
+from fastapi.responses import StreamingResponse
+from core.database import (
+    DatabaseSession,
+    get_db,
+    get_read_db,
+    open_detached_read_session,
+    release_with_response,
+)
+from schemas.user import (
+    USER_OUT_ROWS,
+    BulkUserImport,
+    ListUsers,
+    SearchMode,
+    User,
+    UserCreate,
+    UserFilters,
+    UserOut,
+)
 from services.user_service import UserService
 from utils.api_utils import raise_or_return
+from utils.conditional import (
+    NotModified,
+    known_versions,
+    not_modified,
+    version_headers,
+)
+from utils.dependencies import sparse_fields
+from utils.errors import BadReqeustException
+from utils.exports import MEDIA_TYPES, ExportFormat, encode_batches
+from utils.imports import ImportFormat, parse_records
+from utils.pagination import CountStrategy, decode_cursor
+from utils.responses import FastJSONResponse, TimedRoute
 from utils.scopes import UserScope
 from utils.security import get_current_user
 
-router = APIRouter(prefix="/users", tags=["Users"])
+router = APIRouter(prefix="/users", tags=["Users"], route_class=TimedRoute)
+
+# shorter substrings have no trigram to look up, they would scan every user
+MIN_SUBSTRING_SEARCH = 3
 
 
 @router.get("/", response_model=ListUsers)
 async def list_users(
+    request: Request,
     current_user: User = Security(get_current_user, scopes=[UserScope.list_]),
-    db=Depends(get_db),
+    db=Depends(get_read_db),
     page_count: int = 10,
-    offset: int = 0,
+    offset: int = Query(0, description="Ignored when a `cursor` is given."),
+    cursor: str | None = Query(
+        None,
+        description="The `next_cursor` of a page, to get the page after it. "
+        "Stays fast however deep the page is.",
+    ),
+    count: CountStrategy = Query(
+        CountStrategy(USERS_COUNT_STRATEGY),
+        description="How `size` is computed: `exact`, `estimated` from the "
+        "planner statistics, `counter` from a trigger maintained table, or "
+        "`none` to leave it out.",
+    ),
+    search: str | None = Query(
+        None, description="Matches the username or the full name."
+    ),
+    search_mode: SearchMode = Query(
+        SearchMode.substring,
+        description="A `prefix`, or a `substring` of at least "
+        f"{MIN_SUBSTRING_SEARCH} characters.",
+    ),
+    email_domain: str | None = None,
+    disabled: bool | None = None,
+    email_verified: bool | None = None,
+    scope: List[str] = Query(
+        default=[], description="Repeatable, the users have all of them."
+    ),
+    created_after: datetime | None = None,
+    created_before: datetime | None = None,
+    fields: Tuple[str, ...] | None = Depends(sparse_fields(UserOut)),
+):
+    """Lists out the users in the database, oldest first. A weak `ETag` comes
+    with each page, `If-None-Match` gets a `304` while the page is unchanged."""
+
+    if (
+        search
+        and search_mode == SearchMode.substring
+        and len(search) < MIN_SUBSTRING_SEARCH
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail=f"A substring search needs at least {MIN_SUBSTRING_SEARCH} characters.",
+        )
+    filters = UserFilters(
+        search=search,
+        search_mode=search_mode,
+        email_domain=email_domain,
+        disabled=disabled,
+        email_verified=email_verified,
+        scopes=scope,
+        created_after=created_after,
+        created_before=created_before,
+    )
+
+    after = None
+    if cursor:
+        try:
+            after = decode_cursor(cursor)
+        except BadReqeustException as error:
+            raise HTTPException(status_code=400, detail=str(error))
+
+    result = await UserService(db, requesting_user=current_user).get_users(
+        offset,
+        page_count,
+        after=after,
+        count=count,
+        filters=filters,
+        fields=fields,
+        known_versions=known_versions(request),
+    )
+    if isinstance(result, NotModified):
+        return not_modified(result.version)
+    result = raise_or_return(result, ListUsers)
+
+    if fields:
+        # the users only hold the requested fields, bypasses the response_model
+        return Response(
+            result.model_dump_json(
+                include={
+                    "size": True,
+                    "next_cursor": True,
+                    "users": {"__all__": set(fields)},
+                }
+            ),
+            media_type="application/json",
+            headers=version_headers(result._version),
+        )
+    # the page was built from trusted rows, skips revalidating it against the
+    # response_model
+    return FastJSONResponse(result, headers=version_headers(result._version))
+
+
+async def _stream_export(db: DatabaseSession, export_format: ExportFormat):
+    # runs after the endpoint returned, so it owns the session it was given
+    try:
+        batches = UserService(db).export_users(USERS_EXPORT_ITERSIZE)
+        async for chunk in encode_batches(batches, export_format, USER_OUT_ROWS.fields):
+            yield chunk
+        await db.commit(wrote=False)
+    finally:
+        await db.release()
+
+
+@router.get("/export", response_class=StreamingResponse)
+async def export_users(
+    request: Request,
+    current_user: User = Security(get_current_user, scopes=[UserScope.list_]),
+    format: ExportFormat = ExportFormat.ndjson,
+):
+    """Streams every user in the database as newline delimited JSON or CSV,
+    for analytics dumps, without loading the table into memory."""
+
+    # checked out before the response starts so a saturated pool is still a 503
+    db = await open_detached_read_session(request)
+    return StreamingResponse(
+        _stream_export(db, format),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="users.{format}"'},
+        background=release_with_response(db),
+    )
+
+
+@router.post("/import", response_model=BulkUserImport)
+async def import_users(
+    users: List[UserCreate],
+    current_user: User = Security(get_current_user, scopes=[UserScope.create]),
+    db: DatabaseSession = Depends(get_db),
+):
+    """Creates many users at once, for onboarding a customer. Records that
+    can't be created, such as duplicate emails, are reported in `errors`."""
+
+    return await UserService(db, requesting_user=current_user).create_users_bulk(users)
+
+
+@router.post("/import/file", response_model=BulkUserImport)
+async def import_users_file(
+    file: UploadFile = File(
+        description="A CSV needs a username, email, password and full_name " "header."
+    ),
+    format: ImportFormat = ImportFormat.csv,
+    current_user: User = Security(get_current_user, scopes=[UserScope.create]),
+    db: DatabaseSession = Depends(get_db),
 ):
-    """Lists out all the users in the database."""
+    """Creates the users of an uploaded CSV, JSON array or newline delimited
+    JSON file. Invalid records are reported in `errors` by their 1 based row."""
 
-    result = UserService(db, requesting_user=current_user).get_users(offset, page_count)
+    try:
+        data = (await file.read()).decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="The file must be UTF-8 encoded.")
 
-    return raise_or_return(result, ListUsers)
+    records, errors = parse_records(data, format, UserCreate)
+    result = await UserService(db, requesting_user=current_user).create_users_bulk(
+        [user for _, user in records],
+        rows=[row for row, _ in records],
+    )
+    result.errors = sorted(result.errors + errors, key=lambda error: error.row)
+    return result
 
 
 # @router.post("/items/", response_model=Item)
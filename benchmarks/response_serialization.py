@@ -0,0 +1,67 @@
+"""Compares the ways of turning a ListUsers page into a response body.
+
+    python -m benchmarks.response_serialization [users ...]
+"""
+
+import sys
+import timeit
+from uuid import uuid4
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastapi.utils import create_response_field
+
+from schemas.user import ListUsers, UserOut
+from utils.responses import FastJSONResponse
+
+RESPONSE_FIELD = create_response_field(name="response", type_=ListUsers)
+
+
+def make_page(count: int) -> ListUsers:
+    users = [
+        UserOut(
+            username=f"user{index}",
+            email=f"user{index}@example.com",
+            full_name=f"User {index}",
+            disabled=False,
+            scopes=["users.list"],
+            email_verified=True,
+            id=uuid4(),
+        )
+        for index in range(count)
+    ]
+    return ListUsers(size=count, users=users, next_cursor=None)
+
+
+def with_response_model(page: ListUsers, response_class) -> bytes:
+    # what FastAPI's serialize_response does for a route with a response_model
+    value, _ = RESPONSE_FIELD.validate(page, {}, loc=("response",))
+    return response_class(RESPONSE_FIELD.serialize(value)).body
+
+
+def main(*counts: int, repeat: int = 20) -> None:
+    for count in counts or (10, 1_000, 10_000):
+        page = make_page(count)
+        candidates = {
+            "jsonable_encoder + JSONResponse": lambda: JSONResponse(
+                jsonable_encoder(page)
+            ).body,
+            "response_model + JSONResponse": lambda: with_response_model(
+                page, JSONResponse
+            ),
+            "response_model + FastJSONResponse": lambda: with_response_model(
+                page, FastJSONResponse
+            ),
+            "FastJSONResponse(model)": lambda: FastJSONResponse(page).body,
+        }
+
+        baseline = None
+        print(f"\nSerializing {count} users, best of {repeat}")
+        for name, candidate in candidates.items():
+            best = min(timeit.repeat(candidate, number=1, repeat=repeat))
+            baseline = baseline or best
+            print(f"{name:<34} {best * 1000:9.3f} ms  {baseline / best:6.2f}x")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,57 @@
+"""Compares the ways of turning a page of users rows into models.
+
+    python -m benchmarks.row_mapping [rows]
+"""
+
+import sys
+import timeit
+from uuid import uuid4
+
+from schemas.user import USER_OUT_ROWS, UserOut
+
+
+def make_rows(count: int):
+    return [
+        (
+            f"user{index}",
+            f"user{index}@example.com",
+            f"User {index}",
+            False,
+            ["users.list"],
+            True,
+            uuid4(),
+        )
+        for index in range(count)
+    ]
+
+
+def per_row_dicts(rows):
+    # how the services mapped rows before RowMapper
+    table_fields = list(UserOut.model_fields.keys())
+    users = []
+    for row in rows:
+        datum = {}
+        for index, _table in enumerate(table_fields):
+            datum[_table] = row[index]
+        users.append(UserOut(**datum))
+    return users
+
+
+def main(count: int = 10_000, repeat: int = 20) -> None:
+    rows = make_rows(count)
+    candidates = {
+        "per row dicts + validation": lambda: per_row_dicts(rows),
+        "RowMapper validated": lambda: USER_OUT_ROWS.many(rows, validate=True),
+        "RowMapper trusted": lambda: USER_OUT_ROWS.many(rows),
+    }
+
+    baseline = None
+    print(f"Mapping {count} rows, best of {repeat}")
+    for name, candidate in candidates.items():
+        best = min(timeit.repeat(candidate, number=1, repeat=repeat))
+        baseline = baseline or best
+        print(f"{name:<28} {best * 1000:8.2f} ms  {baseline / best:5.2f}x")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -22,14 +22,116 @@ CONNECTION_PARAMS = {
 }
 DB_CONN_STRING = f"dbname='{DATABASE_NAME}' user='{DATABASE_USERNAME}' host='{DATABASE_SERVER}' password='{DATABASE_PASSWORD}'"
 
+# Streaming replicas for read-only work, connection strings separated by ";"
+DB_REPLICA_CONN_STRINGS = [
+    conn_string.strip()
+    for conn_string in os.getenv("DB_REPLICA_CONN_STRINGS", "").split(";")
+    if conn_string.strip()
+]
+# how a replica is picked for a read: "round_robin" or "least_busy"
+DB_REPLICA_STRATEGY = os.getenv("DB_REPLICA_STRATEGY", "round_robin")
+# seconds a client's reads stay on the primary after it wrote something
+DB_READ_YOUR_WRITES_SECONDS = int(os.getenv("DB_READ_YOUR_WRITES_SECONDS", "5"))
+DB_READ_YOUR_WRITES_COOKIE = "db_read_primary"
+
 
 # Email configurations
-EMAIL_HOST = "smtp.example.com"
-EMAIL_PORT = 587
-EMAIL_ADDRESS = "your-email@example.com"
-EMAIL_PASSWORD = "your-email-password"
-EMAIL_FROM_NAME = "Your App Name"
-MIN_DB_POOL_SIZE = 1
-MAX_DB_POOL_SIZE = 10
+EMAIL_HOST = os.getenv("EMAIL_HOST", "smtp.example.com")
+EMAIL_PORT = int(os.getenv("EMAIL_PORT", "587"))
+EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS", "your-email@example.com")
+# no login is attempted when empty
+EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD", "your-email-password")
+EMAIL_FROM_NAME = os.getenv("EMAIL_FROM_NAME", "Your App Name")
+EMAIL_STARTTLS = os.getenv("EMAIL_STARTTLS", "True")
+# seconds an SMTP connect or command may take
+EMAIL_TIMEOUT = float(os.getenv("EMAIL_TIMEOUT", "10"))
+# authenticated SMTP connections kept open between sends, per worker
+EMAIL_POOL_SIZE = int(os.getenv("EMAIL_POOL_SIZE", "4"))
+# seconds a pooled connection may sit idle before a NOOP checks it is alive
+EMAIL_HEALTH_CHECK_AFTER = float(os.getenv("EMAIL_HEALTH_CHECK_AFTER", "30"))
+
+# Emails are sent from the email_outbox table by a dispatcher in every worker
+EMAIL_OUTBOX_DISPATCHER_ENABLED = os.getenv("EMAIL_OUTBOX_DISPATCHER_ENABLED", "True")
+# Postgres channel the outbox is announced on once an email is committed
+EMAIL_OUTBOX_CHANNEL = os.getenv("EMAIL_OUTBOX_CHANNEL", "email_outbox")
+# seconds between two looks at the outbox when nothing was announced
+EMAIL_OUTBOX_POLL_INTERVAL = float(os.getenv("EMAIL_OUTBOX_POLL_INTERVAL", "5"))
+# emails a dispatcher claims at a time
+EMAIL_OUTBOX_BATCH_SIZE = int(os.getenv("EMAIL_OUTBOX_BATCH_SIZE", "20"))
+# attempts before an email is marked failed, retries back off exponentially
+# from EMAIL_OUTBOX_RETRY_DELAY seconds up to EMAIL_OUTBOX_MAX_RETRY_DELAY
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv("EMAIL_OUTBOX_MAX_ATTEMPTS", "8"))
+EMAIL_OUTBOX_RETRY_DELAY = float(os.getenv("EMAIL_OUTBOX_RETRY_DELAY", "30"))
+EMAIL_OUTBOX_MAX_RETRY_DELAY = float(os.getenv("EMAIL_OUTBOX_MAX_RETRY_DELAY", "3600"))
+# seconds a claimed batch has to be sent before another dispatcher claims it
+EMAIL_OUTBOX_CLAIM_TIMEOUT = float(os.getenv("EMAIL_OUTBOX_CLAIM_TIMEOUT", "600"))
+
+# Per worker and per server. A worker also holds one connection to the primary
+# for the invalidation listener and one for the email dispatcher, so the
+# primary needs workers * (MAX_DB_POOL_SIZE + 2) connections, each replica
+# workers * MAX_DB_POOL_SIZE
+MIN_DB_POOL_SIZE = int(os.getenv("MIN_DB_POOL_SIZE", "1"))
+MAX_DB_POOL_SIZE = int(os.getenv("MAX_DB_POOL_SIZE", "10"))
+# seconds a request waits for a pooled connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+# requests allowed to queue for a connection, 0 means unbounded
+DB_POOL_MAX_WAITING = int(os.getenv("DB_POOL_MAX_WAITING", "0"))
+# seconds shutdown waits for checked out connections to be returned
+DB_POOL_DRAIN_TIMEOUT = float(os.getenv("DB_POOL_DRAIN_TIMEOUT", "10"))
+# share of the pool in use above which a saturation warning is logged
+DB_POOL_SATURATION_THRESHOLD = float(os.getenv("DB_POOL_SATURATION_THRESHOLD", "0.8"))
+# minimum seconds between two saturation warnings
+DB_POOL_SATURATION_LOG_INTERVAL = float(
+    os.getenv("DB_POOL_SATURATION_LOG_INTERVAL", "30")
+)
+
+# Authenticated principals are cached per process for this many seconds
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "30"))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+
+# Postgres channel the workers use to tell each other to drop cache entries
+CACHE_INVALIDATION_CHANNEL = os.getenv(
+    "CACHE_INVALIDATION_CHANNEL", "cache_invalidation"
+)
+CACHE_INVALIDATION_ENABLED = os.getenv("CACHE_INVALIDATION_ENABLED", "True")
+
+# Password hashing runs off the event loop, in "thread" (bcrypt releases the
+# GIL) or "process" workers
+PASSWORD_HASHING_EXECUTOR = os.getenv("PASSWORD_HASHING_EXECUTOR", "thread")
+PASSWORD_HASHING_WORKERS = int(
+    os.getenv("PASSWORD_HASHING_WORKERS", str(max(1, (os.cpu_count() or 2) // 2)))
+)
+# hashes allowed in flight at once, the rest wait without blocking the loop
+PASSWORD_HASHING_MAX_CONCURRENCY = int(
+    os.getenv("PASSWORD_HASHING_MAX_CONCURRENCY", str(PASSWORD_HASHING_WORKERS))
+)
+# of those, the most a bulk import may take, the rest stay free for logins
+PASSWORD_HASHING_BULK_CONCURRENCY = int(
+    os.getenv(
+        "PASSWORD_HASHING_BULK_CONCURRENCY",
+        str(max(1, PASSWORD_HASHING_MAX_CONCURRENCY - 1)),
+    )
+)
+
+# How ListUsers.size is computed when the request does not ask: "exact",
+# "estimated" (planner statistics), "counter" (trigger maintained) or "none"
+USERS_COUNT_STRATEGY = os.getenv("USERS_COUNT_STRATEGY", "exact")
+
+# rows the users export fetches from its server-side cursor per round trip
+USERS_EXPORT_ITERSIZE = int(os.getenv("USERS_EXPORT_ITERSIZE", "2000"))
+
+# users a bulk import hashes, loads and commits at a time
+BULK_IMPORT_CHUNK_SIZE = int(os.getenv("BULK_IMPORT_CHUNK_SIZE", "1000"))
+
+# share of requests answered with a Server-Timing header and a timing log
+# line, 0 turns it off
+SERVER_TIMING_SAMPLE_RATE = float(os.getenv("SERVER_TIMING_SAMPLE_RATE", "0.1"))
+
+# Workers write their metrics to this directory for /metrics to add them up,
+# empty means each process only reports its own, see utils/metrics.py.
+# gunicorn.conf.py sets a default, uvicorn --workers needs it set.
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+# seconds between two writes of a worker's metrics file
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
 
 TESTING = os.getenv("TESTING", "False")
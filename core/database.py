@@ -1,21 +1,486 @@
-import psycopg2
-
-import psycopg2.pool
-import atexit
-from psycopg2.extensions import connection as PsycopgConnection
-from core.config import DB_CONN_STRING, MAX_DB_POOL_SIZE, MIN_DB_POOL_SIZE
-
-# Create a connection pool
-DB_POOL = psycopg2.pool.SimpleConnectionPool(
-    minconn=MIN_DB_POOL_SIZE,
-    maxconn=MAX_DB_POOL_SIZE,
-    dsn=DB_CONN_STRING,
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+import os
+import time
+from typing import AsyncIterator, Dict, List, Tuple
+
+import anyio
+from fastapi import Request, Response
+from loguru import logger
+from psycopg import AsyncConnection, AsyncCursor, AsyncServerCursor
+from psycopg_pool import AsyncConnectionPool, PoolTimeout, TooManyRequests
+from starlette.background import BackgroundTask
+
+from core.config import (
+    DB_CONN_STRING,
+    DB_POOL_DRAIN_TIMEOUT,
+    DB_POOL_MAX_WAITING,
+    DB_POOL_SATURATION_LOG_INTERVAL,
+    DB_POOL_SATURATION_THRESHOLD,
+    DB_POOL_TIMEOUT,
+    DB_READ_YOUR_WRITES_COOKIE,
+    DB_READ_YOUR_WRITES_SECONDS,
+    DB_REPLICA_CONN_STRINGS,
+    DB_REPLICA_STRATEGY,
+    MAX_DB_POOL_SIZE,
+    MIN_DB_POOL_SIZE,
 )
+from utils.metrics import DB_QUERY_SECONDS, Histogram
+from utils.timing import record, span
+
+PRIMARY_POOL_NAME = "primary"
+
+
+class TimedCursor(AsyncCursor):
+    """Adds the statements' round trips to the "db" span of the request and
+    to the db_query_duration_seconds histogram."""
+
+    async def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            observe_query(time.perf_counter() - started)
+
+    async def executemany(self, query, params_seq, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().executemany(query, params_seq, **kwargs)
+        finally:
+            observe_query(time.perf_counter() - started)
+
+
+def observe_query(elapsed: float) -> None:
+    record("db", elapsed)
+    DB_QUERY_SECONDS.observe(elapsed)
+
+
+def create_pool(conn_string: str, name: str) -> AsyncConnectionPool:
+    return AsyncConnectionPool(
+        conninfo=conn_string,
+        name=name,
+        kwargs={"cursor_factory": TimedCursor},
+        min_size=MIN_DB_POOL_SIZE,
+        max_size=MAX_DB_POOL_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        max_waiting=DB_POOL_MAX_WAITING,
+        open=False,
+    )
+
+
+def connections_in_use(pool: AsyncConnectionPool) -> int:
+    stats = pool.get_stats()
+    return stats["pool_size"] - stats["pool_available"]
+
+
+class PoolMetrics:
+    """Checkout and hold timings of a connection pool, plus the pool's own
+    counters, so the pool size can be chosen from data."""
+
+    def __init__(
+        self,
+        pool: AsyncConnectionPool,
+        saturation_threshold: float = DB_POOL_SATURATION_THRESHOLD,
+        saturation_log_interval: float = DB_POOL_SATURATION_LOG_INTERVAL,
+    ) -> None:
+        self.pool = pool
+        self.saturation_threshold = saturation_threshold
+        self.saturation_log_interval = saturation_log_interval
+        self.checkout_wait = Histogram()
+        self.hold_time: Dict[str, Histogram] = defaultdict(Histogram)
+        self.checkout_timeouts = 0
+        self.checkout_rejections = 0
+        # connections handed out through get_db and not yet given back
+        self.checked_out = 0
+        self._last_saturation_log = 0.0
+
+    def record_checkout(self, waited: float) -> None:
+        self.checked_out += 1
+        self.checkout_wait.observe(waited)
+
+        stats = self.pool.get_stats()
+        in_use = connections_in_use(self.pool)
+        if in_use < stats["pool_max"] * self.saturation_threshold:
+            return
+
+        now = time.monotonic()
+        if now - self._last_saturation_log >= self.saturation_log_interval:
+            self._last_saturation_log = now
+            logger.warning(
+                f"Database pool {self.pool.name} is saturated: "
+                f"{in_use}/{stats['pool_max']} connections in use, "
+                f"{stats['requests_waiting']} requests waiting"
+            )
+
+    def record_timeout(self, error: PoolTimeout | TooManyRequests) -> None:
+        if isinstance(error, TooManyRequests):
+            self.checkout_rejections += 1
+        else:
+            self.checkout_timeouts += 1
+
+    def record_hold(self, route: str, held: float) -> None:
+        self.checked_out -= 1
+        self.hold_time[route].observe(held)
+
+    def snapshot(self) -> Dict:
+        stats = self.pool.get_stats()
+        return {
+            "max": stats["pool_max"],
+            "min": stats["pool_min"],
+            "in_use": connections_in_use(self.pool),
+            "checked_out": self.checked_out,
+            "idle": stats["pool_available"],
+            "waiting": stats["requests_waiting"],
+            "checkout_timeouts": self.checkout_timeouts,
+            "checkout_rejections": self.checkout_rejections,
+            # broken when checked out plus broken when given back
+            "connections_discarded": stats.get("connections_lost", 0)
+            + stats.get("returns_bad", 0),
+            "checkout_wait_seconds": self.checkout_wait.snapshot(),
+            "hold_seconds": {
+                route: histogram.snapshot()
+                for route, histogram in self.hold_time.items()
+            },
+        }
+
+
+class ReplicaSet:
+    """The reader pools, one per streaming replica."""
+
+    def __init__(self, pools: List[AsyncConnectionPool], strategy: str) -> None:
+        if strategy not in ("round_robin", "least_busy"):
+            raise ValueError(f"Unknown replica strategy {strategy}")
+
+        self.strategy = strategy
+        self.pools = pools
+        self.metrics = {pool.name: PoolMetrics(pool) for pool in self.pools}
+        self._next = 0
+
+    def choose(self) -> AsyncConnectionPool:
+        if self.strategy == "least_busy":
+            return min(self.pools, key=self._busy)
+
+        pool = self.pools[self._next % len(self.pools)]
+        self._next += 1
+        return pool
+
+    @staticmethod
+    def _busy(pool: AsyncConnectionPool) -> int:
+        return connections_in_use(pool) + pool.get_stats()["requests_waiting"]
+
+
+class DatabasePools:
+    """The primary and replica pools of one process.
+
+    Pools must never cross a fork, a forked worker sharing its parent's
+    sockets corrupts both, so they are built inside each worker's lifespan
+    and remember the process that built them.
+    """
+
+    def __init__(self, primary: AsyncConnectionPool, replicas: ReplicaSet) -> None:
+        self.pid = os.getpid()
+        self.primary = primary
+        self.primary_metrics = PoolMetrics(primary)
+        self.replicas = replicas
+
+    def all(self) -> List[Tuple[AsyncConnectionPool, PoolMetrics]]:
+        return [
+            (self.primary, self.primary_metrics),
+            *((pool, self.replicas.metrics[pool.name]) for pool in self.replicas.pools),
+        ]
+
+    async def open(self) -> None:
+        for pool, _ in self.all():
+            await pool.open()
+
+    async def close(self, drain_timeout: float = DB_POOL_DRAIN_TIMEOUT) -> None:
+        """Waits up to `drain_timeout` seconds for checked out connections to
+        come back before closing the pools, so in-flight work can finish."""
+
+        deadline = time.monotonic() + drain_timeout
+        for pool, metrics in self.all():
+            while metrics.checked_out and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+
+            if metrics.checked_out:
+                logger.warning(
+                    f"Closing database pool {pool.name} with {metrics.checked_out} "
+                    "connections still checked out"
+                )
+            await pool.close()
+
+
+def create_db_pools() -> DatabasePools:
+    replica_pools = [
+        create_pool(conn_string, f"replica-{index}")
+        for index, conn_string in enumerate(DB_REPLICA_CONN_STRINGS)
+    ]
+    return DatabasePools(
+        create_pool(DB_CONN_STRING, PRIMARY_POOL_NAME),
+        ReplicaSet(replica_pools, DB_REPLICA_STRATEGY),
+    )
+
+
+# The pools of the current process, see open_db_pools.
+_DB_POOLS: DatabasePools | None = None
+
+
+def db_pools() -> DatabasePools:
+    if _DB_POOLS is None or _DB_POOLS.pid != os.getpid():
+        raise RuntimeError(
+            "The database pools are not open in this process, "
+            "open_db_pools must run in the application's lifespan"
+        )
+    return _DB_POOLS
+
+
+async def open_db_pools() -> DatabasePools:
+    """Creates and opens this process's pools, connections are only made
+    here, never at import time."""
+
+    global _DB_POOLS
+    if _DB_POOLS is None or _DB_POOLS.pid != os.getpid():
+        # pools inherited from a parent process are left alone, they belong
+        # to the parent
+        _DB_POOLS = create_db_pools()
+        await _DB_POOLS.open()
+    return _DB_POOLS
+
+
+async def close_db_pools() -> None:
+    global _DB_POOLS
+    if _DB_POOLS is None or _DB_POOLS.pid != os.getpid():
+        return
+    pools, _DB_POOLS = _DB_POOLS, None
+    await pools.close()
+
+
+class DatabaseSession:
+    """The unit of work of a single request.
+
+    Wraps one pooled connection and hands out the same cursor to everything
+    that asks for one during the request, so services and security lookups
+    share it instead of leaving their own cursors open.
+    """
+
+    def __init__(
+        self,
+        connection: AsyncConnection,
+        pool: AsyncConnectionPool,
+        metrics: PoolMetrics | None = None,
+        route: str = "",
+    ):
+        self.connection: AsyncConnection | None = connection
+        self.pool = pool
+        self.metrics = metrics
+        self.route = route
+        self.checked_out_at = time.perf_counter()
+        # set once something was committed through this session
+        self.wrote = False
+        self._cursor: AsyncCursor | None = None
+        self._notifications: List[Tuple[str, str]] = []
+
+    def cursor(self) -> AsyncCursor:
+        if self._cursor is None:
+            self._cursor = self.connection.cursor()  # type: ignore
+        return self._cursor
+
+    def server_cursor(self, name: str) -> AsyncServerCursor:
+        """A named cursor kept on the server, rows are fetched in batches as
+        they are read instead of all at once. The caller closes it, before
+        the transaction ends."""
+        return self.connection.cursor(name=name)  # type: ignore
+
+    def notify_on_commit(self, channel: str, payload: str) -> None:
+        """Queues a NOTIFY that is sent with the next commit, and dropped if
+        the transaction is rolled back."""
+        self._notifications.append((channel, payload))
+
+    async def commit(self, wrote: bool = True) -> None:
+        # a connection level execute, the shared cursor keeps its results
+        for channel, payload in self._notifications:
+            await self.connection.execute(  # type: ignore
+                "SELECT pg_notify(%s, %s)", (channel, payload)
+            )
+        self._notifications.clear()
+        with span("db"):
+            await self.connection.commit()  # type: ignore
+        self.wrote = self.wrote or wrote
+
+    async def rollback(self) -> None:
+        self._notifications.clear()
+        await self.connection.rollback()  # type: ignore
+
+    async def release(self) -> None:
+        """Closes the cursor and returns the connection to the pool, calling
+        it more than once is harmless."""
+
+        connection, self.connection = self.connection, None
+        if connection is None:
+            return
+
+        # often called while the request is being cancelled, a client that
+        # hung up, and a cancelled putconn would leak the connection for good
+        with anyio.CancelScope(shield=True):
+            try:
+                if self._cursor is not None:
+                    await self._cursor.close()
+            finally:
+                self._cursor = None
+                # the pool rolls back anything left uncommitted
+                await self.pool.putconn(connection)
+                if self.metrics is not None:
+                    self.metrics.record_hold(
+                        self.route, time.perf_counter() - self.checked_out_at
+                    )
+
+
+async def _checkout(
+    pool: AsyncConnectionPool, metrics: PoolMetrics, route: str
+) -> DatabaseSession:
+    started = time.perf_counter()
+    try:
+        connection = await pool.getconn()
+    except (PoolTimeout, TooManyRequests) as error:
+        metrics.record_timeout(error)
+        raise
+    waited = time.perf_counter() - started
+    metrics.record_checkout(waited)
+    record("db-wait", waited)
+
+    return DatabaseSession(connection, pool, metrics=metrics, route=route)
+
+
+def _route_path(request: Request) -> str:
+    route = request.scope.get("route")
+    return getattr(route, "path", request.url.path)
+
+
+@asynccontextmanager
+async def _session_scope(
+    request: Request, pool: AsyncConnectionPool, metrics: PoolMetrics
+) -> AsyncIterator[DatabaseSession]:
+    """Checks out one connection of `pool` for the whole request, commits when
+    the request succeeds, rolls back when it raises and always gives the
+    connection back. Dependencies asking for the same pool again within the
+    request share the first session."""
+
+    sessions: Dict[str, DatabaseSession] = request_sessions(request)
+    if pool.name in sessions:
+        yield sessions[pool.name]
+        return
+
+    session = await _checkout(pool, metrics, _route_path(request))
+    sessions[pool.name] = session
+    try:
+        yield session
+    except Exception:
+        await session.rollback()
+        raise
+    else:
+        # closes the transaction without flagging the request as a writer
+        await session.commit(wrote=False)
+    finally:
+        del sessions[pool.name]
+        await session.release()
+        if session.wrote:
+            request.state.db_wrote = True
+
+
+def request_sessions(request: Request) -> Dict[str, DatabaseSession]:
+    """The database sessions opened by a request, keyed by pool name."""
+
+    if not hasattr(request.state, "db_sessions"):
+        request.state.db_sessions = {}
+    return request.state.db_sessions
+
+
+def request_wrote(request: Request) -> bool:
+    """Whether the request committed a write to the primary."""
+
+    primary_session = request_sessions(request).get(PRIMARY_POOL_NAME)
+    if primary_session is not None and primary_session.wrote:
+        return True
+    return getattr(request.state, "db_wrote", False)
+
+
+def reads_from_primary(request: Request) -> bool:
+    """Whether the request must read its own writes, either because it already
+    wrote in this request or because the client wrote a moment ago."""
+
+    return request_wrote(request) or DB_READ_YOUR_WRITES_COOKIE in request.cookies
+
+
+def remember_primary_writes(request: Request, response: Response) -> None:
+    """Keeps the client's reads on the primary for a short while after a
+    write, so it doesn't read stale data from a lagging replica."""
+
+    if request_wrote(request):
+        response.set_cookie(
+            DB_READ_YOUR_WRITES_COOKIE,
+            "1",
+            max_age=DB_READ_YOUR_WRITES_SECONDS,
+            httponly=True,
+            samesite="lax",
+        )
+
+
+def primary_session(request: Request):
+    """A session on the primary as an async context manager, for requests
+    that only need the connection for part of their work, such as the
+    queries around a password hash. get_db is the dependency form."""
+
+    pools = db_pools()
+    return _session_scope(request, pools.primary, pools.primary_metrics)
+
+
+async def get_db(request: Request) -> AsyncIterator[DatabaseSession]:
+    """A session on the primary, for anything that writes."""
+
+    async with primary_session(request) as session:
+        yield session
+
+
+def _read_pool(request: Request) -> Tuple[AsyncConnectionPool, PoolMetrics]:
+    pools = db_pools()
+    if not pools.replicas.pools or reads_from_primary(request):
+        return pools.primary, pools.primary_metrics
+
+    pool = pools.replicas.choose()
+    return pool, pools.replicas.metrics[pool.name]
+
+
+def read_session(request: Request):
+    """A session for read-only work. It is served by a replica unless none is
+    configured or the client has to read its own writes.
+
+    Usable as an async context manager where a connection is only needed
+    some of the time, get_read_db is the dependency form."""
+
+    return _session_scope(request, *_read_pool(request))
+
+
+async def open_detached_read_session(request: Request) -> DatabaseSession:
+    """A read session that outlives the request's dependencies, for
+    responses streamed after the endpoint has returned.
+
+    It is not shared with the rest of the request and the request never
+    releases it, the caller must commit or roll back and release it, also
+    when the response is never sent, see release_with_response."""
+
+    return await _checkout(*_read_pool(request), _route_path(request))
+
+
+def release_with_response(session: DatabaseSession) -> BackgroundTask:
+    """Releases a detached session once its response is done, sent or not.
+
+    A streamed body's own cleanup is not enough, a generator the client hung
+    up on before it started never runs its finally."""
 
-# Ensure connections are closed when the application exits
-atexit.register(DB_POOL.closeall)
+    return BackgroundTask(session.release)
 
 
-def get_db() -> PsycopgConnection:
-    db: PsycopgConnection = DB_POOL.getconn()
-    return db
+async def get_read_db(request: Request) -> AsyncIterator[DatabaseSession]:
+    async with read_session(request) as session:
+        yield session
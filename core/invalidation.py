@@ -0,0 +1,68 @@
+import json
+from typing import Callable, Dict, Tuple
+
+from loguru import logger
+from psycopg import AsyncConnection, Notify
+
+from core.config import CACHE_INVALIDATION_CHANNEL
+from core.database import DatabaseSession
+from core.listener import Listener
+
+
+class InvalidationBus(Listener):
+    """Keeps the in-process caches of every worker, on every node, in step
+    with the users table through Postgres LISTEN/NOTIFY.
+
+    A change publishes the affected key in the same transaction as the change
+    itself, Postgres only delivers it once that transaction commits. Each
+    worker keeps one dedicated connection listening on the channel and evicts
+    the key from its local cache.
+    """
+
+    description = "Cache invalidation listener"
+
+    def __init__(self, channel: str = CACHE_INVALIDATION_CHANNEL) -> None:
+        super().__init__(channel)
+        self._caches: Dict[str, Tuple[Callable[[str], None], Callable[[], None]]] = {}
+
+    def subscribe(
+        self, cache: str, evict: Callable[[str], None], clear: Callable[[], None]
+    ) -> None:
+        """Registers a local cache, `evict` drops one key and `clear` drops
+        everything for when notifications may have been missed."""
+        self._caches[cache] = (evict, clear)
+
+    def publish(self, db: DatabaseSession, cache: str, key: str) -> None:
+        """Announces that `key` of `cache` changed, once `db` commits."""
+        payload = json.dumps({"cache": cache, "key": key})
+        db.notify_on_commit(self.channel, payload)
+
+    def dispatch(self, payload: str) -> None:
+        try:
+            message = json.loads(payload)
+            evict, _ = self._caches[message["cache"]]
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f"Ignoring malformed invalidation {payload!r}")
+            return
+        evict(message["key"])
+
+    def clear_all(self) -> None:
+        for _, clear in self._caches.values():
+            clear()
+
+    def on_notify(self, notify: Notify) -> None:
+        self.dispatch(notify.payload)
+
+    def on_connect(self) -> None:
+        # anything published while we were not listening is lost
+        self.clear_all()
+
+    def on_disconnect(self) -> None:
+        self.clear_all()
+
+    async def serve(self, connection: AsyncConnection) -> None:
+        while not self.stopping:
+            await self.wait(connection)
+
+
+INVALIDATION_BUS = InvalidationBus()
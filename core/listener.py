@@ -0,0 +1,137 @@
+import asyncio
+from abc import ABC, abstractmethod
+
+from loguru import logger
+from psycopg import AsyncConnection, Notify, sql
+
+from core.config import DB_CONN_STRING
+
+# seconds stop() waits for the task to wind down before cancelling it
+STOP_TIMEOUT = 5.0
+
+
+class Listener(ABC):
+    """A task of each worker process with a dedicated connection listening on
+    `channel`, reconnecting with a growing delay when the connection is lost.
+
+    It is stopped through an event rather than by cancelling it: psycopg
+    waits with asyncio.wait_for, which on Python 3.11 loses a cancellation
+    that arrives as the connection has something to read. `wait` wakes up on
+    the event, and stop() cancels a task that hasn't ended after
+    `stop_timeout` seconds instead of waiting for good.
+    """
+
+    # how the task is called in the logs
+    description = "Listener"
+
+    def __init__(self, channel: str, stop_timeout: float = STOP_TIMEOUT) -> None:
+        self.channel = channel
+        self.stop_timeout = stop_timeout
+        self._task: asyncio.Task | None = None
+        self._stop = asyncio.Event()
+
+    @property
+    def stopping(self) -> bool:
+        return self._stop.is_set()
+
+    def on_notify(self, notify: Notify) -> None:
+        """Called with every notification on the channel, whether it arrived
+        during `wait` or during a query of `serve`."""
+
+    def on_connect(self) -> None:
+        """Called once listening, notifications sent before are lost."""
+
+    def on_disconnect(self) -> None:
+        """Called when the connection was lost."""
+
+    @abstractmethod
+    async def serve(self, connection: AsyncConnection) -> None:
+        """Works with the connection until `stopping`, waiting through
+        `wait`."""
+
+    async def listen(self, connection: AsyncConnection) -> None:
+        connection.add_notify_handler(self.on_notify)
+        await connection.execute(
+            sql.SQL("LISTEN {}").format(sql.Identifier(self.channel))
+        )
+
+    async def wait(self, connection: AsyncConnection, timeout: float | None = None):
+        """Waits until something arrives on the connection, stop() is called
+        or `timeout` seconds passed, then hands the notifications that
+        arrived to on_notify."""
+
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        loop.add_reader(connection.fileno(), readable.set)
+        wakers = [
+            asyncio.ensure_future(readable.wait()),
+            asyncio.ensure_future(self._stop.wait()),
+        ]
+        try:
+            await asyncio.wait(
+                wakers, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            loop.remove_reader(connection.fileno())
+            for waker in wakers:
+                waker.cancel()
+
+        if readable.is_set():
+            # what connection.notifies() does, less its wait
+            pgconn = connection.pgconn
+            pgconn.consume_input()
+            while (notify := pgconn.notifies()) is not None:
+                pgconn.notify_handler(notify)  # type: ignore
+
+    async def run(self, conn_string: str, max_delay: float = 30) -> None:
+        """Serves until stopped or cancelled, reconnecting with a growing
+        delay."""
+
+        delay = 1.0
+        while not self.stopping:
+            try:
+                async with await AsyncConnection.connect(
+                    conn_string, autocommit=True
+                ) as connection:
+                    await self.listen(connection)
+                    self.on_connect()
+                    delay = 1.0
+                    await self.serve(connection)
+                    return
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.warning(
+                    f"{self.description} lost its connection: {error}, "
+                    f"reconnecting in {delay:.0f}s"
+                )
+                self.on_disconnect()
+
+            try:
+                async with asyncio.timeout(delay):
+                    await self._stop.wait()
+            except TimeoutError:
+                pass
+            delay = min(delay * 2, max_delay)
+
+    def start(self, conn_string: str = DB_CONN_STRING) -> None:
+        if self._task is None or self._task.done():
+            # a fresh event, an event loop of its own for each app run
+            self._stop = asyncio.Event()
+            self._task = asyncio.create_task(self.run(conn_string))
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        self._stop.set()
+        try:
+            async with asyncio.timeout(self.stop_timeout):
+                # a timeout cancels the wait, not the task
+                await asyncio.shield(task)
+        except TimeoutError:
+            logger.warning(f"{self.description} did not stop in time, cancelled")
+            task.cancel()
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
@@ -0,0 +1,72 @@
+from typing import Dict, FrozenSet, Generic, Iterable, List, Sequence, Type, TypeVar
+
+from pydantic import BaseModel, TypeAdapter
+
+M = TypeVar("M", bound=BaseModel)
+
+_new = object.__new__
+_setattr = object.__setattr__
+
+
+class RowMapper(Generic[M]):
+    """Maps the rows of `table` onto `model`, one column per model field.
+
+    The column list and SELECT are worked out once when the mapper is built,
+    mapping a row is then a `zip` over the precomputed field names. Rows read
+    from our own schema already have the right types, those go through the
+    trusted path which skips validation, use `validate=True` for anything else.
+    """
+
+    def __init__(
+        self, model: Type[M], table: str, fields: Iterable[str] | None = None
+    ) -> None:
+        self.model = model
+        self.table = table
+        self.fields = tuple(fields or model.model_fields)
+        self.columns = ", ".join(self.fields)
+        # extra columns selected after the model's ones are ignored by the mapper
+        self.select = f"SELECT {self.columns} FROM {table}"
+        # validates a whole page in one call into pydantic-core
+        self._page = TypeAdapter(List[model])
+        self._subsets: Dict[FrozenSet[str], "RowMapper[M]"] = {}
+
+    def only(self, fields: Iterable[str]) -> "RowMapper[M]":
+        """A mapper selecting just `fields`, for sparse responses. Its models
+        only have those attributes, serialize them with `include=fields` and
+        don't validate them, the other required fields are missing.
+
+        Built once per set of fields, raises ValueError for unknown ones."""
+
+        key = frozenset(fields)
+        subset = self._subsets.get(key)
+        if subset is None:
+            unknown = key.difference(self.fields)
+            if unknown:
+                raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+            subset = RowMapper(
+                self.model, self.table, [name for name in self.fields if name in key]
+            )
+            self._subsets[key] = subset
+        return subset
+
+    def construct(self, row: Sequence) -> M:
+        # what model_construct does without its per field default handling,
+        # every field comes from the row
+        instance = _new(self.model)
+        _setattr(instance, "__dict__", dict(zip(self.fields, row)))
+        _setattr(instance, "__pydantic_fields_set__", set(self.fields))
+        _setattr(instance, "__pydantic_extra__", None)
+        _setattr(instance, "__pydantic_private__", None)
+        return instance
+
+    def validate(self, row: Sequence) -> M:
+        return self.model.model_validate(dict(zip(self.fields, row)))
+
+    def one(self, row: Sequence, validate: bool = False) -> M:
+        return self.validate(row) if validate else self.construct(row)
+
+    def many(self, rows: Iterable[Sequence], validate: bool = False) -> List[M]:
+        if validate:
+            fields = self.fields
+            return self._page.validate_python([dict(zip(fields, row)) for row in rows])
+        return list(map(self.construct, rows))
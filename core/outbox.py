@@ -0,0 +1,170 @@
+import asyncio
+from typing import Callable, List, Sequence, Tuple
+
+from loguru import logger
+from psycopg import AsyncConnection, Notify, sql
+
+from core.config import (
+    DB_CONN_STRING,
+    EMAIL_OUTBOX_BATCH_SIZE,
+    EMAIL_OUTBOX_CHANNEL,
+    EMAIL_OUTBOX_CLAIM_TIMEOUT,
+    EMAIL_OUTBOX_MAX_ATTEMPTS,
+    EMAIL_OUTBOX_MAX_RETRY_DELAY,
+    EMAIL_OUTBOX_POLL_INTERVAL,
+    EMAIL_OUTBOX_RETRY_DELAY,
+)
+from core.database import DatabaseSession
+from core.listener import Listener
+from utils.emails import deliver
+from utils.errors import EmailException
+
+ENQUEUE_EMAIL = sql.SQL(
+    "INSERT INTO email_outbox (subject, to_email, body) VALUES (%s, %s, %s)"
+)
+# rows claimed by another dispatcher are skipped rather than waited for. A
+# claim marks the emails in flight and commits before they are sent, an email
+# whose claim ran out, its dispatcher died while sending, is claimed again.
+CLAIM_EMAILS = sql.SQL(
+    "UPDATE email_outbox SET status = 'sending', attempts = attempts + 1, "
+    "next_attempt_at = NOW() + %s * INTERVAL '1 second' "
+    "WHERE id IN (SELECT id FROM email_outbox "
+    "WHERE status IN ('pending', 'sending') AND next_attempt_at <= NOW() "
+    "ORDER BY next_attempt_at LIMIT %s FOR UPDATE SKIP LOCKED) "
+    "RETURNING id, subject, to_email, body, attempts"
+)
+MARK_EMAIL_SENT = sql.SQL(
+    "UPDATE email_outbox SET status = 'sent', sent_at = NOW(), last_error = NULL "
+    "WHERE id = %s"
+)
+MARK_EMAIL_FAILED = sql.SQL(
+    "UPDATE email_outbox SET status = %s, last_error = %s, "
+    "next_attempt_at = NOW() + %s * INTERVAL '1 second' WHERE id = %s"
+)
+
+
+async def queue_email(db: DatabaseSession, subject: str, to_email: str, body: str):
+    """Writes an email to the outbox in `db`'s transaction, it is only sent
+    once that transaction commits and never if it rolls back."""
+
+    # a connection level execute, the shared cursor keeps its results
+    await db.connection.execute(ENQUEUE_EMAIL, (subject, to_email, body))  # type: ignore
+    db.notify_on_commit(EMAIL_OUTBOX_CHANNEL, "")
+
+
+async def queue_emails(db: DatabaseSession, messages: List[Tuple[str, str, str]]):
+    """queue_email for many (subject, to_email, body) messages at once, the
+    rows are written in a single pipelined round trip."""
+
+    if not messages:
+        return
+    async with db.connection.cursor() as cursor:  # type: ignore
+        await cursor.executemany(ENQUEUE_EMAIL, messages)
+    db.notify_on_commit(EMAIL_OUTBOX_CHANNEL, "")
+
+
+class EmailDispatcher(Listener):
+    """Sends the emails of the email_outbox table, one per worker.
+
+    Due emails are claimed with FOR UPDATE SKIP LOCKED and marked in flight
+    for `claim_timeout` seconds, so any number of dispatchers share the
+    outbox without sending an email twice and no row stays locked while the
+    batch goes out. A failed email is retried with an exponential backoff
+    until `max_attempts`, then marked failed. The dispatcher wakes up when an
+    email is announced on `channel` and looks at the outbox every
+    `poll_interval` seconds anyway, for retries that came due and
+    announcements it missed.
+    """
+
+    description = "Email dispatcher"
+
+    def __init__(
+        self,
+        channel: str = EMAIL_OUTBOX_CHANNEL,
+        batch_size: int = EMAIL_OUTBOX_BATCH_SIZE,
+        max_attempts: int = EMAIL_OUTBOX_MAX_ATTEMPTS,
+        retry_delay: float = EMAIL_OUTBOX_RETRY_DELAY,
+        max_retry_delay: float = EMAIL_OUTBOX_MAX_RETRY_DELAY,
+        poll_interval: float = EMAIL_OUTBOX_POLL_INTERVAL,
+        claim_timeout: float = EMAIL_OUTBOX_CLAIM_TIMEOUT,
+        send: Callable[
+            [List[Tuple[str, str, str]]], Sequence[EmailException | None]
+        ] = deliver,
+    ) -> None:
+        super().__init__(channel)
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self.send = send
+        self._announced = False
+
+    def backoff(self, attempts: int) -> float:
+        """Seconds to wait before retrying an email that failed `attempts`
+        times."""
+        return min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+
+    async def dispatch_batch(self, connection: AsyncConnection) -> int:
+        """Claims up to `batch_size` due emails, sends them and records the
+        outcomes, returns how many were claimed. No transaction is open while
+        the emails are sent."""
+
+        async with connection.transaction():
+            cursor = await connection.execute(
+                CLAIM_EMAILS, (self.claim_timeout, self.batch_size)
+            )
+            emails: List[Tuple] = await cursor.fetchall()
+        if not emails:
+            return 0
+
+        # one pooled SMTP connection for the batch, smtplib blocks so it runs
+        # off the event loop
+        failures = await asyncio.to_thread(
+            self.send,
+            [(subject, to_email, body) for _, subject, to_email, body, _ in emails],
+        )
+
+        async with connection.transaction():
+            for (email_id, subject, to_email, _, attempts), failure in zip(
+                emails, failures
+            ):
+                if failure is None:
+                    await connection.execute(MARK_EMAIL_SENT, (email_id,))
+                    continue
+
+                status = "failed" if attempts >= self.max_attempts else "pending"
+                reason = str(failure.__cause__ or failure)
+                logger.warning(
+                    f"Could not send {subject!r} to {to_email}, "
+                    f"attempt {attempts}: {reason}"
+                )
+                await connection.execute(
+                    MARK_EMAIL_FAILED,
+                    (status, reason, self.backoff(attempts), email_id),
+                )
+        return len(emails)
+
+    def on_notify(self, notify: Notify) -> None:
+        # announcements that arrive while a batch is being sent included
+        self._announced = True
+
+    async def serve(self, connection: AsyncConnection) -> None:
+        while not self.stopping:
+            self._announced = False
+            while (
+                await self.dispatch_batch(connection) == self.batch_size
+                and not self.stopping
+            ):
+                pass
+            if not self._announced:
+                await self.wait(connection, self.poll_interval)
+
+
+EMAIL_DISPATCHER = EmailDispatcher()
+
+
+if __name__ == "__main__":
+    # a dispatcher on its own, for deployments that don't run one per worker
+    asyncio.run(EMAIL_DISPATCHER.run(DB_CONN_STRING))
@@ -0,0 +1,36 @@
+# Multi-worker entry point: gunicorn -c gunicorn.conf.py main:app
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+# one event loop per core, each worker opens its own database pools
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Safe to preload, importing the app never connects to the database, the
+# pools are created inside each worker's lifespan after the fork.
+preload_app = True
+
+# seconds a worker gets to finish in-flight requests and drain its pools
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.getenv("WORKER_TIMEOUT", "60"))
+keepalive = 5
+
+# Workers write their metrics here so any of them can answer /metrics for all,
+# set before the app is preloaded, it reads the setting at import. The default
+# belongs to this master alone, another instance on the host has its own.
+default_metrics_dir = os.path.join(tempfile.gettempdir(), f"app-metrics-{os.getpid()}")
+os.environ.setdefault("METRICS_DIR", default_metrics_dir)
+
+
+def on_starting(server):
+    if os.environ["METRICS_DIR"] == default_metrics_dir:
+        # left by an earlier master with the same pid
+        shutil.rmtree(default_metrics_dir, ignore_errors=True)
+
+
+def on_exit(server):
+    if os.environ["METRICS_DIR"] == default_metrics_dir:
+        shutil.rmtree(default_metrics_dir, ignore_errors=True)
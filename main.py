@@ -1,40 +1,114 @@
+from contextlib import asynccontextmanager
+import random
+import time
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from api.routes.auth_router import router as auth_router
 from api.routes.user_routes import router as user_router
 from api.routes.sample_routes import router as sample_router
-from core.database import DB_POOL
+from api.routes.internal_routes import router as internal_router
+from api.routes.metrics_routes import router as metrics_router
+from core.config import (
+    CACHE_INVALIDATION_ENABLED,
+    EMAIL_OUTBOX_DISPATCHER_ENABLED,
+    SERVER_TIMING_SAMPLE_RATE,
+)
+from core.database import (
+    close_db_pools,
+    open_db_pools,
+    remember_primary_writes,
+    request_sessions,
+)
+from core.invalidation import INVALIDATION_BUS
+from core.outbox import EMAIL_DISPATCHER
+from loguru import logger
+from psycopg_pool import PoolTimeout, TooManyRequests
 
 from utils.api_utils import add_scopes_to_docs
+from utils.exception_handlers import database_unavailable_handler
+from utils.responses import FastJSONResponse
+from utils.emails import SMTP_POOL
+from utils.metrics import METRICS, RequestMetricsMiddleware
+from utils.security import shutdown_hashing_executor
+from utils.timing import server_timing, start_timing
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the connection pools once the event loop is running
+    await open_db_pools()
+    if CACHE_INVALIDATION_ENABLED.lower() == "true":
+        INVALIDATION_BUS.start()
+    if EMAIL_OUTBOX_DISPATCHER_ENABLED.lower() == "true":
+        EMAIL_DISPATCHER.start()
+    METRICS.start()
+    yield
+    # Close the pools and release their connections
+    await EMAIL_DISPATCHER.stop()
+    await INVALIDATION_BUS.stop()
+    await close_db_pools()
+    shutdown_hashing_executor()
+    SMTP_POOL.close()
+    await METRICS.stop()
 
 
-# app = FastAPI(lifespan=add_scopes_to_docs)
-# ml_models = {}
-# @asynccontextmanager
-# async def lifespan(app: FastAPI):
-#     # Load the ML model
-#     ml_models["answer_to_everything"] = fake_answer_to_everything_ml_model
-#     yield
-#     # Clean up the ML models and release the resources
-#     ml_models.clear()
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 
 
-# Ensure connections are returned to the pool after use
+# Ensure connections are returned to the pool after use, get_db normally does
+# this itself, this catches requests whose dependency teardown never ran.
 @app.middleware("http")
 async def release_db_connection(request, call_next):
+    try:
+        response = await call_next(request)
+    finally:
+        for session in list(request_sessions(request).values()):
+            await session.release()
+
+    remember_primary_writes(request, response)
+    return response
+
+
+# Breaks a sample of the requests down into where their time went, db, db-wait
+# (for a pooled connection), password, jwt and encode (the response_model dump
+# and the render, see TimedRoute), as a Server-Timing header for the browser's
+# devtools and a log line.
+@app.middleware("http")
+async def add_server_timing(request, call_next):
+    if random.random() >= SERVER_TIMING_SAMPLE_RATE:
+        return await call_next(request)
+
+    spans = start_timing()
+    started = time.perf_counter()
     response = await call_next(request)
-    if getattr(response, "connection", None) is not None:
-        DB_POOL.putconn(response.connection)
+    total = time.perf_counter() - started
+
+    response.headers["Server-Timing"] = server_timing(spans, total)
+    logger.bind(
+        method=request.method,
+        path=request.url.path,
+        status=response.status_code,
+        total_ms=round(total * 1000, 1),
+        spans={name: round(seconds * 1000, 1) for name, (seconds, _) in spans.items()},
+    ).info(
+        f"{request.method} {request.url.path} {response.status_code} "
+        f"took {total * 1000:.1f}ms: {server_timing(spans, total)}"
+    )
     return response
 
 
+# Counts and times every request for /metrics, see RequestMetricsMiddleware.
+app.add_middleware(RequestMetricsMiddleware)
+
 app.include_router(user_router)
 app.include_router(auth_router)
 app.include_router(sample_router)
+app.include_router(internal_router)
+app.include_router(metrics_router)
+
+app.add_exception_handler(PoolTimeout, database_unavailable_handler)
+app.add_exception_handler(TooManyRequests, database_unavailable_handler)
 
 add_scopes_to_docs(app)
 
@@ -0,0 +1,8 @@
+-- keyset pagination of the users list orders by (date_created, id), a NULL date_created
+-- would fall out of the row comparison so rows created before 003 are backfilled first,
+-- a batch at a time so no transaction holds many row locks for long.
+-- migrate:backfill 5000
+-- migrate:lock-timeout 5s
+-- migrate:retries 5
+UPDATE users SET date_created = NOW()
+WHERE id IN (SELECT id FROM users WHERE date_created IS NULL LIMIT %(batch_size)s);
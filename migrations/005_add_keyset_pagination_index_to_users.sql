@@ -0,0 +1,17 @@
+-- date_created is filled in by 004. SET NOT NULL would scan the table under an ACCESS EXCLUSIVE
+-- lock, a validated CHECK constraint proves it instead: adding it NOT VALID is instant and
+-- validating it only takes a lock that lets reads and writes through.
+-- migrate:no-transaction
+-- migrate:lock-timeout 5s
+-- migrate:retries 5
+ALTER TABLE users DROP CONSTRAINT IF EXISTS users_date_created_is_set;
+
+ALTER TABLE users ADD CONSTRAINT users_date_created_is_set CHECK (date_created IS NOT NULL) NOT VALID;
+
+ALTER TABLE users VALIDATE CONSTRAINT users_date_created_is_set;
+
+ALTER TABLE users ALTER COLUMN date_created SET NOT NULL;
+
+ALTER TABLE users DROP CONSTRAINT users_date_created_is_set;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_date_created_id_idx ON users (date_created, id);
@@ -0,0 +1,11 @@
+-- confirm_email looks users up by confirmation_token and reset_password by reset_token and its expiry.
+-- both tokens are NULL for most users so the indexes only cover the rows that have one.
+-- built concurrently, signups and logins keep writing to users meanwhile.
+-- migrate:no-transaction
+-- migrate:lock-timeout 5s
+-- migrate:retries 5
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_confirmation_token_idx ON users (confirmation_token)
+    WHERE confirmation_token IS NOT NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_reset_token_idx ON users (reset_token, reset_token_expiry)
+    WHERE reset_token IS NOT NULL;
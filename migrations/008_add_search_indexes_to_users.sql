@@ -0,0 +1,19 @@
+-- indexes behind the filters of the users listing, see user_filter_conditions.
+-- substring searches on username and full_name use trigram indexes, they need at least three characters to narrow anything down.
+-- built concurrently, signups and logins keep writing to users meanwhile.
+-- migrate:no-transaction
+-- migrate:lock-timeout 5s
+-- migrate:retries 5
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_username_trgm_idx ON users USING GIN (username gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_full_name_trgm_idx ON users USING GIN (full_name gin_trgm_ops);
+
+-- prefix searches compare the lowercased names, text_pattern_ops lets LIKE 'abc%' use them whatever the collation
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_lower_username_idx ON users (lower(username) text_pattern_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_lower_full_name_idx ON users (lower(full_name) text_pattern_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_email_domain_idx ON users (lower(split_part(email, '@', 2)));
+
+-- scope membership, scopes @> ARRAY[...]
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_scopes_idx ON users USING GIN (scopes);
@@ -0,0 +1,13 @@
+-- date_modified was added in 003 but never set, the ETags of the users listing depend on it.
+-- clock_timestamp so two updates in one transaction still get different versions.
+CREATE OR REPLACE FUNCTION set_date_modified() RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW IS DISTINCT FROM OLD THEN
+        NEW.date_modified = clock_timestamp();
+    END IF;
+    RETURN NEW;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS users_set_date_modified ON users;
+CREATE TRIGGER users_set_date_modified BEFORE UPDATE ON users
+    FOR EACH ROW EXECUTE FUNCTION set_date_modified();
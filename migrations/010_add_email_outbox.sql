@@ -0,0 +1,18 @@
+-- emails are written here in the same transaction as the change that triggers them
+-- and sent afterwards by the dispatcher, see core/outbox.py.
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    subject TEXT NOT NULL,
+    to_email VARCHAR(255) NOT NULL,
+    body TEXT NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'sending', 'sent', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    last_error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    sent_at TIMESTAMPTZ
+);
+
+-- the dispatcher only ever looks for due emails that are pending, or that are
+-- being sent by a dispatcher whose claim ran out
+CREATE INDEX IF NOT EXISTS email_outbox_pending_idx ON email_outbox (next_attempt_at) WHERE status IN ('pending', 'sending');
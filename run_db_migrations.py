@@ -1,10 +1,58 @@
+import hashlib
 import os
 import re
-import psycopg2
+import time
+from typing import Callable, Dict, List, Tuple, TypeVar
+
+import psycopg
+from psycopg import sql
 
 from core.config import DB_CONN_STRING
 from utils.errors import InvalidMigrationScript
 
+# held while migrating, every other runner waits for it instead of racing
+MIGRATIONS_LOCK_KEY = 7_391_021_654_208_113
+# attempts after a lock timeout unless a script says otherwise, and the
+# seconds before the first retry, doubled for each further one
+DEFAULT_LOCK_RETRIES = 3
+LOCK_RETRY_DELAY = 1.0
+
+# "-- migrate:<name> [value]" lines of a script, see Directives
+DIRECTIVE = re.compile(r"^--\s*migrate:([a-z-]+)[ \t]*(.*?)\s*$", re.M)
+# what can hide a semicolon: dollar quotes, string literals and comments
+STATEMENT_TOKEN = re.compile(
+    r"\$[A-Za-z_]*\$|'(?:[^']|'')*'|--[^\n]*|/\*.*?\*/|;", re.S
+)
+COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+# the placeholder of a backfill statement, see Directives
+BATCH_SIZE = "%(batch_size)s"
+CREATE_INDEX_CONCURRENTLY = re.compile(
+    r"^CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?"
+    r"(\S+)\s+ON\s",
+    re.I,
+)
+
+T = TypeVar("T")
+
+CREATE_LEDGER = sql.SQL(
+    """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        filename TEXT NOT NULL,
+        checksum CHAR(64) NOT NULL,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        execution_ms INTEGER NOT NULL
+    )
+    """
+)
+APPLIED_MIGRATIONS = sql.SQL(
+    "SELECT version, filename, checksum FROM schema_migrations"
+)
+RECORD_MIGRATION = sql.SQL(
+    "INSERT INTO schema_migrations (version, filename, checksum, execution_ms) "
+    "VALUES (%s, %s, %s, %s)"
+)
+
 
 def validate_migration_scripts(directory):
     migration_files = [f for f in os.listdir(directory) if f.endswith(".sql")]
@@ -22,34 +70,277 @@ def validate_migration_scripts(directory):
     return True
 
 
-def run_migrations(directory, db_conn_string):
-    migration_files = [f for f in os.listdir(directory) if f.endswith(".sql")]
-    migration_files.sort()
+class Directives:
+    """How a script is applied, declared with comment lines in it:
+
+    -- migrate:no-transaction       statements run one at a time outside a
+                                    transaction, CREATE INDEX CONCURRENTLY
+                                    needs it
+    -- migrate:lock-timeout 2s      gives up waiting for a lock after 2s,
+    -- migrate:retries 5            then tries again up to 5 times
+    -- migrate:statement-timeout 5min
+    -- migrate:backfill 5000        repeats every statement that picks
+                                    %(batch_size)s rows, 5000 here, each time
+                                    in its own transaction, until it changes
+                                    no row. The other statements, an ADD
+                                    COLUMN before the UPDATE, run once.
+                                    Implies no-transaction
+
+    A script that runs outside a transaction may have been half applied when
+    it failed, it runs again from the top next time so it must be safe to
+    repeat, IF NOT EXISTS and backfills that skip done rows. A CREATE INDEX
+    CONCURRENTLY that failed leaves an INVALID index behind, it is dropped
+    before the statement is tried again, IF NOT EXISTS would keep it.
+    """
+
+    def __init__(
+        self,
+        transaction: bool = True,
+        lock_timeout: str | None = None,
+        statement_timeout: str | None = None,
+        retries: int = DEFAULT_LOCK_RETRIES,
+        batch_size: int | None = None,
+    ) -> None:
+        self.transaction = transaction
+        self.lock_timeout = lock_timeout
+        self.statement_timeout = statement_timeout
+        self.retries = retries
+        self.batch_size = batch_size
+
+
+def parse_directives(filename: str, script: str) -> Directives:
+    directives = Directives()
+    for name, value in DIRECTIVE.findall(script):
+        try:
+            if name == "no-transaction":
+                directives.transaction = False
+            elif name == "lock-timeout" and value:
+                directives.lock_timeout = value
+            elif name == "statement-timeout" and value:
+                directives.statement_timeout = value
+            elif name == "retries":
+                directives.retries = int(value)
+            elif name == "backfill":
+                directives.batch_size = int(value)
+                directives.transaction = False
+            else:
+                raise ValueError(value)
+        except ValueError:
+            raise InvalidMigrationScript(
+                f"{filename}: invalid directive migrate:{name} {value}".rstrip()
+            )
+    return directives
+
+
+def split_statements(script: str) -> List[str]:
+    """Splits a script at the semicolons that end its statements."""
+
+    statements, start, dollar_quote = [], 0, None
+    for token in STATEMENT_TOKEN.finditer(script):
+        text = token.group()
+        if dollar_quote is not None:
+            if text == dollar_quote:
+                dollar_quote = None
+        elif text.startswith("$"):
+            dollar_quote = text
+        elif text == ";":
+            statements.append(script[start : token.start()])
+            start = token.end()
+    statements.append(script[start:])
+    # drop what is only comments and whitespace
+    return [
+        statement.strip()
+        for statement in statements
+        if COMMENT.sub("", statement).strip()
+    ]
+
+
+def with_lock_retries(filename: str, retries: int, apply: Callable[[], T]) -> T:
+    """Calls `apply` again, after a growing delay, when it timed out waiting
+    for a lock, until it ran out of `retries`."""
+
+    attempt = 0
+    while True:
+        try:
+            return apply()
+        except psycopg.errors.LockNotAvailable:
+            if attempt >= retries:
+                raise
+            delay = LOCK_RETRY_DELAY * 2**attempt
+            print(f"{filename} timed out waiting for a lock, retrying in {delay:g}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+def drop_invalid_index(conn: psycopg.Connection, statement: str) -> None:
+    """Drops what a failed attempt of `statement`, a CREATE INDEX
+    CONCURRENTLY, left behind: an INVALID index, never used by queries but
+    still maintained on every write."""
+
+    match = CREATE_INDEX_CONCURRENTLY.match(COMMENT.sub("", statement).strip())
+    if match is None:
+        return
+    name = match.group(1)
+    # no other runner builds indexes meanwhile, they wait for the migrations
+    # lock, so an invalid index is a leftover and not one being built
+    invalid = conn.execute(
+        "SELECT 1 FROM pg_index WHERE indexrelid = to_regclass(%s) "
+        "AND NOT indisvalid",
+        (name,),
+    ).fetchone()
+    if invalid:
+        print(f"Dropping {name}, left invalid by an earlier attempt")
+        conn.execute(
+            sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.SQL(name))
+        )
+
+
+def execute_once(conn: psycopg.Connection, statement: str) -> None:
+    drop_invalid_index(conn, statement)
+    conn.execute(statement)
+
+
+def set_timeouts(conn: psycopg.Connection, directives: Directives, local: bool):
+    # set_config(..., true) only lasts until the end of the transaction
+    for name, value in (
+        ("lock_timeout", directives.lock_timeout),
+        ("statement_timeout", directives.statement_timeout),
+    ):
+        if value:
+            conn.execute("SELECT set_config(%s, %s, %s)", (name, value, local))
 
-    conn = psycopg2.connect(db_conn_string)
-    cur = conn.cursor()
+
+def apply_migration(
+    conn: psycopg.Connection, version: int, filename: str, script: str
+) -> None:
+    """Runs one script as its directives say and records it in the ledger."""
+
+    directives = parse_directives(filename, script)
+    started = time.perf_counter()
+
+    def record():
+        elapsed = int((time.perf_counter() - started) * 1000)
+        conn.execute(RECORD_MIGRATION, (version, filename, checksum(script), elapsed))
+
+    if directives.transaction:
+
+        def apply_in_transaction():
+            with conn.transaction():
+                set_timeouts(conn, directives, local=True)
+                conn.execute(script)
+                record()
+
+        with_lock_retries(filename, directives.retries, apply_in_transaction)
+        return
+
+    set_timeouts(conn, directives, local=False)
     try:
-        for filename in migration_files:
-            with open(os.path.join(directory, filename), "r") as file:
-                sql = file.read()
-                if len(sql) == 0:
-                    raise InvalidMigrationScript(f"{filename} should not be empty.")
-                cur.execute(sql)
-                conn.commit()
-            print(f"Migration script {filename} executed successfully.")
-    except Exception as e:
-        print(f"Error executing migration script: {e}")
-        conn.rollback()
+        for statement in split_statements(script):
+            if directives.batch_size is None or BATCH_SIZE not in statement:
+                with_lock_retries(
+                    filename, directives.retries, lambda: execute_once(conn, statement)
+                )
+                continue
+
+            params = {"batch_size": directives.batch_size}
+            # rowcount is -1 when the server reports no count, only a batch
+            # that changed rows may have left more to do
+            while (
+                with_lock_retries(
+                    filename,
+                    directives.retries,
+                    lambda: conn.execute(statement, params).rowcount,
+                )
+                > 0
+            ):
+                pass
+        record()
     finally:
-        cur.close()
-        conn.close()
+        conn.execute("RESET lock_timeout")
+        conn.execute("RESET statement_timeout")
+
+
+def migration_version(filename: str) -> int:
+    return int(re.findall(r"\d+", filename)[0])
+
+
+def checksum(script: str) -> str:
+    return hashlib.sha256(script.encode()).hexdigest()
+
+
+def read_migrations(directory) -> List[Tuple[int, str, str]]:
+    """The (version, filename, script) of every migration, in order."""
+
+    migrations = []
+    for filename in sorted(f for f in os.listdir(directory) if f.endswith(".sql")):
+        with open(os.path.join(directory, filename), "r") as file:
+            script = file.read()
+        if len(script) == 0:
+            raise InvalidMigrationScript(f"{filename} should not be empty.")
+        migrations.append((migration_version(filename), filename, script))
+    return migrations
+
+
+def pending_migrations(
+    migrations: List[Tuple[int, str, str]], applied: Dict[int, Tuple[str, str]]
+) -> List[Tuple[int, str, str]]:
+    """The migrations missing from the ledger. An applied script that was
+    edited since is an error, the database would not match it."""
+
+    modified = [
+        filename
+        for version, filename, script in migrations
+        if version in applied and applied[version][1] != checksum(script)
+    ]
+    if modified:
+        raise InvalidMigrationScript(
+            f"Already applied migration scripts were modified: {', '.join(modified)}. "
+            "Add a new migration instead."
+        )
+    return [migration for migration in migrations if migration[0] not in applied]
+
+
+def run_migrations(directory, db_conn_string) -> List[str]:
+    """Applies the scripts of `directory` that the schema_migrations ledger
+    does not list yet, each in its own transaction unless its directives say
+    otherwise, and returns their file names.
+
+    Runners started at the same time queue on an advisory lock, the ones
+    that get it after the first find nothing left to do. A failing script
+    is rolled back and stops the run, the ones before it stay applied.
+    """
+
+    migrations = read_migrations(directory)
+    applied_now = []
+    with psycopg.connect(db_conn_string, autocommit=True) as conn:
+        conn.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_KEY,))
+        try:
+            conn.execute(CREATE_LEDGER)
+            applied = {
+                version: (filename, digest)
+                for version, filename, digest in conn.execute(
+                    APPLIED_MIGRATIONS
+                ).fetchall()
+            }
+
+            for version, filename, script in pending_migrations(migrations, applied):
+                try:
+                    apply_migration(conn, version, filename, script)
+                except psycopg.Error as e:
+                    raise InvalidMigrationScript(
+                        f"Error executing migration script {filename}: {e}"
+                    ) from e
+                applied_now.append(filename)
+                print(f"Migration script {filename} executed successfully.")
+        finally:
+            conn.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_KEY,))
+
+    if not applied_now:
+        print("No pending migration scripts.")
+    return applied_now
 
 
 if __name__ == "__main__":
     migration_directory = "./migrations"
     validate_migration_scripts(migration_directory)
     run_migrations(migration_directory, DB_CONN_STRING)
-
-
-if __name__ == "__main__":
-    migration_directory = "path/to/migration/scripts"
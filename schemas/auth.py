@@ -11,6 +11,7 @@ class Token(BaseModel):
 class TokenData(BaseModel):
     username: str | None = None
     scopes: List[str] = []
+    disabled: bool | None = None
 
 
 class TokenRefresh(BaseModel):
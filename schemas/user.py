@@ -1,6 +1,10 @@
+from datetime import datetime
+from enum import StrEnum
 from typing import List
 from uuid import UUID
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, PrivateAttr
+
+from core.mapping import RowMapper
 
 
 class CustomBaseModel(BaseModel):
@@ -37,8 +41,37 @@ class UserOut(User):
 
 
 class ListUsers(CustomBaseModel):
-    size: int
+    # None when the request asked for count=none
+    size: int | None
     users: List[UserOut]
+    # pass it back as `cursor` to get the next page, None on the last page
+    next_cursor: str | None = None
+    # digest of the page's content, the ETag of the response
+    _version: str | None = PrivateAttr(default=None)
+
+
+class SearchMode(StrEnum):
+    prefix = "prefix"
+    substring = "substring"
+
+
+class UserFilters(CustomBaseModel):
+    """Narrows a users listing, every filter given must match."""
+
+    # matched against the username or the full name, ignoring case
+    search: str | None = None
+    search_mode: SearchMode = SearchMode.substring
+    email_domain: str | None = None
+    disabled: bool | None = None
+    email_verified: bool | None = None
+    # the user must have all of them
+    scopes: List[str] = []
+    created_after: datetime | None = None
+    created_before: datetime | None = None
+
+
+USER_OUT_ROWS = RowMapper(UserOut, "users")
+USER_FROM_DB_ROWS = RowMapper(UserFromDB, "users")
 
 
 class UserCreate(CustomBaseModel):
@@ -48,5 +81,17 @@ class UserCreate(CustomBaseModel):
     full_name: str
 
 
+class BulkImportError(CustomBaseModel):
+    # 1 based position of the record in the import
+    row: int
+    email: str | None = None
+    detail: str
+
+
+class BulkUserImport(CustomBaseModel):
+    users: List[UserOut]
+    errors: List[BulkImportError]
+
+
 class UserUpdate(CustomBaseModel):
     password: str
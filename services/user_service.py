@@ -1,87 +1,310 @@
-from typing import List, Union
+import asyncio
+from datetime import datetime
+from typing import (
+    AsyncIterator,
+    Collection,
+    Dict,
+    List,
+    Sequence,
+    Tuple,
+    Union,
+)
 from uuid import UUID, uuid4
 import uuid
 from venv import logger
 
-import psycopg2
-from psycopg2 import sql
-from psycopg2.extensions import connection as PsycopgConnection
+import psycopg
+from psycopg import sql
+from core.config import BULK_IMPORT_CHUNK_SIZE
+from core.database import DatabaseSession
+from core.outbox import queue_email, queue_emails
 from schemas.auth import PasswordResetToken
-from schemas.user import ListUsers, User, UserCreate, UserFromDB, UserOut
-from utils.emails import send_email
+from schemas.user import (
+    USER_FROM_DB_ROWS,
+    USER_OUT_ROWS,
+    BulkImportError,
+    BulkUserImport,
+    ListUsers,
+    SearchMode,
+    User,
+    UserCreate,
+    UserFilters,
+    UserFromDB,
+    UserOut,
+)
+from utils.conditional import NotModified, matches, version_of
 from utils.errors import (
-    EMAIL_CONFIRMATION_ERROR_MESSAGE,
-    EMAIL_PASSWORD_RESET_ERROR_MESSAGE,
     BadReqeustException,
-    EmailException,
     ResourceNotFoundException,
     log_database_error,
 )
+from utils.pagination import CountStrategy, encode_cursor
 from utils.scopes import UserScope
-from utils.security import get_password_hash
+from utils.security import (
+    USER_BY_EMAIL,
+    get_password_hash,
+    invalidate_principal,
+    publish_principal_change,
+)
 import secrets, string
 
+DUPLICATE_USER_MESSAGE = "User with this email already exists"
+
+EXISTING_EMAILS = sql.SQL("SELECT email FROM users WHERE email = ANY(%s)")
+# bulk imports are COPYed into a scratch table first, then moved into users
+# with a single INSERT that skips emails taken since they were checked
+CREATE_USERS_IMPORT_TABLE = sql.SQL(
+    "CREATE TEMP TABLE users_import ON COMMIT DROP AS SELECT username, email, "
+    "full_name, hashed_password, scopes, confirmation_token FROM users WITH NO DATA"
+)
+COPY_USERS_IMPORT = sql.SQL(
+    "COPY users_import (username, email, full_name, hashed_password, scopes, "
+    "confirmation_token) FROM STDIN"
+)
+INSERT_USERS_IMPORT = sql.SQL(
+    "INSERT INTO users (username, email, full_name, hashed_password, scopes, "
+    "confirmation_token) SELECT username, email, full_name, hashed_password, "
+    "scopes, confirmation_token FROM users_import "
+    "ON CONFLICT (email) DO NOTHING RETURNING id, email"
+)
+
+# the page queries select the mapper's {columns}, date_created, the first
+# half of the next cursor, and the row's version, {filters} is where the
+# UserFilters conditions go
+USERS_PAGE_AFTER = sql.SQL(
+    "SELECT {columns}, date_created, coalesce(date_modified, date_created) "
+    "FROM users WHERE (date_created, id) > (%s, %s){filters} "
+    "ORDER BY date_created, id LIMIT %s"
+)
+USERS_PAGE_AT_OFFSET = sql.SQL(
+    "SELECT {columns}, date_created, coalesce(date_modified, date_created) "
+    "FROM users{filters} ORDER BY date_created, id OFFSET %s LIMIT %s"
+)
+COUNT_USERS = sql.SQL("SELECT COUNT(*) FROM users{filters}")
+# the planner's guess of how many users match, from the column statistics
+ESTIMATE_USERS = sql.SQL("EXPLAIN (FORMAT JSON) SELECT 1 FROM users{filters}")
+# no ORDER BY, an export is read in whatever order a sequential scan gives
+USERS_EXPORT = sql.SQL(USER_OUT_ROWS.select)
+
+
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def user_filter_conditions(
+    filters: UserFilters,
+) -> Tuple[List[sql.Composable], List]:
+    """The WHERE conditions and parameters of `filters`, each one is served
+    by an index of migration 007."""
+
+    conditions: List[sql.Composable] = []
+    params: List = []
+    if filters.search:
+        if filters.search_mode == SearchMode.prefix:
+            conditions.append(
+                sql.SQL("(lower(username) LIKE %s OR lower(full_name) LIKE %s)")
+            )
+            pattern = f"{escape_like(filters.search.lower())}%"
+        else:
+            conditions.append(sql.SQL("(username ILIKE %s OR full_name ILIKE %s)"))
+            pattern = f"%{escape_like(filters.search)}%"
+        params += [pattern, pattern]
+    if filters.email_domain:
+        conditions.append(sql.SQL("lower(split_part(email, '@', 2)) = %s"))
+        params.append(filters.email_domain.lstrip("@").lower())
+    # a NULL flag reads as not set
+    if filters.disabled is not None:
+        conditions.append(sql.SQL("coalesce(disabled, FALSE) = %s"))
+        params.append(filters.disabled)
+    if filters.email_verified is not None:
+        conditions.append(sql.SQL("coalesce(email_verified, FALSE) = %s"))
+        params.append(filters.email_verified)
+    if filters.scopes:
+        conditions.append(sql.SQL("scopes @> %s::varchar[]"))
+        params.append(filters.scopes)
+    if filters.created_after:
+        conditions.append(sql.SQL("date_created >= %s"))
+        params.append(filters.created_after)
+    if filters.created_before:
+        conditions.append(sql.SQL("date_created < %s"))
+        params.append(filters.created_before)
+    return conditions, params
+
+
+def _where(conditions: Sequence[sql.Composable]) -> sql.Composable:
+    if not conditions:
+        return sql.SQL("")
+    return sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conditions)
+
+
+def _and(conditions: Sequence[sql.Composable]) -> sql.Composable:
+    if not conditions:
+        return sql.SQL("")
+    return sql.SQL(" AND ") + sql.SQL(" AND ").join(conditions)
+
+
+def confirmation_email(email: str, confirmation_token: str) -> Tuple[str, str, str]:
+    confirmation_link = f"http://yourapp.com/confirm_email?token={confirmation_token}"
+    email_body = (
+        f"Please confirm your email by clicking on the link below:\n{confirmation_link}"
+    )
+    return "Confirm Your Email", email, email_body
+
 
 class UserService:
 
     def __init__(self, db, requesting_user: User | None = None) -> None:
-        self.db: PsycopgConnection = db
+        self.db: DatabaseSession = db
         self.cursor = self.db.cursor()
         self.requesting_user = requesting_user
 
-    def get_users(self, offset: int, page_count: int) -> ListUsers | Exception:
-        table_fields = list(UserOut.model_fields.keys())
-        tables_str = ", ".join(table_fields)
+    async def get_users(
+        self,
+        offset: int,
+        page_count: int,
+        after: Tuple[datetime, UUID] | None = None,
+        count: CountStrategy = CountStrategy.exact,
+        filters: UserFilters | None = None,
+        fields: Sequence[str] | None = None,
+        known_versions: Collection[str] = (),
+    ) -> ListUsers | NotModified | Exception:
+        """Pages through the users matching `filters` ordered by
+        (date_created, id).
+
+        With `fields` only those columns, and the id, are read and set on the
+        users, serialize them with `include`.
+
+        The page's version digests the ids and modification dates of its
+        users, its size and fields. When it is one of `known_versions` the
+        users aren't even built, NotModified is returned instead.
+
+        When `after`, the position of the last user of the previous page, is
+        given the page starts right after it through the index and `offset` is
+        ignored, otherwise the first `offset` users are skipped. `count` picks
+        how the total is computed, see `CountStrategy`.
+        """
+        conditions, params = user_filter_conditions(filters or UserFilters())
+        # the id is always read, the next cursor needs it
+        mapper = USER_OUT_ROWS.only({*fields, "id"}) if fields else USER_OUT_ROWS
+        columns = sql.SQL(mapper.columns)
         try:
-            self.cursor.execute(
-                sql.SQL(f"SELECT {tables_str} FROM users OFFSET %s LIMIT %s"),
-                (
-                    offset,
-                    page_count,
-                ),
-            )
-            rows = self.cursor.fetchall()
-
-            self.cursor.execute(sql.SQL("SELECT COUNT(*) FROM users"))
-            user_size = self.cursor.fetchone()
+            if after:
+                await self.cursor.execute(
+                    USERS_PAGE_AFTER.format(columns=columns, filters=_and(conditions)),
+                    (*after, *params, page_count),
+                )
+            else:
+                await self.cursor.execute(
+                    USERS_PAGE_AT_OFFSET.format(
+                        columns=columns, filters=_where(conditions)
+                    ),
+                    (
+                        *params,
+                        offset,
+                        page_count,
+                    ),
+                )
+            rows = await self.cursor.fetchall()
+
+            user_size = await self.count_users(count, conditions, params)
         except Exception as exception:
             return log_database_error(exception)
 
-        user_size = user_size[0] if user_size else 0
-        user_dicts: List[UserOut] = []
+        # the row's version is the last column
+        id_index = mapper.fields.index("id")
+        version = version_of(
+            [mapper.fields, user_size, *((row[id_index], row[-1]) for row in rows)]
+        )
+        if matches(version, known_versions):
+            return NotModified(version)
+
+        users = mapper.many(rows)
+
+        next_cursor = None
+        # a short page is the last one
+        if rows and len(rows) == page_count:
+            next_cursor = encode_cursor(rows[-1][len(mapper.fields)], users[-1].id)
+
+        page = ListUsers(size=user_size, users=users, next_cursor=next_cursor)
+        page._version = version
+        return page
+
+    async def count_users(
+        self,
+        strategy: CountStrategy,
+        conditions: Sequence[sql.Composable] = (),
+        params: Sequence = (),
+    ) -> int | None:
+        """Counts the users matching `conditions`. The table wide shortcuts
+        don't apply to filtered counts: those are estimated from the plan of
+        the filtered query, or counted."""
+
+        if strategy == CountStrategy.none:
+            return None
+
+        if conditions:
+            if strategy == CountStrategy.estimated:
+                await self.cursor.execute(
+                    ESTIMATE_USERS.format(filters=_where(conditions)), params
+                )
+                row = await self.cursor.fetchone()
+                if row:
+                    return row[0][0]["Plan"]["Plan Rows"]
+        elif strategy == CountStrategy.estimated:
+            # reltuples is -1 until the table has been vacuumed or analyzed
+            await self.cursor.execute(
+                sql.SQL(
+                    "SELECT reltuples::bigint FROM pg_class WHERE oid = 'users'::regclass"
+                )
+            )
+            row = await self.cursor.fetchone()
+            if row and row[0] >= 0:
+                return row[0]
+        elif strategy == CountStrategy.counter:
+            await self.cursor.execute(
+                sql.SQL(
+                    "SELECT SUM(row_count)::bigint FROM row_counts WHERE table_name = 'users'"
+                )
+            )
+            row = await self.cursor.fetchone()
+            # no slots yet, the migration's initial count hasn't run
+            if row and row[0] is not None:
+                return row[0]
 
-        for row in rows:
-            datum = {}
-            for index, _table in enumerate(table_fields):
-                datum[_table] = row[index]
+        await self.cursor.execute(
+            COUNT_USERS.format(filters=_where(conditions)), params
+        )
+        row = await self.cursor.fetchone()
+        return row[0] if row else 0
 
-            user_dicts.append(UserOut(**datum))
+    async def export_users(self, itersize: int) -> AsyncIterator[List[UserOut]]:
+        """Yields every user in batches of `itersize` read from a server-side
+        cursor, so memory stays flat however large the table is."""
 
-        return ListUsers(size=user_size, users=user_dicts)
+        async with self.db.server_cursor("users_export") as cursor:
+            await cursor.execute(USERS_EXPORT)
+            while rows := await cursor.fetchmany(itersize):
+                yield USER_OUT_ROWS.many(rows)
 
-    def get_user(self, email: str) -> Union[UserFromDB, Exception]:
-        table_fields = list(UserFromDB.model_fields.keys())
-        tables_str = ", ".join(table_fields)
-        self.cursor.execute(
-            sql.SQL(f"SELECT {tables_str} FROM users WHERE email = %s"), (email,)
-        )
-        row = self.cursor.fetchone()
+    async def get_user(self, email: str) -> Union[UserFromDB, Exception]:
+        await self.cursor.execute(USER_BY_EMAIL, (email,))
+        row = await self.cursor.fetchone()
 
         if row:
-            user_dict = {}
-            for index, _table in enumerate(table_fields):
-                user_dict[_table] = row[index]
-
-            return UserFromDB(**user_dict)
+            return USER_FROM_DB_ROWS.one(row)
         return ResourceNotFoundException("User not found")
 
-    def create_user(self, user: UserCreate) -> Union[User, Exception]:
-        hashed_password = get_password_hash(user.password)
+    async def create_user(
+        self, user: UserCreate, hashed_password: str
+    ) -> Union[User, Exception]:
+        """Stores `user` with its `hashed_password`, hashed by the caller
+        before it checks out a connection."""
+
         default_scopes = [UserScope.list_.value]
         try:
             # Create confirmation token
             confirmation_token = secrets.token_hex(5).upper()
-            self.cursor.execute(
+            await self.cursor.execute(
                 sql.SQL(
                     """
                         INSERT INTO users (username, email, full_name, disabled, hashed_password, 
@@ -100,26 +323,20 @@ class UserService:
                     confirmation_token,
                 ),
             )
-            self.db.commit()
+            publish_principal_change(self.db, user.email)
+            # Queue the email confirmation, it is sent once the user exists
+            await queue_email(
+                self.db, *confirmation_email(user.email, confirmation_token)
+            )
+            await self.db.commit()
 
             # Fetch the result (the inserted ID)
-            result = self.cursor.fetchone()
+            result = await self.cursor.fetchone()
             inserted_id = result[0] if result else None
 
-            # Send email for email confirmation
-            confirmation_link = (
-                f"http://yourapp.com/confirm_email?token={confirmation_token}"
-            )
-            email_body = f"Please confirm your email by clicking on the link below:\n{confirmation_link}"
-
-            send_email("Confirm Your Email", user.email, email_body)
-
-        except psycopg2.IntegrityError as e:
-            self.db.rollback()
+        except psycopg.IntegrityError as e:
+            await self.db.rollback()
             return log_database_error(e, "User with this email already exists")
-        except EmailException as e:
-            logger.error(e)
-            return BadReqeustException(EMAIL_CONFIRMATION_ERROR_MESSAGE)
         except Exception as e:
             logger.error(e)
             return BadReqeustException(str(e))
@@ -131,7 +348,139 @@ class UserService:
             full_name=user.full_name,
         )
 
-    def confirm_email(self, token: str) -> Union[User, Exception]:
+    async def create_users_bulk(
+        self,
+        users: Sequence[UserCreate],
+        chunk_size: int = BULK_IMPORT_CHUNK_SIZE,
+        rows: Sequence[int] | None = None,
+    ) -> BulkUserImport:
+        """Creates many users at once, `chunk_size` at a time: the passwords of
+        a chunk are hashed in parallel, the rows are COPYed in and committed
+        together. Records that can't be created are reported by their row
+        instead of failing the import, the confirmation emails of the created
+        users are written to the outbox with them.
+
+        Records are numbered from 1 unless `rows` gives their numbers, as for
+        a file whose invalid lines were already left out."""
+
+        created: List[UserOut] = []
+        errors: List[BulkImportError] = []
+
+        # the first record of an email wins, later ones are reported
+        first_rows: Dict[str, int] = {}
+        pending: List[Tuple[int, UserCreate]] = []
+        for row, user in zip(rows or range(1, len(users) + 1), users):
+            if user.email in first_rows:
+                errors.append(
+                    BulkImportError(
+                        row=row,
+                        email=user.email,
+                        detail=f"Duplicate of row {first_rows[user.email]}",
+                    )
+                )
+                continue
+            first_rows[user.email] = row
+            pending.append((row, user))
+
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start : start + chunk_size]
+            try:
+                chunk_created, chunk_errors = await self._import_chunk(chunk)
+            except Exception as exception:
+                await self.db.rollback()
+                detail = str(log_database_error(exception))
+                errors.extend(
+                    BulkImportError(row=row, email=user.email, detail=detail)
+                    for row, user in chunk
+                )
+                continue
+
+            created.extend(chunk_created)
+            errors.extend(chunk_errors)
+        errors.sort(key=lambda error: error.row)
+        return BulkUserImport(users=created, errors=errors)
+
+    async def _import_chunk(
+        self, chunk: List[Tuple[int, UserCreate]]
+    ) -> Tuple[List[UserOut], List[BulkImportError]]:
+        errors: List[BulkImportError] = []
+
+        # existing users are weeded out first, no point hashing their passwords
+        await self.cursor.execute(EXISTING_EMAILS, ([user.email for _, user in chunk],))
+        existing = {row[0] for row in await self.cursor.fetchall()}
+        new_users = []
+        for row, user in chunk:
+            if user.email in existing:
+                errors.append(
+                    BulkImportError(
+                        row=row, email=user.email, detail=DUPLICATE_USER_MESSAGE
+                    )
+                )
+            else:
+                new_users.append((row, user))
+
+        if not new_users:
+            return [], errors
+
+        hashed_passwords = await asyncio.gather(
+            *(get_password_hash(user.password, bulk=True) for _, user in new_users)
+        )
+        confirmation_tokens = {
+            user.email: secrets.token_hex(5).upper() for _, user in new_users
+        }
+        default_scopes = [UserScope.list_.value]
+
+        await self.cursor.execute(CREATE_USERS_IMPORT_TABLE)
+        async with self.cursor.copy(COPY_USERS_IMPORT) as copy:
+            for (_, user), hashed_password in zip(new_users, hashed_passwords):
+                await copy.write_row(
+                    (
+                        user.username,
+                        user.email,
+                        user.full_name,
+                        hashed_password,
+                        default_scopes,
+                        confirmation_tokens[user.email],
+                    )
+                )
+        await self.cursor.execute(INSERT_USERS_IMPORT)
+        inserted = {email: user_id for user_id, email in await self.cursor.fetchall()}
+        # sent once the users exist, retried by the outbox if SMTP fails
+        await queue_emails(
+            self.db,
+            [
+                confirmation_email(user.email, confirmation_tokens[user.email])
+                for _, user in new_users
+                if user.email in inserted
+            ],
+        )
+        # no principal to invalidate, unknown users are never cached
+        await self.db.commit()
+
+        created = []
+        for row, user in new_users:
+            if user.email not in inserted:
+                # created by someone else since we looked
+                errors.append(
+                    BulkImportError(
+                        row=row, email=user.email, detail=DUPLICATE_USER_MESSAGE
+                    )
+                )
+                continue
+            created.append(
+                UserOut(
+                    id=inserted[user.email],
+                    username=user.username,
+                    email=user.email,
+                    full_name=user.full_name,
+                    disabled=False,
+                    scopes=default_scopes,
+                )
+            )
+
+        return created, errors
+
+    async def confirm_email(self, token: str) -> Union[User, Exception]:
         """Confirms the user's email. Please note returned data will have the email and username hidden
 
         Args:
@@ -142,24 +491,27 @@ class UserService:
         """
 
         try:
-            self.cursor.execute(
+            await self.cursor.execute(
                 sql.SQL(
-                    "UPDATE users SET email_verified = TRUE WHERE confirmation_token = %s"
+                    "UPDATE users SET email_verified = TRUE WHERE confirmation_token = %s RETURNING email"
                 ),
                 (token,),
             )
 
             if self.cursor.rowcount == 0:
                 return BadReqeustException("Invalid confirmation token")
-            self.db.commit()
-        except psycopg2.DatabaseError as error:
+            row = await self.cursor.fetchone()
+            publish_principal_change(self.db, row[0])
+            await self.db.commit()
+            invalidate_principal(row[0])
+        except psycopg.DatabaseError as error:
             return log_database_error(error)
         except Exception as e:
             return BadReqeustException(e)
 
         return User(email_verified=True, email="hidden", username="hidden")
 
-    def request_password_reset(
+    async def request_password_reset(
         self, email: str
     ) -> Union[PasswordResetToken, Exception]:
         # Generate and save reset token
@@ -167,7 +519,7 @@ class UserService:
             secrets.choice(string.ascii_letters + string.digits) for _ in range(16)
         )
         try:
-            self.cursor.execute(
+            await self.cursor.execute(
                 sql.SQL(
                     "UPDATE users SET reset_token = %s, reset_token_expiry = NOW() + INTERVAL '10 minutes' WHERE email = %s"
                 ),
@@ -175,28 +527,29 @@ class UserService:
             )
             if self.cursor.rowcount == 0:
                 return ResourceNotFoundException("User not found")
-            self.db.commit()
 
-            # Send email with reset token
+            # Queue the email with the reset token, sent with the commit
             reset_link = f"http://yourapp.com/reset_password?token={reset_token}"
             email_body = (
                 f"Please use the following link to reset your password:\n{reset_link}"
             )
-            send_email("Reset Your Password", email, email_body)
+            await queue_email(self.db, "Reset Your Password", email, email_body)
+            await self.db.commit()
             return PasswordResetToken(email=email, token=reset_token)
-        except psycopg2.DatabaseError as e:
+        except psycopg.DatabaseError as e:
             return log_database_error(e)
-        except EmailException as e:
-            return BadReqeustException(EMAIL_PASSWORD_RESET_ERROR_MESSAGE)
         except Exception as e:
             return BadReqeustException(e)
 
-    def reset_password(self, token: str, new_password: str) -> Union[User, Exception]:
+    async def reset_password(
+        self, token: str, hashed_password: str
+    ) -> Union[User, Exception]:
         """Resets the user's password. Please note returned data will have the email and username hidden
 
         Args:
             token (str): The token that was sent to the user.
-            new_password (str): The new chosen password of the user.
+            hashed_password (str): The hash of the new chosen password, made
+                before the connection was checked out.
 
         Returns:
             Union[User, Exception]: If any error occur while updating the records
@@ -204,28 +557,29 @@ class UserService:
 
         try:
             # Check if token is valid
-            self.cursor.execute(
+            await self.cursor.execute(
                 sql.SQL(
                     "SELECT email FROM users WHERE reset_token = %s AND reset_token_expiry >= NOW()"
                 ),
                 (token,),
             )
-            row = self.cursor.fetchone()
+            row = await self.cursor.fetchone()
 
             if not row:
                 return BadReqeustException("Invalid or expired token")
 
             email = row[0]
             # Update password
-            hashed_password = get_password_hash(new_password)
-            self.cursor.execute(
+            await self.cursor.execute(
                 sql.SQL(
                     "UPDATE users SET hashed_password = %s, reset_token = NULL, reset_token_expiry = NULL WHERE email = %s"
                 ),
                 (hashed_password, email),
             )
-            self.db.commit()
-        except psycopg2.DatabaseError as e:
+            publish_principal_change(self.db, email)
+            await self.db.commit()
+            invalidate_principal(email)
+        except psycopg.DatabaseError as e:
             return log_database_error(e)
         except Exception as e:
             return BadReqeustException(e)
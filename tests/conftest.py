@@ -0,0 +1,100 @@
+from contextlib import contextmanager
+import os
+from unittest.mock import MagicMock
+from uuid import uuid4
+
+import psycopg
+from psycopg import sql
+from psycopg.conninfo import conninfo_to_dict, make_conninfo
+import pytest
+
+from core.database import DatabaseSession
+from run_db_migrations import run_migrations
+
+# a database the tests may create and drop databases from
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+@pytest.fixture
+def anyio_backend():
+    # psycopg's async connections only run on asyncio
+    return "asyncio"
+
+
+def database_conninfo(name: str) -> str:
+    return make_conninfo(**{**conninfo_to_dict(TEST_DATABASE_URL), "dbname": name})
+
+
+def drop_database(name: str) -> None:
+    with psycopg.connect(TEST_DATABASE_URL, autocommit=True) as admin:
+        admin.execute(
+            sql.SQL("DROP DATABASE IF EXISTS {} WITH (FORCE)").format(
+                sql.Identifier(name)
+            )
+        )
+
+
+@pytest.fixture(scope="session")
+def template_database():
+    """A database with every migration applied, run once per session and per
+    xdist worker. Tests get clones of it, see clone_database."""
+
+    if not TEST_DATABASE_URL:
+        pytest.skip("needs TEST_DATABASE_URL")
+
+    worker = os.getenv("PYTEST_XDIST_WORKER", "main")
+    name = f"test_template_{worker}_{uuid4().hex[:8]}"
+    with psycopg.connect(TEST_DATABASE_URL, autocommit=True) as admin:
+        admin.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(name)))
+    try:
+        run_migrations("./migrations", database_conninfo(name))
+        yield name
+    finally:
+        drop_database(name)
+
+
+@pytest.fixture(scope="session")
+def clone_database(template_database):
+    """Returns a context manager that creates a copy of the migrated template
+    and drops it on exit, yielding its connection string.
+
+    Copying the template's files takes milliseconds where migrating a fresh
+    database takes seconds.
+    """
+
+    with psycopg.connect(TEST_DATABASE_URL, autocommit=True) as admin:
+        # the default WAL_LOG strategy of Postgres 15+ is slower for small
+        # databases
+        strategy = "STRATEGY FILE_COPY" if admin.info.server_version >= 150000 else ""
+
+    @contextmanager
+    def clone():
+        name = f"test_{uuid4().hex[:12]}"
+        with psycopg.connect(TEST_DATABASE_URL, autocommit=True) as admin:
+            admin.execute(
+                sql.SQL("CREATE DATABASE {} TEMPLATE {} {}").format(
+                    sql.Identifier(name),
+                    sql.Identifier(template_database),
+                    sql.SQL(strategy),
+                )
+            )
+        try:
+            yield database_conninfo(name)
+        finally:
+            drop_database(name)
+
+    return clone
+
+
+@pytest.fixture
+def database_url(clone_database):
+    """A migrated database of the test's own."""
+    with clone_database() as url:
+        yield url
+
+
+@pytest.fixture
+async def db(database_url):
+    """A DatabaseSession on the test's own database."""
+    async with await psycopg.AsyncConnection.connect(database_url) as connection:
+        yield DatabaseSession(connection, MagicMock())
@@ -0,0 +1,250 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import anyio
+import pytest
+from psycopg_pool import PoolTimeout
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+from core.config import DB_READ_YOUR_WRITES_COOKIE
+from core.database import (
+    DatabasePools,
+    DatabaseSession,
+    PoolMetrics,
+    ReplicaSet,
+    db_pools,
+    get_db,
+    get_read_db,
+    open_detached_read_session,
+    remember_primary_writes,
+    request_sessions,
+)
+
+pytestmark = pytest.mark.anyio
+
+
+def make_request(cookies: str = "") -> Request:
+    headers = [(b"cookie", cookies.encode())] if cookies else []
+    return Request({"type": "http", "path": "/users/", "headers": headers})
+
+
+def make_pool(name: str) -> MagicMock:
+    connection = MagicMock()
+    connection.commit = AsyncMock()
+    connection.rollback = AsyncMock()
+    connection.cursor.return_value = AsyncMock()
+
+    pool = MagicMock()
+    pool.name = name
+    pool.get_stats.return_value = {
+        "pool_min": 1,
+        "pool_max": 10,
+        "pool_size": 1,
+        "pool_available": 0,
+        "requests_waiting": 0,
+    }
+    pool.getconn = AsyncMock(return_value=connection)
+    pool.putconn = AsyncMock()
+    return pool
+
+
+@pytest.fixture
+def mock_pools():
+    pools = DatabasePools(make_pool("primary"), ReplicaSet([], "round_robin"))
+    with patch("core.database._DB_POOLS", pools):
+        yield pools
+
+
+@pytest.fixture
+def mock_pool(mock_pools):
+    return mock_pools.primary
+
+
+@pytest.fixture
+def mock_replicas(mock_pools):
+    mock_pools.replicas = ReplicaSet(
+        [make_pool("replica-0"), make_pool("replica-1")], "round_robin"
+    )
+    return mock_pools.replicas
+
+
+async def test_get_db_commits_and_returns_the_connection(mock_pool):
+    request = make_request()
+    dependency = get_db(request)
+    session = await dependency.__anext__()
+    assert request_sessions(request)["primary"] is session
+
+    # every caller in the request shares the same cursor
+    assert session.cursor() is session.cursor()
+    connection = session.connection
+
+    with pytest.raises(StopAsyncIteration):
+        await dependency.__anext__()
+
+    connection.commit.assert_awaited_once()
+    connection.rollback.assert_not_awaited()
+    connection.cursor.return_value.close.assert_awaited_once()
+    mock_pool.putconn.assert_awaited_once_with(connection)
+
+
+async def test_get_db_rolls_back_and_returns_the_connection_on_error(mock_pool):
+    dependency = get_db(make_request())
+    session = await dependency.__anext__()
+    connection = session.connection
+
+    with pytest.raises(ValueError):
+        await dependency.athrow(ValueError("boom"))
+
+    connection.rollback.assert_awaited_once()
+    connection.commit.assert_not_awaited()
+    mock_pool.putconn.assert_awaited_once_with(connection)
+
+
+async def test_release_is_idempotent(mock_pool):
+    connection = await mock_pool.getconn()
+    session = DatabaseSession(connection, mock_pool)
+
+    await session.release()
+    await session.release()
+
+    # no cursor was asked for, so there is nothing to close
+    connection.cursor.assert_not_called()
+    mock_pool.putconn.assert_awaited_once_with(connection)
+
+
+async def test_get_db_counts_checkout_timeouts(mock_pools, mock_pool):
+    mock_pool.getconn.side_effect = PoolTimeout("no connection")
+    metrics = mock_pools.primary_metrics
+
+    with pytest.raises(PoolTimeout):
+        await get_db(make_request()).__anext__()
+
+    assert metrics.snapshot()["checkout_timeouts"] == 1
+    assert metrics.checkout_wait.count == 0
+
+
+def test_pool_metrics_snapshot_and_saturation_warning(mock_pool):
+    mock_pool.get_stats.return_value = {
+        "pool_min": 1,
+        "pool_max": 10,
+        "pool_size": 10,
+        "pool_available": 1,
+        "requests_waiting": 3,
+        "connections_lost": 1,
+        "returns_bad": 2,
+    }
+    metrics = PoolMetrics(mock_pool, saturation_threshold=0.8)
+
+    with patch("core.database.logger") as mock_logger:
+        metrics.record_checkout(0.002)
+        metrics.record_checkout(0.3)
+        # warnings are rate limited
+        mock_logger.warning.assert_called_once()
+
+    metrics.record_hold("/users/", 0.04)
+    snapshot = metrics.snapshot()
+
+    assert snapshot["in_use"] == 9
+    assert snapshot["idle"] == 1
+    assert snapshot["waiting"] == 3
+    assert snapshot["connections_discarded"] == 3
+    assert snapshot["checkout_wait_seconds"]["count"] == 2
+    assert snapshot["checkout_wait_seconds"]["buckets"]["0.005"] == 1
+    assert snapshot["hold_seconds"]["/users/"]["count"] == 1
+
+
+async def test_get_read_db_uses_the_primary_without_replicas(mock_pool):
+    request = make_request()
+    writer = get_db(request)
+    reader = get_read_db(request)
+
+    # both dependencies share the request's single primary connection
+    assert await reader.__anext__() is await writer.__anext__()
+    mock_pool.getconn.assert_awaited_once()
+
+
+async def test_get_read_db_round_robins_replicas(mock_pool, mock_replicas):
+    chosen = []
+    for _ in range(3):
+        session = await get_read_db(make_request()).__anext__()
+        chosen.append(session.pool.name)
+
+    assert chosen == ["replica-0", "replica-1", "replica-0"]
+    mock_pool.getconn.assert_not_awaited()
+
+
+async def test_detached_read_sessions_are_left_to_the_caller(mock_pool, mock_replicas):
+    request = make_request()
+    session = await open_detached_read_session(request)
+
+    assert session.pool.name == "replica-0"
+    # the request neither shares nor releases it
+    assert request_sessions(request) == {}
+
+    await session.release()
+    session.pool.putconn.assert_awaited_once()
+    assert mock_replicas.metrics["replica-0"].checked_out == 0
+
+
+def test_least_busy_replica_is_chosen(mock_replicas):
+    mock_replicas.strategy = "least_busy"
+    mock_replicas.pools[0].get_stats.return_value = {
+        "pool_size": 5,
+        "pool_available": 1,
+        "requests_waiting": 2,
+    }
+    mock_replicas.pools[1].get_stats.return_value = {
+        "pool_size": 5,
+        "pool_available": 4,
+        "requests_waiting": 0,
+    }
+
+    assert mock_replicas.choose().name == "replica-1"
+
+
+async def test_reads_stay_on_the_primary_after_a_write(mock_pool, mock_replicas):
+    # a write earlier in the same request
+    request = make_request()
+    writer = await get_db(request).__anext__()
+    await writer.commit()
+    reader = await get_read_db(request).__anext__()
+    assert reader is writer
+
+    response = Response()
+    remember_primary_writes(request, response)
+    assert DB_READ_YOUR_WRITES_COOKIE in response.headers["set-cookie"]
+
+    # a later request of the same client
+    request = make_request(cookies=f"{DB_READ_YOUR_WRITES_COOKIE}=1")
+    reader = await get_read_db(request).__anext__()
+    assert reader.pool is mock_pool
+
+
+async def test_pools_are_not_shared_with_forked_processes(mock_pools):
+    with patch("os.getpid", return_value=mock_pools.pid + 1):
+        with pytest.raises(RuntimeError):
+            db_pools()
+
+
+async def test_closing_pools_waits_for_checked_out_connections(mock_pools):
+    pool = mock_pools.primary
+    pool.close = AsyncMock()
+
+    dependency = get_db(make_request())
+    await dependency.__anext__()
+    assert mock_pools.primary_metrics.checked_out == 1
+
+    async def finish_request():
+        with pytest.raises(StopAsyncIteration):
+            await dependency.__anext__()
+
+    # the request finishes while shutdown is waiting for it
+    async with anyio.create_task_group() as tasks:
+        tasks.start_soon(mock_pools.close, 5)
+        await anyio.sleep(0.1)
+        pool.close.assert_not_awaited()
+        tasks.start_soon(finish_request)
+
+    pool.close.assert_awaited_once()
+    assert mock_pools.primary_metrics.checked_out == 0
@@ -0,0 +1,81 @@
+import asyncio
+import os
+from unittest.mock import AsyncMock, MagicMock
+
+import psycopg
+import pytest
+
+from core.database import DatabaseSession
+from core.invalidation import InvalidationBus
+from utils.cache import TTLCache
+
+pytestmark = pytest.mark.anyio
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+def make_bus(cache: TTLCache, channel: str = "cache_invalidation") -> InvalidationBus:
+    bus = InvalidationBus(channel)
+    bus.subscribe("principal", cache.invalidate, cache.clear)
+    return bus
+
+
+async def test_notifications_are_sent_with_the_commit_only():
+    connection = MagicMock()
+    connection.execute = AsyncMock()
+    connection.commit = AsyncMock()
+    connection.rollback = AsyncMock()
+    session = DatabaseSession(connection, MagicMock())
+    bus = make_bus(TTLCache(10, 30))
+
+    bus.publish(session, "principal", "solomon@gmail.com")
+    await session.rollback()
+    await session.commit()
+    connection.execute.assert_not_awaited()
+
+    bus.publish(session, "principal", "solomon@gmail.com")
+    await session.commit()
+    connection.execute.assert_awaited_once()
+    assert "solomon@gmail.com" in connection.execute.call_args.args[1][1]
+
+
+def test_dispatch_evicts_the_key_and_ignores_garbage():
+    cache = TTLCache(10, 30)
+    cache.set("solomon@gmail.com", "principal")
+    cache.set("other@gmail.com", "principal")
+    bus = make_bus(cache)
+
+    bus.dispatch("not json")
+    bus.dispatch('{"cache": "unknown", "key": "solomon@gmail.com"}')
+    bus.dispatch('{"cache": "principal", "key": "solomon@gmail.com"}')
+
+    assert cache.get("solomon@gmail.com") is None
+    assert cache.get("other@gmail.com") == "principal"
+
+
+@pytest.mark.skipif(not TEST_DATABASE_URL, reason="needs TEST_DATABASE_URL")
+async def test_committed_changes_evict_entries_of_listening_workers():
+    cache = TTLCache(10, 30)
+    bus = make_bus(cache, channel="test_cache_invalidation")
+    bus.start(TEST_DATABASE_URL)
+    try:
+        # wait for the listener to be connected, it clears the cache then
+        cache.set("solomon@gmail.com", "principal")
+        for _ in range(100):
+            await asyncio.sleep(0.05)
+            if cache.get("solomon@gmail.com") is None:
+                break
+        cache.set("solomon@gmail.com", "principal")
+
+        async with await psycopg.AsyncConnection.connect(TEST_DATABASE_URL) as conn:
+            session = DatabaseSession(conn, MagicMock())
+            bus.publish(session, "principal", "solomon@gmail.com")
+            await session.commit()
+
+        for _ in range(100):
+            if len(cache) == 0:
+                break
+            await asyncio.sleep(0.05)
+        assert len(cache) == 0
+    finally:
+        await bus.stop()
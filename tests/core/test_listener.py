@@ -0,0 +1,109 @@
+import asyncio
+import os
+import time
+
+import psycopg
+import pytest
+
+from core.listener import Listener
+
+pytestmark = pytest.mark.anyio
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+needs_database = pytest.mark.skipif(
+    not TEST_DATABASE_URL, reason="needs TEST_DATABASE_URL"
+)
+
+
+class Recorder(Listener):
+    def __init__(self, channel: str, stop_timeout: float = 5) -> None:
+        super().__init__(channel, stop_timeout)
+        self.payloads = []
+        self.serving = asyncio.Event()
+
+    def on_notify(self, notify):
+        self.payloads.append(notify.payload)
+
+    async def serve(self, connection):
+        self.serving.set()
+        while not self.stopping:
+            await self.wait(connection)
+
+
+class Stubborn(Recorder):
+    async def serve(self, connection):
+        self.serving.set()
+        await asyncio.sleep(3600)
+
+
+async def notify(channel: str, *payloads: str):
+    async with await psycopg.AsyncConnection.connect(
+        TEST_DATABASE_URL, autocommit=True
+    ) as conn:
+        for payload in payloads:
+            await conn.execute(f"NOTIFY {channel}, '{payload}'")
+
+
+@needs_database
+async def test_notifications_are_handed_to_the_listener():
+    listener = Recorder("test_listener")
+    listener.start(TEST_DATABASE_URL)
+    try:
+        await asyncio.wait_for(listener.serving.wait(), 5)
+        await notify("test_listener", "one", "two")
+        for _ in range(100):
+            if len(listener.payloads) == 2:
+                break
+            await asyncio.sleep(0.05)
+        assert listener.payloads == ["one", "two"]
+    finally:
+        await listener.stop()
+
+
+@needs_database
+async def test_a_quiet_listener_stops_right_away():
+    listener = Recorder("test_listener")
+    listener.start(TEST_DATABASE_URL)
+    await asyncio.wait_for(listener.serving.wait(), 5)
+
+    started = time.monotonic()
+    await listener.stop()
+    assert time.monotonic() - started < 1
+
+
+@needs_database
+async def test_a_listener_stops_while_notifications_are_coming_in():
+    stopped = asyncio.Event()
+
+    async def announce():
+        async with await psycopg.AsyncConnection.connect(
+            TEST_DATABASE_URL, autocommit=True
+        ) as conn:
+            while not stopped.is_set():
+                await conn.execute("NOTIFY test_listener")
+
+    announcing = asyncio.create_task(announce())
+    try:
+        for _ in range(5):
+            listener = Recorder("test_listener")
+            listener.start(TEST_DATABASE_URL)
+            await asyncio.wait_for(listener.serving.wait(), 5)
+            await asyncio.wait_for(listener.stop(), 5)
+    finally:
+        stopped.set()
+        await announcing
+
+
+@needs_database
+async def test_stop_gives_up_waiting_after_the_timeout():
+    listener = Stubborn("test_listener", stop_timeout=0.2)
+    listener.start(TEST_DATABASE_URL)
+    await asyncio.wait_for(listener.serving.wait(), 5)
+    task = listener._task
+
+    started = time.monotonic()
+    await listener.stop()
+    assert time.monotonic() - started < 1
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(task, 5)
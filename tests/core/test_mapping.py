@@ -0,0 +1,75 @@
+from uuid import uuid4
+
+import pydantic
+import pytest
+
+from core.mapping import RowMapper
+from schemas.user import USER_OUT_ROWS, UserOut
+
+row = (
+    "solomon@gmail.com",
+    "solomon@gmail.com",
+    "Solomon",
+    False,
+    ["users.list"],
+    True,
+    uuid4(),
+)
+
+
+def test_columns_and_select_follow_the_model_fields():
+    assert USER_OUT_ROWS.fields == tuple(UserOut.model_fields)
+    assert USER_OUT_ROWS.select == (
+        "SELECT username, email, full_name, disabled, scopes, email_verified, id "
+        "FROM users"
+    )
+
+
+def test_trusted_and_validated_rows_give_the_same_model():
+    trusted = USER_OUT_ROWS.one(row)
+    validated = USER_OUT_ROWS.one(row, validate=True)
+
+    assert isinstance(trusted, UserOut)
+    assert trusted == validated
+    assert trusted.model_dump() == validated.model_dump()
+    assert trusted.model_fields_set == validated.model_fields_set
+
+
+def test_extra_columns_are_ignored():
+    user = USER_OUT_ROWS.one(row + ("2024-03-01",))
+
+    assert user.model_dump() == USER_OUT_ROWS.one(row, validate=True).model_dump()
+
+
+def test_trusted_models_do_not_share_state():
+    first, second = USER_OUT_ROWS.many([row, row])
+    first.full_name = "Aboyeji"
+
+    assert second.full_name == "Solomon"
+    assert "full_name" in first.model_fields_set
+    assert second.model_fields_set == set(USER_OUT_ROWS.fields)
+
+
+def test_validated_rows_are_checked():
+    mapper = RowMapper(UserOut, "users")
+
+    with pytest.raises(pydantic.ValidationError):
+        mapper.one(row[:-1] + ("not-a-uuid",), validate=True)
+
+
+def test_subsets_select_and_set_only_their_fields():
+    subset = USER_OUT_ROWS.only(["id", "username"])
+
+    assert subset is USER_OUT_ROWS.only({"username", "id"})
+    # in the model's order whatever the order asked
+    assert subset.select == "SELECT username, id FROM users"
+
+    user = subset.one(("solomon@gmail.com", row[-1]))
+    assert user.model_dump_json(include={"id", "username"}) == (
+        f'{{"username":"solomon@gmail.com","id":"{row[-1]}"}}'
+    )
+
+
+def test_subsets_reject_unknown_fields():
+    with pytest.raises(ValueError):
+        USER_OUT_ROWS.only(["id", "hashed_password"])
@@ -0,0 +1,191 @@
+import asyncio
+import os
+import time
+from unittest.mock import AsyncMock, MagicMock
+from uuid import uuid4
+
+import psycopg
+from psycopg import sql
+from psycopg.conninfo import make_conninfo
+import pytest
+
+from core.database import DatabaseSession
+from core.outbox import ENQUEUE_EMAIL, EmailDispatcher, queue_email
+from utils.emails import email_failure
+
+pytestmark = pytest.mark.anyio
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+async def test_queued_emails_are_announced_with_the_commit_only():
+    connection = MagicMock()
+    connection.execute = AsyncMock()
+    connection.commit = AsyncMock()
+    connection.rollback = AsyncMock()
+    session = DatabaseSession(connection, MagicMock())
+
+    await queue_email(session, "Subject", "solomon@gmail.com", "Body")
+    connection.execute.assert_awaited_once_with(
+        ENQUEUE_EMAIL, ("Subject", "solomon@gmail.com", "Body")
+    )
+    await session.rollback()
+    await session.commit()
+    assert connection.execute.await_count == 1
+
+    await queue_email(session, "Subject", "solomon@gmail.com", "Body")
+    await session.commit()
+    assert connection.execute.call_args.args[1] == ("email_outbox", "")
+
+
+def test_retries_back_off_exponentially_up_to_a_limit():
+    dispatcher = EmailDispatcher(retry_delay=30, max_retry_delay=3600)
+
+    assert [dispatcher.backoff(attempts) for attempts in (1, 2, 3, 4)] == [
+        30,
+        60,
+        120,
+        240,
+    ]
+    assert dispatcher.backoff(20) == 3600
+
+
+@pytest.fixture
+async def outbox_url():
+    """The email_outbox migration applied in a scratch schema."""
+
+    schema = f"outbox_{uuid4().hex[:8]}"
+    url = make_conninfo(TEST_DATABASE_URL, options=f"-c search_path={schema}")
+    with open("migrations/010_add_email_outbox.sql") as migration:
+        script = migration.read()
+    async with await psycopg.AsyncConnection.connect(url, autocommit=True) as conn:
+        await conn.execute(sql.SQL("CREATE SCHEMA {}").format(sql.Identifier(schema)))
+        await conn.execute(script)
+    try:
+        yield url
+    finally:
+        async with await psycopg.AsyncConnection.connect(
+            TEST_DATABASE_URL, autocommit=True
+        ) as conn:
+            await conn.execute(
+                sql.SQL("DROP SCHEMA {} CASCADE").format(sql.Identifier(schema))
+            )
+
+
+async def emails(url: str):
+    async with await psycopg.AsyncConnection.connect(url) as conn:
+        cursor = await conn.execute(
+            "SELECT to_email, status, attempts, last_error, "
+            "next_attempt_at > NOW() FROM email_outbox ORDER BY id"
+        )
+        return await cursor.fetchall()
+
+
+@pytest.mark.skipif(not TEST_DATABASE_URL, reason="needs TEST_DATABASE_URL")
+async def test_dispatchers_share_the_outbox_without_sending_twice(outbox_url):
+    sent = []
+
+    def send(messages):
+        time.sleep(0.05)
+        sent.extend(to_email for _, to_email, _ in messages)
+        return [None] * len(messages)
+
+    async with await psycopg.AsyncConnection.connect(outbox_url) as conn:
+        session = DatabaseSession(conn, MagicMock())
+        for index in range(10):
+            await queue_email(session, "Subject", f"user{index}@example.com", "Body")
+        await session.commit()
+
+    async def dispatch():
+        dispatcher = EmailDispatcher(batch_size=3, send=send)
+        async with await psycopg.AsyncConnection.connect(
+            outbox_url, autocommit=True
+        ) as conn:
+            while await dispatcher.dispatch_batch(conn):
+                pass
+
+    await asyncio.gather(dispatch(), dispatch())
+
+    assert sorted(sent) == sorted(f"user{index}@example.com" for index in range(10))
+    assert {row[1:3] for row in await emails(outbox_url)} == {("sent", 1)}
+
+
+@pytest.mark.skipif(not TEST_DATABASE_URL, reason="needs TEST_DATABASE_URL")
+async def test_failed_emails_are_retried_later_then_given_up(outbox_url):
+    def send(messages):
+        unreachable = ConnectionRefusedError("SMTP server unreachable")
+        return [email_failure(unreachable) for _ in messages]
+
+    async with await psycopg.AsyncConnection.connect(outbox_url) as conn:
+        session = DatabaseSession(conn, MagicMock())
+        await queue_email(session, "Subject", "solomon@gmail.com", "Body")
+        await session.commit()
+
+    dispatcher = EmailDispatcher(max_attempts=2, retry_delay=0, send=send)
+    async with await psycopg.AsyncConnection.connect(
+        outbox_url, autocommit=True
+    ) as conn:
+        assert await dispatcher.dispatch_batch(conn) == 1
+        assert await emails(outbox_url) == [
+            ("solomon@gmail.com", "pending", 1, "SMTP server unreachable", False)
+        ]
+
+        dispatcher.retry_delay = 60
+        assert await dispatcher.dispatch_batch(conn) == 1
+        assert await dispatcher.dispatch_batch(conn) == 0
+
+    assert await emails(outbox_url) == [
+        ("solomon@gmail.com", "failed", 2, "SMTP server unreachable", True)
+    ]
+
+
+@pytest.mark.skipif(not TEST_DATABASE_URL, reason="needs TEST_DATABASE_URL")
+async def test_emails_are_not_locked_while_being_sent(outbox_url):
+    seen_while_sending = []
+
+    def send(messages):
+        with psycopg.connect(outbox_url) as conn:
+            seen_while_sending.extend(
+                conn.execute(
+                    "SELECT status FROM email_outbox FOR UPDATE NOWAIT"
+                ).fetchall()
+            )
+        return [None] * len(messages)
+
+    async with await psycopg.AsyncConnection.connect(outbox_url) as conn:
+        session = DatabaseSession(conn, MagicMock())
+        await queue_email(session, "Subject", "solomon@gmail.com", "Body")
+        await session.commit()
+
+    dispatcher = EmailDispatcher(send=send)
+    async with await psycopg.AsyncConnection.connect(
+        outbox_url, autocommit=True
+    ) as conn:
+        assert await dispatcher.dispatch_batch(conn) == 1
+
+    assert seen_while_sending == [("sending",)]
+    assert [row[1:3] for row in await emails(outbox_url)] == [("sent", 1)]
+
+
+@pytest.mark.skipif(not TEST_DATABASE_URL, reason="needs TEST_DATABASE_URL")
+async def test_emails_of_a_dispatcher_that_died_are_claimed_again(outbox_url):
+    def die(messages):
+        raise RuntimeError("worker killed")
+
+    async with await psycopg.AsyncConnection.connect(outbox_url) as conn:
+        session = DatabaseSession(conn, MagicMock())
+        await queue_email(session, "Subject", "solomon@gmail.com", "Body")
+        await session.commit()
+
+    async with await psycopg.AsyncConnection.connect(
+        outbox_url, autocommit=True
+    ) as conn:
+        with pytest.raises(RuntimeError):
+            await EmailDispatcher(claim_timeout=60, send=die).dispatch_batch(conn)
+        dispatcher = EmailDispatcher(send=lambda messages: [None] * len(messages))
+        assert await dispatcher.dispatch_batch(conn) == 0
+
+        await conn.execute("UPDATE email_outbox SET next_attempt_at = NOW()")
+        assert await dispatcher.dispatch_batch(conn) == 1
+
+    assert [row[1:3] for row in await emails(outbox_url)] == [("sent", 2)]
@@ -0,0 +1,264 @@
+"""Runs every statement of the users services against a seeded users table
+and fails when one that should use an index plans a sequential scan.
+
+Needs TEST_DATABASE_URL, see the template_database fixture.
+"""
+
+import ast
+from datetime import datetime, timedelta
+import hashlib
+import inspect
+import os
+import re
+from typing import Dict, List, Tuple
+from unittest.mock import MagicMock
+from uuid import uuid4
+
+import psycopg
+from psycopg import AsyncCursor, AsyncServerCursor, sql
+import pytest
+
+from core.database import DatabaseSession
+import core.outbox as outbox
+from schemas.user import SearchMode, UserCreate, UserFilters
+import services.user_service as user_service
+from services.user_service import UserService
+from utils.errors import EmailException
+from utils.pagination import CountStrategy, decode_cursor
+import utils.security as security
+
+pytestmark = [
+    pytest.mark.anyio,
+    pytest.mark.skipif(
+        not os.getenv("TEST_DATABASE_URL"), reason="needs TEST_DATABASE_URL"
+    ),
+]
+
+SEEDED_USERS = 100_000
+
+
+def normalize(query, context=None) -> str:
+    if isinstance(query, sql.Composable):
+        # identifiers need a connection to be quoted
+        query = query.as_string(context)
+    return re.sub(r"\s+", " ", query).strip().rstrip(";")
+
+
+# statements that read the whole table by design
+FULL_SCANS = {
+    "SELECT COUNT(*) FROM users",
+    normalize(user_service.USERS_EXPORT),
+}
+# reads the scratch table that only exists while an import runs
+UNPLANNABLE = {normalize(user_service.INSERT_USERS_IMPORT)}
+
+
+def module_statements(module) -> List[str]:
+    """Every sql.SQL of a module, inline literals and module constants. The
+    {placeholders} of templates match anything, fragments such as filter
+    conditions only have to appear in some statement."""
+
+    statements = [
+        normalize(value)
+        for value in vars(module).values()
+        if isinstance(value, sql.SQL)
+    ]
+    for node in ast.walk(ast.parse(inspect.getsource(module))):
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Attribute)
+            and node.func.attr == "SQL"
+            and node.args
+            and isinstance(node.args[0], ast.Constant)
+        ):
+            statements.append(normalize(node.args[0].value))
+    return statements
+
+
+def md5_of(n: int) -> str:
+    return hashlib.md5(str(n).encode()).hexdigest()
+
+
+def fail_password_resets(messages):
+    # the dispatcher records both outcomes
+    return [
+        (
+            EmailException("SMTP server unreachable")
+            if subject == "Reset Your Password"
+            else None
+        )
+        for subject, _, _ in messages
+    ]
+
+
+EXECUTED: List[Tuple[str, object]] = []
+
+
+def as_pattern(statement: str) -> re.Pattern:
+    parts = re.split(r"\{\w*\}", statement)
+    return re.compile(".*".join(re.escape(part) for part in parts))
+
+
+class RecordingCursor(AsyncCursor):
+    async def execute(self, query, params=None, **kwargs):
+        EXECUTED.append((normalize(query, self), params))
+        return await super().execute(query, params, **kwargs)
+
+    def copy(self, statement, params=None, **kwargs):
+        EXECUTED.append((normalize(statement, self), params))
+        return super().copy(statement, params, **kwargs)
+
+
+class RecordingServerCursor(AsyncServerCursor):
+    async def execute(self, query, params=None, **kwargs):
+        EXECUTED.append((normalize(query, self), params))
+        return await super().execute(query, params, **kwargs)
+
+
+@pytest.fixture(scope="module")
+def anyio_backend():
+    # the statements are recorded once for the whole module
+    return "asyncio"
+
+
+@pytest.fixture(scope="module")
+def seeded_database(clone_database):
+    """A clone of the migrated template with a large users table."""
+
+    with clone_database() as url:
+        with psycopg.connect(url) as connection:
+            connection.execute(
+                """
+                INSERT INTO users (username, email, full_name, hashed_password, scopes,
+                    confirmation_token, reset_token, reset_token_expiry, date_created)
+                SELECT 'user' || n,
+                    'user' || n || CASE WHEN n %% 100 = 0 THEN '@acme.io' ELSE '@example.com' END,
+                    'Full Name ' || md5(n::text), 'hash',
+                    CASE WHEN n %% 100 = 0 THEN '{users.list,users.create}'
+                        ELSE '{users.list}' END::varchar[],
+                    md5(n::text),
+                    CASE WHEN n %% 100 = 0 THEN md5('reset' || n) END,
+                    CASE WHEN n %% 100 = 0 THEN NOW() + INTERVAL '10 minutes' END,
+                    NOW() - n * INTERVAL '1 second'
+                FROM generate_series(1, %s) AS n
+                """,
+                (SEEDED_USERS,),
+            )
+            connection.commit()
+            connection.autocommit = True
+            connection.execute("VACUUM ANALYZE users")
+        yield url
+
+
+@pytest.fixture(scope="module")
+async def executed_statements(seeded_database):
+    """Drives every UserService method, the security lookups and the email
+    dispatcher, recording each statement they execute with its parameters."""
+
+    os.environ["TESTING"] = "True"
+    EXECUTED.clear()
+    async with await psycopg.AsyncConnection.connect(
+        seeded_database, cursor_factory=RecordingCursor
+    ) as connection:
+        connection.server_cursor_factory = RecordingServerCursor
+        db = DatabaseSession(connection, MagicMock())
+        service = UserService(db)
+
+        page = await service.get_users(offset=100, page_count=10)
+        await service.get_users(
+            offset=0, page_count=10, after=decode_cursor(page.next_cursor)
+        )
+        for strategy in CountStrategy:
+            await service.get_users(offset=0, page_count=10, count=strategy)
+        for filters in (
+            UserFilters(search="ser4242"),
+            UserFilters(search="USER4242", search_mode=SearchMode.prefix),
+            UserFilters(email_domain="acme.io", disabled=False),
+            UserFilters(scopes=["users.create"], email_verified=False),
+            UserFilters(
+                search="ser42",
+                created_after=datetime.now() - timedelta(minutes=5),
+                created_before=datetime.now(),
+            ),
+        ):
+            for strategy in (CountStrategy.exact, CountStrategy.estimated):
+                page = await service.get_users(
+                    offset=0, page_count=10, count=strategy, filters=filters
+                )
+            if page.next_cursor:
+                await service.get_users(
+                    offset=0,
+                    page_count=10,
+                    after=decode_cursor(page.next_cursor),
+                    filters=filters,
+                )
+        await service.get_user("user42@example.com")
+        await security.get_user_from_db(db, "user42@example.com")
+
+        email = f"{uuid4().hex[:8]}@example.com"
+        await service.create_user(
+            UserCreate(username=email, email=email, password="secret", full_name=""),
+            "hashed",
+        )
+        await service.create_users_bulk(
+            [
+                UserCreate(
+                    username="bulk",
+                    email=f"bulk-{uuid4().hex[:8]}@example.com",
+                    password="secret",
+                    full_name="",
+                ),
+                UserCreate(
+                    username="bulk", email=email, password="secret", full_name=""
+                ),
+            ],
+        )
+        await service.confirm_email(md5_of(7))
+        reset = await service.request_password_reset("user42@example.com")
+        await service.reset_password(reset.token, "hashed")
+        async for _ in service.export_users(itersize=50_000):
+            pass
+
+        dispatcher = outbox.EmailDispatcher(send=fail_password_resets)
+        await dispatcher.listen(connection)
+        await dispatcher.dispatch_batch(connection)
+
+    return list(EXECUTED)
+
+
+def seq_scanned_relations(plan: Dict) -> List[str]:
+    scans = []
+    if plan.get("Node Type") == "Seq Scan":
+        scans.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        scans.extend(seq_scanned_relations(child))
+    return scans
+
+
+@pytest.mark.parametrize("module", [user_service, security, outbox])
+async def test_every_statement_is_exercised(module, executed_statements):
+    executed = {query for query, _ in executed_statements}
+    missing = [
+        statement
+        for statement in module_statements(module)
+        if not any(as_pattern(statement).search(query) for query in executed)
+    ]
+    assert not missing, f"Not covered by the plan suite: {missing}"
+
+
+async def test_hot_statements_use_indexes(seeded_database, executed_statements):
+    regressions = []
+    async with await psycopg.AsyncConnection.connect(seeded_database) as connection:
+        for query, params in executed_statements:
+            if not query.split(" ", 1)[0] in ("SELECT", "UPDATE", "INSERT", "DELETE"):
+                continue
+            if query in FULL_SCANS or query in UNPLANNABLE:
+                continue
+
+            cursor = await connection.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+            (plan,) = (await cursor.fetchone())[0]
+            if "users" in seq_scanned_relations(plan["Plan"]):
+                regressions.append(query)
+            await connection.rollback()
+
+    assert not regressions, f"Sequential scans on users: {regressions}"
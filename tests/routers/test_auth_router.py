@@ -0,0 +1,79 @@
+"""The auth routes against a real pool, see the database_url fixture."""
+
+import os
+from unittest.mock import patch
+
+import httpx
+import psycopg
+import pytest
+
+from core.database import DatabasePools, ReplicaSet, create_pool
+from main import app
+import utils.security
+
+os.environ["TESTING"] = "True"
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def pools(database_url):
+    pools = DatabasePools(
+        create_pool(database_url, "primary"), ReplicaSet([], "round_robin")
+    )
+    await pools.open()
+    try:
+        with patch("core.database._DB_POOLS", pools):
+            yield pools
+    finally:
+        await pools.close(drain_timeout=0)
+
+
+async def test_passwords_are_hashed_without_holding_a_connection(pools, database_url):
+    held_while_hashing = []
+
+    def hash_password(password):
+        held_while_hashing.append(pools.primary_metrics.checked_out)
+        return f"hashed {password}"
+
+    def verify_password(password, hashed_password):
+        held_while_hashing.append(pools.primary_metrics.checked_out)
+        return hashed_password == f"hashed {password}"
+
+    transport = httpx.ASGITransport(app=app)
+    with patch.object(utils.security, "_hash_password", hash_password), patch.object(
+        utils.security, "_verify_password", verify_password
+    ):
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://testserver"
+        ) as client:
+            signup = await client.post(
+                "/auth/users/",
+                json={
+                    "username": "solomon",
+                    "email": "solomon@gmail.com",
+                    "full_name": "Solomon",
+                    "password": "secret",
+                },
+            )
+            assert signup.status_code == 200, signup.json()
+            await client.post(
+                "/auth/request_password_reset/",
+                params={"email": "solomon@gmail.com"},
+            )
+            with psycopg.connect(database_url) as connection:
+                (token,) = connection.execute(
+                    "SELECT reset_token FROM users"
+                ).fetchone()
+            reset = await client.post(
+                "/auth/reset_password/",
+                params={"token": token, "new_password": "new-secret"},
+            )
+            assert reset.status_code == 200, reset.json()
+            login = await client.post(
+                "/auth/token",
+                data={"username": "solomon@gmail.com", "password": "new-secret"},
+            )
+
+    assert login.status_code == 200, login.json()
+    assert held_while_hashing == [0, 0, 0]
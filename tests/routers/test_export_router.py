@@ -0,0 +1,95 @@
+"""The users export against a real pool, see the database_url fixture."""
+
+import os
+from unittest.mock import patch
+
+import anyio
+import psycopg
+import pytest
+
+from core.database import DatabasePools, ReplicaSet, create_pool
+from main import app
+from utils.security import get_current_user
+
+os.environ["TESTING"] = "True"
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def pools(database_url):
+    with psycopg.connect(database_url) as connection:
+        # more rows than one batch of the export's cursor
+        connection.execute(
+            "INSERT INTO users (username, email, hashed_password) "
+            "SELECT 'user' || n, 'user' || n || '@example.com', 'hash' "
+            "FROM generate_series(1, 5000) AS n"
+        )
+
+    pools = DatabasePools(
+        create_pool(database_url, "primary"), ReplicaSet([], "round_robin")
+    )
+    await pools.open()
+    app.dependency_overrides[get_current_user] = lambda: None
+    try:
+        with patch("core.database._DB_POOLS", pools):
+            yield pools
+    finally:
+        app.dependency_overrides.clear()
+        await pools.close(drain_timeout=0)
+
+
+async def abort_export(after_chunks: int) -> int:
+    """Requests an export and disconnects once `after_chunks` chunks of the
+    body arrived, returns the chunks received."""
+
+    disconnected = anyio.Event()
+    if after_chunks < 0:
+        # gone before the response even started
+        disconnected.set()
+    requested = False
+    chunks = 0
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal chunks
+        if message["type"] == "http.response.body":
+            chunks += 1
+        if chunks >= after_chunks:
+            disconnected.set()
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/users/export",
+        "raw_path": b"/users/export",
+        "query_string": b"",
+        "headers": [(b"host", b"testserver")],
+        "client": ("127.0.0.1", 1234),
+        "server": ("testserver", 80),
+    }
+    with anyio.fail_after(10):
+        await app(scope, receive, send)
+    return chunks
+
+
+@pytest.mark.parametrize("after_chunks", [-1, 0, 1, 2])
+async def test_aborted_exports_return_their_connection(pools, after_chunks):
+    for _ in range(3):
+        await abort_export(after_chunks)
+
+    metrics = pools.primary_metrics
+    with anyio.fail_after(5):
+        while metrics.checked_out:
+            await anyio.sleep(0.01)
+    assert pools.primary.get_stats()["requests_waiting"] == 0
@@ -1,21 +1,34 @@
+from datetime import datetime
 import os
 import unittest
 from uuid import uuid4
-import psycopg2
+import psycopg
 import pytest
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
+from core.database import DatabaseSession
 from schemas.auth import PasswordResetToken
-from services.user_service import UserService
+from services.user_service import UserService, user_filter_conditions
 from utils.errors import (
     BadReqeustException,
     DuplicateResourceException,
     ResourceNotFoundException,
 )
-from schemas.user import User, UserCreate, UserFromDB, UserOut
+from schemas.user import (
+    SearchMode,
+    User,
+    UserCreate,
+    UserFilters,
+    UserFromDB,
+    UserOut,
+)
+from utils.conditional import NotModified
+from utils.pagination import CountStrategy, decode_cursor
 
 
 os.environ["TESTING"] = "True"
 
+pytestmark = pytest.mark.anyio
+
 expected_user = UserOut(
     id=uuid4(),
     username="solomon@gmail.com",
@@ -29,14 +42,18 @@ expected_user = UserOut(
 
 @pytest.fixture
 def mock_db_connection():
-    return MagicMock()
+    # cursor() is synchronous on psycopg's AsyncConnection, the rest is awaited
+    connection = MagicMock()
+    connection.commit = AsyncMock()
+    connection.rollback = AsyncMock()
+    return connection
 
 
-def test_get_users_success(mock_db_connection):
+async def test_get_users_success(mock_db_connection):
     mock_db_connection.reset_mock()
 
     # Mock the cursor and execute method
-    mock_cursor = MagicMock()
+    mock_cursor = AsyncMock()
     mock_db_connection.cursor.return_value = mock_cursor
 
     # Set up a mock return value for the execute method
@@ -47,7 +64,7 @@ def test_get_users_success(mock_db_connection):
     user_service = UserService(mock_db_connection)
 
     # Call the method under test with appropriate parameters
-    result = user_service.get_users(offset=0, page_count=10)
+    result = await user_service.get_users(offset=0, page_count=10)
 
     # Assertions
     mock_db_connection.cursor.assert_called_once()
@@ -55,16 +72,298 @@ def test_get_users_success(mock_db_connection):
     mock_cursor.execute.assert_called()
 
 
-def test_create_users_success(mock_db_connection):
+async def test_get_users_pages_by_cursor(mock_db_connection):
+    mock_cursor = AsyncMock()
+    mock_db_connection.cursor.return_value = mock_cursor
+
+    date_created = datetime(2024, 3, 1, 12, 30)
+    mock_cursor.fetchall.return_value = [expected_user.list_values() + [date_created]]
+    mock_cursor.fetchone.return_value = (5,)
+
+    after = (datetime(2024, 2, 1), uuid4())
+    result = await UserService(mock_db_connection).get_users(
+        offset=40, page_count=1, after=after
+    )
+
+    query, params = mock_cursor.execute.call_args_list[0].args
+    assert "(date_created, id) > (%s, %s)" in query.as_string(None)
+    assert "OFFSET" not in query.as_string(None)
+    assert params == (*after, 1)
+
+    assert result.size == 5
+    assert result.users == [expected_user]
+    # a full page points at its last user
+    assert decode_cursor(result.next_cursor) == (date_created, expected_user.id)
+
+
+async def test_get_users_last_page_has_no_cursor(mock_db_connection):
+    mock_cursor = AsyncMock()
+    mock_db_connection.cursor.return_value = mock_cursor
+
+    mock_cursor.fetchall.return_value = [
+        expected_user.list_values() + [datetime(2024, 3, 1)]
+    ]
+    mock_cursor.fetchone.return_value = (1,)
+
+    result = await UserService(mock_db_connection).get_users(offset=0, page_count=10)
+
+    query, params = mock_cursor.execute.call_args_list[0].args
+    assert "ORDER BY date_created, id OFFSET %s LIMIT %s" in query.as_string(None)
+    assert params == (0, 10)
+    assert result.next_cursor is None
+
+
+@pytest.mark.parametrize(
+    "strategy, fetched, expected_size, queries",
+    [
+        (CountStrategy.exact, [(7,)], 7, ["COUNT(*)"]),
+        (CountStrategy.estimated, [(7000,)], 7000, ["reltuples"]),
+        # never analyzed, falls back to counting
+        (CountStrategy.estimated, [(-1,), (7,)], 7, ["reltuples", "COUNT(*)"]),
+        (CountStrategy.counter, [(7,)], 7, ["row_counts"]),
+        (CountStrategy.counter, [(None,), (7,)], 7, ["row_counts", "COUNT(*)"]),
+        (CountStrategy.none, [], None, []),
+    ],
+)
+async def test_get_users_count_strategies(
+    mock_db_connection, strategy, fetched, expected_size, queries
+):
+    mock_cursor = AsyncMock()
+    mock_db_connection.cursor.return_value = mock_cursor
+    mock_cursor.fetchall.return_value = []
+    mock_cursor.fetchone.side_effect = fetched
+
+    result = await UserService(mock_db_connection).get_users(
+        offset=0, page_count=10, count=strategy
+    )
+
+    assert result.size == expected_size
+    executed = [
+        call.args[0].as_string(None) for call in mock_cursor.execute.call_args_list
+    ]
+    # the page query comes first
+    assert len(executed) == len(queries) + 1
+    for query, fragment in zip(executed[1:], queries):
+        assert fragment in query
+
+
+async def test_export_users_reads_batches_from_a_server_cursor(mock_db_connection):
+    server_cursor = AsyncMock()
+    server_cursor.__aenter__.return_value = server_cursor
+    row = expected_user.list_values()
+    server_cursor.fetchmany.side_effect = [[row, row], [row], []]
+    mock_db_connection.cursor.return_value = AsyncMock()
+    db = DatabaseSession(mock_db_connection, MagicMock())
+
+    with patch.object(db, "server_cursor", return_value=server_cursor) as named:
+        batches = [batch async for batch in UserService(db).export_users(itersize=2)]
+
+    named.assert_called_once_with("users_export")
+    server_cursor.fetchmany.assert_awaited_with(2)
+    assert batches == [[expected_user] * 2, [expected_user]]
+    server_cursor.__aexit__.assert_awaited_once()
+
+
+async def test_create_users_bulk_reports_duplicates_per_row(mock_db_connection):
+    mock_cursor = AsyncMock()
+    mock_db_connection.cursor.return_value = mock_cursor
+    copy = AsyncMock()
+    mock_cursor.copy = MagicMock()
+    mock_cursor.copy.return_value.__aenter__.return_value = copy
+    new_id, raced_id = uuid4(), uuid4()
+    mock_cursor.fetchall.side_effect = [
+        # already registered
+        [("taken@gmail.com",)],
+        # inserted, raced@gmail.com was registered by someone else meanwhile
+        [(new_id, "new@gmail.com")],
+    ]
+
+    def record(email):
+        return UserCreate(username=email, email=email, password="secret", full_name="")
+
+    with patch(
+        "services.user_service.get_password_hash", AsyncMock(return_value="hashed")
+    ) as hash_password, patch("services.user_service.queue_emails") as queue_emails:
+        result = await UserService(mock_db_connection).create_users_bulk(
+            [
+                record("new@gmail.com"),
+                record("taken@gmail.com"),
+                record("new@gmail.com"),
+                record("raced@gmail.com"),
+            ],
+        )
+
+    # only the users that could be created have their password hashed
+    assert hash_password.await_count == 2
+    assert [call.args[0][1] for call in copy.write_row.await_args_list] == [
+        "new@gmail.com",
+        "raced@gmail.com",
+    ]
+    mock_db_connection.commit.assert_awaited_once()
+
+    assert [user.id for user in result.users] == [new_id]
+    assert [(error.row, error.email) for error in result.errors] == [
+        (2, "taken@gmail.com"),
+        (3, "new@gmail.com"),
+        (4, "raced@gmail.com"),
+    ]
+    assert result.errors[1].detail == "Duplicate of row 1"
+
+    # queued in the chunk's transaction, the outbox sends them after commit
+    (db, emails), _ = queue_emails.await_args
+    assert db is mock_db_connection
+    assert [to for _, to, _ in emails] == ["new@gmail.com"]
+
+
+async def test_create_users_bulk_reports_a_failed_chunk(mock_db_connection):
+    mock_cursor = AsyncMock()
+    mock_db_connection.cursor.return_value = mock_cursor
+    mock_cursor.fetchall.side_effect = [[], []]
+    mock_cursor.copy = MagicMock(side_effect=psycopg.OperationalError("gone"))
+
+    with patch(
+        "services.user_service.get_password_hash", AsyncMock(return_value="hashed")
+    ), patch("services.user_service.queue_emails") as queue_emails:
+        result = await UserService(mock_db_connection).create_users_bulk(
+            [
+                UserCreate(
+                    username=str(index),
+                    email=f"user{index}@gmail.com",
+                    password="secret",
+                    full_name="",
+                )
+                for index in range(3)
+            ],
+            chunk_size=2,
+            rows=[2, 5, 9],
+        )
+
+    # both chunks failed, every record is reported under its own row
+    assert [error.row for error in result.errors] == [2, 5, 9]
+    assert result.users == []
+    assert mock_db_connection.rollback.await_count == 2
+    queue_emails.assert_not_called()
+
+
+def test_user_filter_conditions():
+    conditions, params = user_filter_conditions(
+        UserFilters(
+            search="50%_off",
+            email_domain="@Gmail.com",
+            disabled=False,
+            scopes=["users.list"],
+        )
+    )
+
+    assert [condition.as_string(None) for condition in conditions] == [
+        "(username ILIKE %s OR full_name ILIKE %s)",
+        "lower(split_part(email, '@', 2)) = %s",
+        "coalesce(disabled, FALSE) = %s",
+        "scopes @> %s::varchar[]",
+    ]
+    # LIKE wildcards typed by the client are matched literally
+    assert params == [
+        "%50\\%\\_off%",
+        "%50\\%\\_off%",
+        "gmail.com",
+        False,
+        ["users.list"],
+    ]
+
+    _, params = user_filter_conditions(
+        UserFilters(search="Solo", search_mode=SearchMode.prefix)
+    )
+    assert params == ["solo%", "solo%"]
+
+
+async def test_get_users_applies_filters_to_the_page_and_count(mock_db_connection):
+    mock_cursor = AsyncMock()
+    mock_db_connection.cursor.return_value = mock_cursor
+    mock_cursor.fetchall.return_value = []
+    mock_cursor.fetchone.return_value = ([{"Plan": {"Plan Rows": 42}}],)
+    after = (datetime(2024, 2, 1), uuid4())
+
+    result = await UserService(mock_db_connection).get_users(
+        offset=0,
+        page_count=10,
+        after=after,
+        count=CountStrategy.estimated,
+        filters=UserFilters(email_verified=True),
+    )
+
+    (page_query, page_params), (count_query, count_params) = [
+        (call.args[0].as_string(None), call.args[1])
+        for call in mock_cursor.execute.call_args_list
+    ]
+    assert "(date_created, id) > (%s, %s) AND coalesce(email_verified" in page_query
+    assert page_params == (*after, True, 10)
+    # filtered totals come from the plan, the table statistics don't apply
+    assert count_query.startswith("EXPLAIN (FORMAT JSON) SELECT 1 FROM users WHERE")
+    assert count_params == [True]
+    assert result.size == 42
+
+
+async def test_get_users_reads_only_the_requested_fields(mock_db_connection):
+    mock_cursor = AsyncMock()
+    mock_db_connection.cursor.return_value = mock_cursor
+    mock_cursor.fetchall.return_value = [
+        ("solomon@gmail.com", expected_user.id, datetime(2024, 3, 1), None)
+    ]
+    mock_cursor.fetchone.return_value = (1,)
+
+    result = await UserService(mock_db_connection).get_users(
+        offset=0, page_count=1, fields=["username"]
+    )
+
+    query = mock_cursor.execute.call_args_list[0].args[0].as_string(None)
+    assert query.startswith("SELECT username, id, date_created, ")
+    assert result.users[0].model_dump(include={"username"}) == {
+        "username": "solomon@gmail.com"
+    }
+    assert decode_cursor(result.next_cursor)[1] == expected_user.id
+
+
+async def test_get_users_answers_not_modified_for_a_known_version(
+    mock_db_connection,
+):
+    mock_cursor = AsyncMock()
+    mock_db_connection.cursor.return_value = mock_cursor
+    date_created = datetime(2024, 3, 1)
+    row = expected_user.list_values() + [date_created, date_created]
+    mock_cursor.fetchall.return_value = [row]
+    mock_cursor.fetchone.return_value = (1,)
+    service = UserService(mock_db_connection)
+
+    page = await service.get_users(offset=0, page_count=10)
+    assert page._version
+
+    with patch("services.user_service.USER_OUT_ROWS.many") as many:
+        unchanged = await service.get_users(
+            offset=0, page_count=10, known_versions={page._version}
+        )
+        # a modified user is a new version
+        mock_cursor.fetchall.return_value = [row[:-1] + [datetime(2024, 3, 2)]]
+        changed = await service.get_users(
+            offset=0, page_count=10, known_versions={page._version}
+        )
+
+    assert isinstance(unchanged, NotModified)
+    assert unchanged.version == page._version
+    assert not isinstance(changed, NotModified)
+    # the unchanged page was never built
+    many.assert_called_once()
+
+
+async def test_create_users_success(mock_db_connection):
     mock_db_connection.reset_mock()
     # Mock the token generation function
     with patch("secrets.token_hex", return_value="A_CONFIRM_TOKEN"):
 
         # Ensure you are importing the function from the UserService file,
         # this would have been imported already in that class/module
-        with patch("services.user_service.send_email") as mock_send_mail:
+        with patch("services.user_service.queue_email") as mock_queue_email:
             # Mock the database cursor
-            mock_cursor = MagicMock()
+            mock_cursor = AsyncMock()
             mock_db_connection.cursor.return_value = mock_cursor
 
             mock_cursor.fetchone.return_value = (str(expected_user.id),)
@@ -82,10 +381,11 @@ def test_create_users_success(mock_db_connection):
             mock_db_connection.cursor.assert_called_once()
 
             # Call the method under test
-            result = user_service.create_user(
+            result = await user_service.create_user(
                 UserCreate(
                     **{**expected_user.model_dump(), "password": "secret"},
-                )
+                ),
+                "hashed",
             )
 
             # # Assertions
@@ -98,30 +398,31 @@ def test_create_users_success(mock_db_connection):
             mock_db_connection.commit.assert_called()
             # ensure the last inserted id was gotten
             mock_cursor.fetchone.assert_called_once()
-            mock_send_mail.assert_called_once()
+            mock_queue_email.assert_called_once()
 
 
-def test_create_user_with_duplicate_email_fails(mock_db_connection):
+async def test_create_user_with_duplicate_email_fails(mock_db_connection):
     mock_db_connection.reset_mock()
     # Mock the token generation function
     with patch("secrets.token_hex", return_value="A_CONFIRM_TOKEN"):
 
         # Ensure you are importing the function from the UserService file,
         # this would have been imported already in that class/module
-        with patch("services.user_service.send_email") as mock_send_mail:
+        with patch("services.user_service.queue_email") as mock_queue_email:
             # Mock the database cursor
-            mock_cursor = MagicMock()
+            mock_cursor = AsyncMock()
             mock_db_connection.cursor.return_value = mock_cursor
-            mock_db_connection.commit.side_effect = psycopg2.IntegrityError("duplicate")
+            mock_db_connection.commit.side_effect = psycopg.IntegrityError("duplicate")
 
             user_service = UserService(mock_db_connection)
             mock_db_connection.cursor.assert_called_once()
 
             # Call the method under test
-            result = user_service.create_user(
+            result = await user_service.create_user(
                 UserCreate(
                     **{**expected_user.model_dump(), "password": "secret"},
-                )
+                ),
+                "hashed",
             )
 
             # # Assertions
@@ -130,19 +431,20 @@ def test_create_user_with_duplicate_email_fails(mock_db_connection):
             # # Ensure the database cursor and connection were used correctly
             mock_db_connection.commit.assert_called()
             mock_cursor.fetchone.assert_not_called()
-            mock_send_mail.assert_not_called()
+            # the email was queued in the transaction that got rolled back
+            mock_db_connection.rollback.assert_called_once()
 
 
-def test_get_user(mock_db_connection):
+async def test_get_user(mock_db_connection):
     mock_db_connection.reset_mock()
 
-    mock_cursor = MagicMock()
+    mock_cursor = AsyncMock()
     mock_db_connection.cursor.return_value = mock_cursor
     mock_cursor.fetchone.return_value = expected_user.list_values(mode="json")
     mock_cursor.rowcount.return_value = 1
 
     user_service = UserService(mock_db_connection)
-    user = user_service.get_user(expected_user.email)
+    user = await user_service.get_user(expected_user.email)
     assert isinstance(user, UserFromDB)
     assert user.email == expected_user.email
     assert user.full_name == expected_user.full_name
@@ -153,10 +455,10 @@ def test_get_user(mock_db_connection):
     mock_cursor.execute.assert_called_once()
 
 
-def test_get_user_with_non_existing_email_fails(mock_db_connection):
+async def test_get_user_with_non_existing_email_fails(mock_db_connection):
     mock_db_connection.reset_mock()
 
-    mock_cursor = MagicMock()
+    mock_cursor = AsyncMock()
     mock_db_connection.cursor.return_value = mock_cursor
     mock_cursor.fetchone.return_value = ()
     mock_cursor.rowcount.return_value = 0
@@ -164,7 +466,7 @@ def test_get_user_with_non_existing_email_fails(mock_db_connection):
     user_service = UserService(mock_db_connection)
     mock_db_connection.cursor.assert_called_once()
 
-    exception = user_service.get_user(expected_user.email)
+    exception = await user_service.get_user(expected_user.email)
     assert isinstance(exception, ResourceNotFoundException)
 
     # Assertions
@@ -173,12 +475,13 @@ def test_get_user_with_non_existing_email_fails(mock_db_connection):
     mock_cursor.execute.assert_called_once()
 
 
-def test_confirm_user_email_is_successful(mock_db_connection):
+async def test_confirm_user_email_is_successful(mock_db_connection):
     mock_db_connection.reset_mock()
 
-    mock_cursor = MagicMock()
+    mock_cursor = AsyncMock()
 
     mock_cursor.rowcount = 1
+    mock_cursor.fetchone.return_value = (expected_user.email,)
     mock_db_connection.cursor.return_value = mock_cursor
 
     user_service = UserService(mock_db_connection)
@@ -186,7 +489,7 @@ def test_confirm_user_email_is_successful(mock_db_connection):
 
     # Mock the token generation function
     with patch("secrets.token_hex", return_value="A_CONFIRM_TOKEN"):
-        user = user_service.confirm_email("A_CONFIRM_TOKEN")
+        user = await user_service.confirm_email("A_CONFIRM_TOKEN")
         assert isinstance(user, User)
 
     # Assertions
@@ -194,10 +497,12 @@ def test_confirm_user_email_is_successful(mock_db_connection):
     mock_cursor.execute.assert_called_once()
 
 
-def test_confirm_email_with_non_existing_confirmation_code_fails(mock_db_connection):
+async def test_confirm_email_with_non_existing_confirmation_code_fails(
+    mock_db_connection,
+):
     mock_db_connection.reset_mock()
 
-    mock_cursor = MagicMock()
+    mock_cursor = AsyncMock()
 
     mock_cursor.rowcount = 0
     mock_db_connection.cursor.return_value = mock_cursor
@@ -207,7 +512,7 @@ def test_confirm_email_with_non_existing_confirmation_code_fails(mock_db_connect
 
     # Mock the token generation function
     with patch("secrets.token_hex", return_value="A_CONFIRM_TOKEN"):
-        user = user_service.confirm_email("A_CONFIRM_TOKEN")
+        user = await user_service.confirm_email("A_CONFIRM_TOKEN")
         assert isinstance(user, BadReqeustException)
 
     # Assertions
@@ -216,11 +521,11 @@ def test_confirm_email_with_non_existing_confirmation_code_fails(mock_db_connect
     mock_cursor.execute.assert_called_once()
 
 
-def test_request_password_reset_passes(mock_db_connection):
+async def test_request_password_reset_passes(mock_db_connection):
 
     mock_db_connection.reset_mock()
 
-    mock_cursor = MagicMock()
+    mock_cursor = AsyncMock()
 
     mock_cursor.rowcount = 1
     mock_db_connection.cursor.return_value = mock_cursor
@@ -228,12 +533,12 @@ def test_request_password_reset_passes(mock_db_connection):
     user_service = UserService(mock_db_connection)
     mock_db_connection.cursor.assert_called_once()
 
-    with patch("services.user_service.send_email") as mock_send_mail:
+    with patch("services.user_service.queue_email") as mock_queue_email:
         # Mock the token generation function
         with patch("secrets.choice", return_value="A"):
-            user = user_service.request_password_reset(expected_user.email)
+            user = await user_service.request_password_reset(expected_user.email)
             assert isinstance(user, PasswordResetToken)
-            mock_send_mail.assert_called_once()
+            mock_queue_email.assert_called_once()
 
     # Assertions
     mock_db_connection.cursor.assert_called_once()
@@ -241,11 +546,11 @@ def test_request_password_reset_passes(mock_db_connection):
     mock_cursor.execute.assert_called_once()
 
 
-def test_request_password_reset_with_invalid_email_fails(mock_db_connection):
+async def test_request_password_reset_with_invalid_email_fails(mock_db_connection):
 
     mock_db_connection.reset_mock()
 
-    mock_cursor = MagicMock()
+    mock_cursor = AsyncMock()
 
     mock_cursor.rowcount = 0
     mock_db_connection.cursor.return_value = mock_cursor
@@ -253,12 +558,12 @@ def test_request_password_reset_with_invalid_email_fails(mock_db_connection):
     user_service = UserService(mock_db_connection)
     mock_db_connection.cursor.assert_called_once()
 
-    with patch("services.user_service.send_email") as mock_send_mail:
+    with patch("services.user_service.queue_email") as mock_queue_email:
         # Mock the token generation function
         with patch("secrets.choice", return_value="A"):
-            user = user_service.request_password_reset(expected_user.email)
+            user = await user_service.request_password_reset(expected_user.email)
             assert isinstance(user, ResourceNotFoundException)
-            mock_send_mail.assert_not_called()
+            mock_queue_email.assert_not_called()
 
     # Assertions
     mock_db_connection.cursor.assert_called_once()
@@ -266,10 +571,10 @@ def test_request_password_reset_with_invalid_email_fails(mock_db_connection):
     mock_db_connection.commit.assert_not_called()
 
 
-def test_reset_password_passes(mock_db_connection):
+async def test_reset_password_passes(mock_db_connection):
 
     mock_db_connection.reset_mock()
-    mock_cursor = MagicMock()
+    mock_cursor = AsyncMock()
 
     mock_cursor.rowcount = 1
     mock_db_connection.cursor.return_value = mock_cursor
@@ -278,8 +583,8 @@ def test_reset_password_passes(mock_db_connection):
     user_service = UserService(mock_db_connection)
     mock_db_connection.cursor.assert_called_once()
 
-    user = user_service.reset_password(
-        "SOMETHING_rANDOM", new_password="new_password_yah!"
+    user = await user_service.reset_password(
+        "SOMETHING_rANDOM", hashed_password="hashed"
     )
 
     # Assertions
@@ -288,9 +593,28 @@ def test_reset_password_passes(mock_db_connection):
     assert mock_cursor.execute.call_count == 2
 
 
-def test_reset_password_with_invalid_fails(mock_db_connection):
+async def test_reset_password_invalidates_the_cached_principal(mock_db_connection):
+    mock_db_connection.reset_mock()
+    mock_cursor = AsyncMock()
+
+    mock_cursor.rowcount = 1
+    mock_db_connection.cursor.return_value = mock_cursor
+    mock_cursor.fetchone.return_value = (expected_user.email,)
+
+    user_service = UserService(mock_db_connection)
+    with patch("services.user_service.invalidate_principal") as mock_invalidate:
+        await user_service.reset_password("SOMETHING_rANDOM", hashed_password="hashed")
+
+    mock_invalidate.assert_called_once_with(expected_user.email)
+    # the other workers hear about it once the change is committed
+    mock_db_connection.notify_on_commit.assert_called_once()
+    channel, payload = mock_db_connection.notify_on_commit.call_args.args
+    assert expected_user.email in payload
+
+
+async def test_reset_password_with_invalid_fails(mock_db_connection):
     mock_db_connection.reset_mock()
-    mock_cursor = MagicMock()
+    mock_cursor = AsyncMock()
 
     mock_cursor.rowcount = 0
     mock_db_connection.cursor.return_value = mock_cursor
@@ -299,8 +623,8 @@ def test_reset_password_with_invalid_fails(mock_db_connection):
     user_service = UserService(mock_db_connection)
     mock_db_connection.cursor.assert_called_once()
 
-    user = user_service.reset_password(
-        "SOMETHING_rANDOM", new_password="new_password_yah!"
+    user = await user_service.reset_password(
+        "SOMETHING_rANDOM", hashed_password="hashed"
     )
 
     # Assertions
@@ -0,0 +1,108 @@
+"""UserService against a real, migrated database, see the db fixture."""
+
+import os
+
+import pytest
+
+from schemas.user import UserCreate, UserFromDB
+from services.user_service import UserService
+from utils.errors import DuplicateResourceException
+from utils.pagination import CountStrategy, decode_cursor
+
+os.environ["TESTING"] = "True"
+
+pytestmark = pytest.mark.anyio
+
+
+def new_user(email: str = "solomon@gmail.com") -> UserCreate:
+    return UserCreate(
+        username=email, email=email, full_name="Solomon", password="secret"
+    )
+
+
+async def fetch_all(db, query, params=None):
+    cursor = await db.connection.execute(query, params)
+    return await cursor.fetchall()
+
+
+async def test_signup_stores_the_user_and_queues_its_confirmation(db):
+    service = UserService(db)
+
+    created = await service.create_user(new_user(), "hashed")
+    duplicate = await service.create_user(new_user(), "hashed")
+
+    assert isinstance(duplicate, DuplicateResourceException)
+    user = await service.get_user("solomon@gmail.com")
+    assert isinstance(user, UserFromDB)
+    assert user.username == created.username and user.email_verified is False
+    # the rolled back duplicate queued nothing
+    assert await fetch_all(db, "SELECT to_email, status FROM email_outbox") == [
+        ("solomon@gmail.com", "pending")
+    ]
+
+
+async def test_imported_users_queue_their_confirmations_with_them(db):
+    service = UserService(db)
+    await service.create_user(new_user("taken@gmail.com"), "hashed")
+
+    result = await service.create_users_bulk(
+        [new_user("taken@gmail.com"), new_user("a@gmail.com"), new_user("b@gmail.com")],
+        chunk_size=2,
+    )
+
+    assert [error.row for error in result.errors] == [1]
+    assert await fetch_all(
+        db, "SELECT to_email FROM email_outbox ORDER BY to_email"
+    ) == [("a@gmail.com",), ("b@gmail.com",), ("taken@gmail.com",)]
+
+
+async def test_confirmation_tokens_verify_the_email(db):
+    service = UserService(db)
+    await service.create_user(new_user(), "hashed")
+    ((token,),) = await fetch_all(db, "SELECT confirmation_token FROM users")
+
+    await service.confirm_email(token)
+
+    assert (await service.get_user("solomon@gmail.com")).email_verified is True
+
+
+async def test_pages_follow_the_cursor_and_count_strategies_agree(db):
+    await db.connection.execute(
+        "INSERT INTO users (username, email, hashed_password, date_created) "
+        "SELECT 'user' || n, 'user' || n || '@example.com', 'hash', "
+        "NOW() - n * INTERVAL '1 minute' FROM generate_series(1, 25) AS n"
+    )
+    await db.commit()
+    service = UserService(db)
+
+    emails, after = [], None
+    while True:
+        page = await service.get_users(offset=0, page_count=10, after=after)
+        emails.extend(user.email for user in page.users)
+        if page.next_cursor is None:
+            break
+        after = decode_cursor(page.next_cursor)
+
+    assert emails == [f"user{n}@example.com" for n in range(25, 0, -1)]
+    for strategy in (CountStrategy.exact, CountStrategy.counter):
+        page = await service.get_users(offset=0, page_count=10, count=strategy)
+        assert page.size == 25
+
+
+async def test_the_counter_is_spread_over_slots_that_add_up(db):
+    for n in range(40):
+        await db.connection.execute(
+            "INSERT INTO users (username, email, hashed_password) "
+            "VALUES (%s, %s, 'hash')",
+            (f"user{n}", f"user{n}@example.com"),
+        )
+    await db.connection.execute("DELETE FROM users WHERE username LIKE 'user1%'")
+    await db.commit()
+
+    page = await UserService(db).get_users(
+        offset=0, page_count=10, count=CountStrategy.counter
+    )
+
+    assert page.size == 29
+    # signups add to different rows instead of all waiting on one
+    assert len(await fetch_all(db, "SELECT slot FROM row_counts")) > 1
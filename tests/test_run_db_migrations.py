@@ -0,0 +1,282 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from uuid import uuid4
+
+import psycopg
+from psycopg import sql
+from psycopg.conninfo import make_conninfo
+import pytest
+
+import run_db_migrations
+from run_db_migrations import parse_directives, run_migrations, split_statements
+from utils.errors import InvalidMigrationScript
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+needs_database = pytest.mark.skipif(
+    not TEST_DATABASE_URL, reason="needs TEST_DATABASE_URL"
+)
+
+# none of these are idempotent, running one twice fails
+MIGRATIONS = {
+    "001_create_items.sql": "CREATE TABLE items (id INTEGER PRIMARY KEY);",
+    "002_seed_items.sql": "INSERT INTO items VALUES (1), (2);",
+}
+
+
+@pytest.fixture
+def schema_url():
+    """A connection string whose tables live in a scratch schema."""
+
+    schema = f"migrations_{uuid4().hex[:8]}"
+    with psycopg.connect(TEST_DATABASE_URL, autocommit=True) as conn:
+        conn.execute(sql.SQL("CREATE SCHEMA {}").format(sql.Identifier(schema)))
+    try:
+        yield make_conninfo(TEST_DATABASE_URL, options=f"-c search_path={schema}")
+    finally:
+        with psycopg.connect(TEST_DATABASE_URL, autocommit=True) as conn:
+            conn.execute(
+                sql.SQL("DROP SCHEMA {} CASCADE").format(sql.Identifier(schema))
+            )
+
+
+def write_migrations(directory, migrations):
+    for filename, script in migrations.items():
+        (directory / filename).write_text(script)
+
+
+def query(url, statement):
+    with psycopg.connect(url) as conn:
+        return conn.execute(statement).fetchall()
+
+
+def test_directives_are_read_from_comment_lines():
+    directives = parse_directives(
+        "010_backfill.sql",
+        "-- migrate:backfill 500\n-- migrate:lock-timeout 2s\n"
+        "-- migrate:retries 5\nUPDATE users SET x = 1",
+    )
+
+    assert directives.transaction is False
+    assert directives.batch_size == 500
+    assert directives.lock_timeout == "2s"
+    assert directives.retries == 5
+    assert parse_directives("001.sql", "CREATE TABLE t ()").transaction is True
+    with pytest.raises(InvalidMigrationScript, match="migrate:no-such-thing"):
+        parse_directives("010.sql", "-- migrate:no-such-thing\nSELECT 1")
+
+
+def test_statements_are_split_outside_quotes_and_bodies():
+    script = """-- migrate:no-transaction
+CREATE INDEX CONCURRENTLY IF NOT EXISTS items_id_idx ON items (id);
+CREATE FUNCTION f() RETURNS TRIGGER AS $body$ BEGIN NEW.x = ';'; RETURN NEW; END $body$
+    LANGUAGE plpgsql;
+SELECT 'it''s; one statement';
+/* a block comment;
+   over two lines; */
+SELECT /* inline; */ 1;
+-- trailing comment;
+"""
+
+    assert split_statements(script) == [
+        "-- migrate:no-transaction\n"
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS items_id_idx ON items (id)",
+        "CREATE FUNCTION f() RETURNS TRIGGER AS $body$ BEGIN NEW.x = ';'; "
+        "RETURN NEW; END $body$\n    LANGUAGE plpgsql",
+        "SELECT 'it''s; one statement'",
+        "/* a block comment;\n   over two lines; */\nSELECT /* inline; */ 1",
+    ]
+
+
+@needs_database
+def test_only_pending_scripts_run(tmp_path, schema_url):
+    write_migrations(tmp_path, MIGRATIONS)
+
+    assert run_migrations(tmp_path, schema_url) == list(MIGRATIONS)
+    assert run_migrations(tmp_path, schema_url) == []
+
+    write_migrations(
+        tmp_path, {"003_seed_more_items.sql": "INSERT INTO items VALUES (3);"}
+    )
+    assert run_migrations(tmp_path, schema_url) == ["003_seed_more_items.sql"]
+    assert query(schema_url, "SELECT COUNT(*) FROM items") == [(3,)]
+    assert query(schema_url, "SELECT version FROM schema_migrations ORDER BY 1") == [
+        (1,),
+        (2,),
+        (3,),
+    ]
+
+
+@needs_database
+def test_modified_applied_scripts_are_refused(tmp_path, schema_url):
+    write_migrations(tmp_path, MIGRATIONS)
+    run_migrations(tmp_path, schema_url)
+
+    write_migrations(
+        tmp_path,
+        {
+            "002_seed_items.sql": "INSERT INTO items VALUES (1), (2), (5);",
+            "003_seed_more_items.sql": "INSERT INTO items VALUES (3);",
+        },
+    )
+    with pytest.raises(InvalidMigrationScript, match="002_seed_items.sql"):
+        run_migrations(tmp_path, schema_url)
+    # nothing ran, not even the new script
+    assert query(schema_url, "SELECT COUNT(*) FROM items") == [(2,)]
+
+
+@needs_database
+def test_a_failing_script_is_rolled_back_alone(tmp_path, schema_url):
+    write_migrations(
+        tmp_path,
+        {
+            **MIGRATIONS,
+            "003_broken.sql": "INSERT INTO items VALUES (3); INSERT INTO items VALUES (1);",
+            "004_seed_more_items.sql": "INSERT INTO items VALUES (4);",
+        },
+    )
+
+    with pytest.raises(InvalidMigrationScript, match="003_broken.sql"):
+        run_migrations(tmp_path, schema_url)
+
+    assert query(schema_url, "SELECT id FROM items ORDER BY id") == [(1,), (2,)]
+    assert query(schema_url, "SELECT COUNT(*) FROM schema_migrations") == [(2,)]
+
+
+@needs_database
+def test_concurrent_runners_apply_each_script_once(tmp_path, schema_url):
+    write_migrations(tmp_path, MIGRATIONS)
+
+    with ThreadPoolExecutor(4) as executor:
+        runs = list(
+            executor.map(lambda _: run_migrations(tmp_path, schema_url), range(4))
+        )
+
+    assert sorted(runs, key=len) == [[], [], [], list(MIGRATIONS)]
+    assert query(schema_url, "SELECT COUNT(*) FROM items") == [(2,)]
+
+
+@needs_database
+def test_online_migrations_index_concurrently_and_backfill_in_batches(
+    tmp_path, schema_url
+):
+    write_migrations(
+        tmp_path,
+        {
+            # every UPDATE of items records how many rows it changed
+            "001_create_items.sql": "CREATE TABLE items (id INTEGER PRIMARY KEY); "
+            "INSERT INTO items SELECT generate_series(1, 1000); "
+            "CREATE TABLE batches (id SERIAL PRIMARY KEY, rows INTEGER); "
+            "CREATE FUNCTION count_batch() RETURNS trigger LANGUAGE plpgsql AS $$ "
+            "BEGIN INSERT INTO batches (rows) SELECT COUNT(*) FROM updated; "
+            "RETURN NULL; END $$; "
+            "CREATE TRIGGER items_batches AFTER UPDATE ON items "
+            "REFERENCING NEW TABLE AS updated FOR EACH STATEMENT "
+            "EXECUTE FUNCTION count_batch();",
+            "002_backfill_labels.sql": "-- migrate:backfill 300\n"
+            "ALTER TABLE items ADD COLUMN IF NOT EXISTS label TEXT;\n"
+            "SET application_name = 'backfill';\n"
+            "UPDATE items SET label = 'item ' || id WHERE id IN "
+            "(SELECT id FROM items WHERE label IS NULL LIMIT %(batch_size)s);",
+            "003_index_labels.sql": "-- migrate:no-transaction\n"
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS items_label_idx ON items (label);",
+        },
+    )
+
+    assert len(run_migrations(tmp_path, schema_url)) == 3
+
+    assert query(schema_url, "SELECT COUNT(*) FROM items WHERE label IS NULL") == [(0,)]
+    # the ADD COLUMN and SET ran once, the UPDATE until it changed nothing
+    assert query(schema_url, "SELECT rows FROM batches ORDER BY id") == [
+        (300,),
+        (300,),
+        (300,),
+        (100,),
+        (0,),
+    ]
+    assert query(
+        schema_url,
+        "SELECT indisvalid FROM pg_index WHERE indexrelid = 'items_label_idx'::regclass",
+    ) == [(True,)]
+
+
+@needs_database
+def test_lock_timeouts_are_retried(tmp_path, schema_url, monkeypatch):
+    monkeypatch.setattr(run_db_migrations, "LOCK_RETRY_DELAY", 0.1)
+    write_migrations(
+        tmp_path, {"001_create_items.sql": MIGRATIONS["001_create_items.sql"]}
+    )
+    run_migrations(tmp_path, schema_url)
+    write_migrations(
+        tmp_path,
+        {
+            "002_add_label.sql": "-- migrate:lock-timeout 50ms\n-- migrate:retries 4\n"
+            "ALTER TABLE items ADD COLUMN label TEXT;"
+        },
+    )
+
+    with psycopg.connect(schema_url) as blocker:
+        blocker.execute("LOCK TABLE items IN ACCESS SHARE MODE")
+        # the migration waits at most 50ms a time, the blocker goes after 0.4s
+        threading.Timer(0.4, blocker.rollback).start()
+        started = time.perf_counter()
+        assert run_migrations(tmp_path, schema_url) == ["002_add_label.sql"]
+        assert time.perf_counter() - started >= 0.4
+
+
+@needs_database
+def test_lock_timeouts_give_up_after_the_retries(tmp_path, schema_url, monkeypatch):
+    monkeypatch.setattr(run_db_migrations, "LOCK_RETRY_DELAY", 0.01)
+    write_migrations(
+        tmp_path, {"001_create_items.sql": MIGRATIONS["001_create_items.sql"]}
+    )
+    run_migrations(tmp_path, schema_url)
+    write_migrations(
+        tmp_path,
+        {
+            "002_add_label.sql": "-- migrate:lock-timeout 20ms\n-- migrate:retries 2\n"
+            "ALTER TABLE items ADD COLUMN label TEXT;"
+        },
+    )
+
+    with psycopg.connect(schema_url) as blocker:
+        blocker.execute("LOCK TABLE items IN ACCESS SHARE MODE")
+        with pytest.raises(InvalidMigrationScript, match="lock timeout"):
+            run_migrations(tmp_path, schema_url)
+    assert query(schema_url, "SELECT COUNT(*) FROM schema_migrations") == [(1,)]
+
+
+@needs_database
+def test_an_index_left_invalid_is_built_again(tmp_path, schema_url):
+    write_migrations(
+        tmp_path,
+        {
+            "001_create_items.sql": "CREATE TABLE items (id INTEGER PRIMARY KEY, "
+            "label TEXT); INSERT INTO items VALUES (1, 'a'), (2, 'a');"
+        },
+    )
+    run_migrations(tmp_path, schema_url)
+    # a concurrent build that failed half way, as a timed out one would
+    with psycopg.connect(schema_url, autocommit=True) as conn:
+        with pytest.raises(psycopg.errors.UniqueViolation):
+            conn.execute(
+                "CREATE UNIQUE INDEX CONCURRENTLY items_label_idx ON items (label)"
+            )
+        conn.execute("UPDATE items SET label = 'b' WHERE id = 2")
+    write_migrations(
+        tmp_path,
+        {
+            "002_index_labels.sql": "-- migrate:no-transaction\n"
+            "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS items_label_idx "
+            "ON items (label);"
+        },
+    )
+
+    assert run_migrations(tmp_path, schema_url) == ["002_index_labels.sql"]
+
+    assert query(
+        schema_url,
+        "SELECT indisvalid FROM pg_index WHERE indexrelid = 'items_label_idx'::regclass",
+    ) == [(True,)]
@@ -0,0 +1,41 @@
+from unittest.mock import patch
+
+from utils.cache import TTLCache
+
+
+def test_entries_expire_after_the_ttl():
+    cache = TTLCache(max_size=10, ttl=30)
+    with patch("time.monotonic", return_value=100.0):
+        cache.set("solomon@gmail.com", "principal")
+        assert cache.get("solomon@gmail.com") == "principal"
+
+    with patch("time.monotonic", return_value=130.0):
+        assert cache.get("solomon@gmail.com") is None
+
+    assert len(cache) == 0
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(max_size=2, ttl=30)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # reading "a" makes "b" the least recently used one
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_invalidate_drops_the_entry():
+    cache = TTLCache(max_size=2, ttl=30)
+    cache.set("a", 1)
+    cache.invalidate("a")
+    cache.invalidate("missing")
+
+    assert cache.get("a") is None
+    assert cache.stats()["invalidations"] == 1
@@ -0,0 +1,33 @@
+from starlette.requests import Request
+
+from utils.conditional import etag, known_versions, matches, not_modified, version_of
+
+
+def make_request(if_none_match: str) -> Request:
+    headers = [(b"if-none-match", if_none_match.encode())]
+    return Request({"type": "http", "path": "/users/", "headers": headers})
+
+
+def test_versions_change_with_any_part():
+    assert version_of(["a", 1]) == version_of(["a", 1])
+    assert version_of(["a", 1]) != version_of(["a", 2])
+    # parts are delimited, they can't run into each other
+    assert version_of(["ab", "c"]) != version_of(["a", "bc"])
+
+
+def test_if_none_match_is_compared_weakly():
+    known = known_versions(make_request(f'"other", {etag("abc")}'))
+
+    assert known == {"other", "abc"}
+    assert matches("abc", known)
+    assert not matches("abd", known)
+    assert matches("abd", known_versions(make_request("*")))
+
+
+def test_not_modified_response_keeps_the_etag():
+    response = not_modified("abc")
+
+    assert response.status_code == 304
+    assert response.body == b""
+    assert response.headers["etag"] == 'W/"abc"'
+    assert response.headers["cache-control"] == "private, no-cache"
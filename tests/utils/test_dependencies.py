@@ -0,0 +1,24 @@
+from fastapi import HTTPException
+import pytest
+
+from schemas.user import UserOut
+from utils.dependencies import sparse_fields
+
+fields_of_user = sparse_fields(UserOut)
+
+
+def test_sparse_fields_are_parsed_and_deduplicated():
+    assert fields_of_user(" id, username,id,") == ("id", "username")
+
+
+@pytest.mark.parametrize("fields", [None, "", " , "])
+def test_no_sparse_fields_means_every_field(fields):
+    assert fields_of_user(fields) is None
+
+
+def test_unknown_sparse_fields_are_a_bad_request():
+    with pytest.raises(HTTPException) as error:
+        fields_of_user("id,hashed_password")
+
+    assert error.value.status_code == 400
+    assert "hashed_password" in error.value.detail
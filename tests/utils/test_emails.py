@@ -0,0 +1,150 @@
+import smtplib
+from typing import List
+from unittest.mock import patch
+
+import pytest
+
+from utils.emails import SMTPPool, deliver
+from utils.metrics import EMAILS_SENT
+from utils.errors import EmailException
+
+
+class FakeSMTP:
+    """Records what a connection was asked to do, `alive` and `refused`
+    stand in for a dropped connection and a rejected recipient."""
+
+    connections: List["FakeSMTP"] = []
+    reachable = True
+
+    def __init__(self, host, port, timeout=None):
+        if not FakeSMTP.reachable:
+            raise ConnectionRefusedError("SMTP server unreachable")
+        self.logins = 0
+        self.sent: List[str] = []
+        self.alive = True
+        self.refused = set()
+        FakeSMTP.connections.append(self)
+
+    def starttls(self):
+        pass
+
+    def login(self, address, password):
+        self.logins += 1
+
+    def noop(self):
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        return 250, b"OK"
+
+    def sendmail(self, sender, to_email, message):
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        if to_email in self.refused:
+            raise smtplib.SMTPRecipientsRefused({to_email: (550, b"No such user")})
+        self.sent.append(to_email)
+
+    def quit(self):
+        self.alive = False
+
+    def close(self):
+        self.alive = False
+
+
+@pytest.fixture(autouse=True)
+def fake_smtp():
+    FakeSMTP.connections = []
+    FakeSMTP.reachable = True
+    with patch("utils.emails.smtplib.SMTP", FakeSMTP):
+        yield
+
+
+def make_pool(**kwargs) -> SMTPPool:
+    options = dict(
+        host="smtp.example.com",
+        port=587,
+        address="app@example.com",
+        password="secret",
+        starttls=True,
+        timeout=1,
+        max_size=2,
+        health_check_after=30,
+    )
+    return SMTPPool(**{**options, **kwargs})
+
+
+def messages(*emails: str):
+    return [("Subject", email, "Body") for email in emails]
+
+
+def test_batches_reuse_one_authenticated_connection():
+    pool = make_pool()
+
+    assert pool.deliver(messages("a@x.io", "b@x.io", "c@x.io")) == [None] * 3
+    assert pool.deliver(messages("d@x.io")) == [None]
+
+    (connection,) = FakeSMTP.connections
+    assert connection.logins == 1
+    assert connection.sent == ["a@x.io", "b@x.io", "c@x.io", "d@x.io"]
+    stats = pool.stats()
+    assert (stats["open"], stats["idle"], stats["connects"]) == (1, 1, 1)
+    assert stats["connections"][0]["messages"] == 4
+
+
+def test_idle_connections_are_checked_and_replaced_when_dropped():
+    pool = make_pool(health_check_after=0)
+    pool.deliver(messages("a@x.io"))
+    FakeSMTP.connections[0].alive = False
+
+    assert pool.deliver(messages("b@x.io")) == [None]
+
+    assert len(FakeSMTP.connections) == 2
+    assert FakeSMTP.connections[1].sent == ["b@x.io"]
+    stats = pool.stats()
+    assert (stats["open"], stats["health_checks"], stats["reconnects"]) == (1, 1, 1)
+
+
+def test_a_connection_dropped_mid_batch_is_reopened():
+    pool = make_pool()
+    pool.deliver(messages("a@x.io"))
+    FakeSMTP.connections[0].alive = False
+
+    assert pool.deliver(messages("b@x.io", "c@x.io")) == [None, None]
+
+    assert FakeSMTP.connections[1].sent == ["b@x.io", "c@x.io"]
+    assert pool.stats()["reconnects"] == 1
+
+
+def test_a_refused_recipient_only_fails_its_message():
+    pool = make_pool()
+    pool.deliver(messages("a@x.io"))
+    FakeSMTP.connections[0].refused.add("b@x.io")
+
+    first, refused, last = pool.deliver(messages("a@x.io", "b@x.io", "c@x.io"))
+
+    assert first is None and last is None
+    assert isinstance(refused, EmailException)
+    assert isinstance(refused.__cause__, smtplib.SMTPRecipientsRefused)
+    assert len(FakeSMTP.connections) == 1
+    assert pool.stats()["failures"] == 1
+
+
+def test_an_unreachable_server_fails_the_batch_and_frees_the_connection():
+    pool = make_pool(max_size=1)
+    FakeSMTP.reachable = False
+
+    failures = pool.deliver(messages("a@x.io", "b@x.io"))
+
+    assert [type(failure) for failure in failures] == [EmailException] * 2
+    assert isinstance(failures[0].__cause__, ConnectionRefusedError)
+    assert pool.stats()["failures"] == 2
+
+    FakeSMTP.reachable = True
+    assert pool.deliver(messages("a@x.io")) == [None]
+
+
+def test_outcomes_are_counted_when_testing_too(monkeypatch):
+    monkeypatch.setenv("TESTING", "True")
+    before = EMAILS_SENT.values[("sent",)]
+
+    assert deliver([("Subject", "solomon@gmail.com", "Body")] * 2) == [None, None]
+    assert EMAILS_SENT.values[("sent",)] == before + 2
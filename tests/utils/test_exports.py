@@ -0,0 +1,59 @@
+import csv
+import io
+import json
+from uuid import uuid4
+
+import pytest
+
+from schemas.user import USER_OUT_ROWS, UserOut
+from utils.exports import ExportFormat, encode_batches
+
+pytestmark = pytest.mark.anyio
+
+user = UserOut(
+    id=uuid4(),
+    username="solomon@gmail.com",
+    email="solomon@gmail.com",
+    full_name="Solomon",
+    disabled=False,
+    email_verified=True,
+    scopes=["users.list", "users.create"],
+)
+
+
+async def batches(*sizes):
+    for size in sizes:
+        yield [user] * size
+
+
+async def encode(export_format, *sizes):
+    return [
+        chunk
+        async for chunk in encode_batches(
+            batches(*sizes), export_format, USER_OUT_ROWS.fields
+        )
+    ]
+
+
+async def test_ndjson_writes_one_chunk_per_batch():
+    chunks = await encode(ExportFormat.ndjson, 2, 1)
+
+    assert len(chunks) == 2
+    lines = "".join(chunks).splitlines()
+    assert [UserOut.model_validate(json.loads(line)) for line in lines] == [user] * 3
+
+
+async def test_csv_writes_the_header_once():
+    chunks = await encode(ExportFormat.csv, 2, 1)
+
+    rows = list(csv.reader(io.StringIO("".join(chunks))))
+    assert rows[0] == list(USER_OUT_ROWS.fields)
+    assert len(rows) == 4
+    assert rows[1][rows[0].index("scopes")] == "users.list users.create"
+    assert rows[1][rows[0].index("id")] == str(user.id)
+
+
+async def test_empty_csv_export_still_has_a_header():
+    chunks = await encode(ExportFormat.csv)
+
+    assert chunks == [",".join(USER_OUT_ROWS.fields) + "\r\n"]
@@ -0,0 +1,43 @@
+from schemas.user import UserCreate
+from utils.imports import ImportFormat, parse_records
+
+
+def test_csv_records_are_numbered_and_invalid_ones_reported():
+    data = (
+        "username,email,password,full_name\n"
+        "solomon,solomon@gmail.com,secret,Solomon\n"
+        "broken,not-an-email,secret,Broken\n"
+        "aboyeji,aboyeji@gmail.com,secret,Aboyeji\n"
+    )
+
+    records, errors = parse_records(data, ImportFormat.csv, UserCreate)
+
+    assert [(row, user.email) for row, user in records] == [
+        (1, "solomon@gmail.com"),
+        (3, "aboyeji@gmail.com"),
+    ]
+    assert [(error.row, error.email) for error in errors] == [(2, "not-an-email")]
+    assert errors[0].detail.startswith("email:")
+
+
+def test_ndjson_skips_blank_lines_and_reports_invalid_json():
+    data = (
+        '{"username": "s", "email": "solomon@gmail.com", "password": "p", "full_name": "S"}\n'
+        "\n"
+        "{not json\n"
+        '{"username": "s", "email": "aboyeji@gmail.com"}\n'
+    )
+
+    records, errors = parse_records(data, ImportFormat.ndjson, UserCreate)
+
+    assert [row for row, _ in records] == [1]
+    assert [error.row for error in errors] == [2, 3]
+    assert errors[0].detail.startswith("Invalid JSON")
+    assert "password: Field required" in errors[1].detail
+
+
+def test_json_must_be_an_array():
+    records, errors = parse_records('{"email": "x"}', ImportFormat.json, UserCreate)
+
+    assert records == []
+    assert errors[0].detail == "Expected an array of users"
@@ -0,0 +1,171 @@
+import json
+import os
+import threading
+from unittest.mock import patch
+
+from fastapi.testclient import TestClient
+import pytest
+
+from utils.metrics import MetricsRegistry
+
+pytestmark = pytest.mark.anyio
+
+
+def registry(directory: str = "") -> MetricsRegistry:
+    metrics = MetricsRegistry(directory=directory)
+    metrics.counter("http_requests_total", "Requests.", ("route", "status"))
+    metrics.gauge("http_requests_in_progress", "In flight.")
+    metrics.histogram("db_query_duration_seconds", "Queries.", buckets=(0.01, 0.1))
+    return metrics
+
+
+def test_render_prometheus_text_format():
+    metrics = registry()
+    metrics.metrics["http_requests_total"].inc("/users/{user_id}", "200", amount=2)
+    metrics.metrics["http_requests_total"].inc('say "hi"\n', "404")
+    for seconds in (0.005, 0.05, 1.0):
+        metrics.metrics["db_query_duration_seconds"].observe(seconds)
+
+    assert metrics.render().splitlines() == [
+        "# HELP http_requests_total Requests.",
+        "# TYPE http_requests_total counter",
+        'http_requests_total{route="/users/{user_id}",status="200"} 2.0',
+        'http_requests_total{route="say \\"hi\\"\\n",status="404"} 1.0',
+        "# HELP http_requests_in_progress In flight.",
+        "# TYPE http_requests_in_progress gauge",
+        "# HELP db_query_duration_seconds Queries.",
+        "# TYPE db_query_duration_seconds histogram",
+        'db_query_duration_seconds_bucket{le="0.01"} 1',
+        'db_query_duration_seconds_bucket{le="0.1"} 2',
+        'db_query_duration_seconds_bucket{le="+Inf"} 3',
+        "db_query_duration_seconds_sum 1.055",
+        "db_query_duration_seconds_count 3",
+    ]
+
+
+def test_workers_are_added_up(tmp_path):
+    other = registry(str(tmp_path))
+    other.metrics["http_requests_total"].inc("/users", "200", amount=3)
+    other.metrics["http_requests_in_progress"].inc()
+    other.metrics["db_query_duration_seconds"].observe(0.05)
+    dump = other.dump()
+    # a worker that has exited since, its gauges no longer hold
+    dump["pid"] = 2**22 + 1
+    (tmp_path / "exited.json").write_text(json.dumps(dump))
+
+    metrics = registry(str(tmp_path))
+    metrics.metrics["http_requests_total"].inc("/users", "200")
+    metrics.metrics["http_requests_in_progress"].inc()
+    metrics.metrics["db_query_duration_seconds"].observe(0.5)
+    merged = metrics.merge(metrics.collect())
+
+    assert merged["http_requests_total"] == {("/users", "200"): 4.0}
+    assert merged["http_requests_in_progress"] == {(): 1.0}
+    assert merged["db_query_duration_seconds"] == {
+        (): {"counts": [0, 1, 1], "sum": 0.55}
+    }
+    assert sorted(path.name for path in tmp_path.glob("*.json")) == sorted(
+        ["exited.json", os.path.basename(metrics._path)]
+    )
+
+
+def exited_worker(directory, filename: str, requests: float) -> None:
+    worker = registry(str(directory))
+    worker.metrics["http_requests_total"].inc("/users", "200", amount=requests)
+    worker.metrics["http_requests_in_progress"].inc()
+    dump = worker.dump()
+    dump["pid"] = 2**22 + 1
+    (directory / filename).write_text(json.dumps(dump))
+
+
+def test_exited_workers_are_folded_into_one_file(tmp_path):
+    metrics = registry(str(tmp_path))
+    metrics.metrics["http_requests_total"].inc("/users", "200")
+    exited_worker(tmp_path, "first.json", 2)
+    exited_worker(tmp_path, "second.json", 4)
+    before = metrics.merge(metrics.collect())
+
+    metrics.compact()
+    exited_worker(tmp_path, "third.json", 8)
+    metrics.compact()
+    metrics.compact()
+
+    assert sorted(path.name for path in tmp_path.glob("*.json")) == sorted(
+        ["aggregate.json", os.path.basename(metrics._path)]
+    )
+    after = metrics.merge(metrics.collect())
+    assert before["http_requests_total"] == {("/users", "200"): 7.0}
+    assert after["http_requests_total"] == {("/users", "200"): 15.0}
+    assert after["http_requests_in_progress"] == {}
+
+
+def test_a_folded_file_left_behind_is_not_counted_twice(tmp_path):
+    metrics = registry(str(tmp_path))
+    exited_worker(tmp_path, "exited.json", 2)
+    metrics.compact()
+    # as if the compaction was interrupted before deleting it
+    exited_worker(tmp_path, "exited.json", 2)
+
+    merged = metrics.merge(metrics.collect())
+    metrics.compact()
+
+    assert merged["http_requests_total"] == {("/users", "200"): 2.0}
+    assert not (tmp_path / "exited.json").exists()
+
+
+async def test_flushes_on_stop(tmp_path):
+    metrics = registry(str(tmp_path))
+    metrics.start()
+    metrics.metrics["http_requests_total"].inc("/users", "200")
+    await metrics.stop()
+
+    (path,) = tmp_path.iterdir()
+    assert json.loads(path.read_text())["metrics"]["http_requests_total"] == [
+        [["/users", "200"], 1.0]
+    ]
+
+
+async def test_scrapes_read_the_files_off_the_event_loop(tmp_path):
+    metrics = registry(str(tmp_path))
+    metrics.metrics["http_requests_total"].inc("/users", "200")
+    threads = []
+    collect = metrics.collect
+
+    def record_thread(dump):
+        threads.append(threading.current_thread())
+        return collect(dump)
+
+    with patch.object(metrics, "collect", record_thread):
+        text = await metrics.scrape()
+
+    assert threads and threads[0] is not threading.current_thread()
+    assert 'http_requests_total{route="/users",status="200"} 1.0' in text
+
+
+def test_several_workers_without_a_directory_are_warned_about():
+    metrics = registry()
+    with patch("utils.metrics.logger") as mock_logger:
+        metrics.start()
+        mock_logger.warning.assert_not_called()
+        with patch("multiprocessing.parent_process", return_value=object()):
+            metrics.start()
+        mock_logger.warning.assert_called_once()
+
+
+def test_requests_are_labeled_by_route_template():
+    from main import app
+    from utils.metrics import HTTP_REQUESTS
+
+    with TestClient(app) as client:
+        before = dict(HTTP_REQUESTS.values)
+        client.get("/nowhere")
+        response = client.get("/metrics")
+
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert "# TYPE http_request_duration_seconds histogram" in response.text
+    counted = {
+        labels: value - before.get(labels, 0)
+        for labels, value in HTTP_REQUESTS.values.items()
+    }
+    assert counted[("GET", "unmatched", "404")] == 1
+    assert counted[("GET", "/metrics", "200")] == 1
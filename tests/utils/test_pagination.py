@@ -0,0 +1,24 @@
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+
+from utils.errors import BadReqeustException
+from utils.pagination import decode_cursor, encode_cursor
+
+
+def test_cursor_round_trips():
+    date_created, id = datetime(2024, 3, 1, 12, 30, 15, 123456), uuid4()
+
+    cursor = encode_cursor(date_created, id)
+
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == (date_created, id)
+
+
+@pytest.mark.parametrize(
+    "cursor", ["", "not-a-cursor", "W10", "WyJub3QgYSBkYXRlIiwiMSJd", "MTIz"]
+)
+def test_invalid_cursor_is_a_bad_request(cursor):
+    with pytest.raises(BadReqeustException):
+        decode_cursor(cursor)
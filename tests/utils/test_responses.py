@@ -0,0 +1,84 @@
+import json
+import time
+from uuid import uuid4
+
+from fastapi import APIRouter, FastAPI
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastapi.testclient import TestClient
+from pydantic import BaseModel, field_validator
+
+from schemas.user import ListUsers, UserOut
+from utils.responses import FastJSONResponse, TimedRoute
+from utils.timing import start_timing
+
+
+def make_page() -> ListUsers:
+    user = UserOut(
+        username="zoë",
+        email="zoe@example.com",
+        full_name="Zoë Ünal",
+        disabled=False,
+        scopes=["users.list"],
+        email_verified=True,
+        id=uuid4(),
+    )
+    return ListUsers(size=1, users=[user], next_cursor="abc")
+
+
+def test_fast_json_response_renders_the_same_document():
+    content = jsonable_encoder(make_page())
+
+    fast = FastJSONResponse(content)
+
+    assert json.loads(fast.body) == json.loads(JSONResponse(content).body)
+    assert fast.media_type == "application/json"
+    assert int(fast.headers["content-length"]) == len(fast.body)
+
+
+def test_fast_json_response_serializes_models_directly():
+    page = make_page()
+
+    response = FastJSONResponse(page, headers={"ETag": 'W/"v"'})
+
+    assert json.loads(response.body) == jsonable_encoder(page)
+    assert response.headers["etag"] == 'W/"v"'
+
+
+class SlowToValidate(BaseModel):
+    name: str
+
+    @field_validator("name")
+    @classmethod
+    def take_a_while(cls, name):
+        time.sleep(0.05)
+        return name
+
+
+def test_the_response_model_dump_is_timed_as_encode():
+    router = APIRouter(route_class=TimedRoute)
+
+    @router.get("/model", response_model=SlowToValidate)
+    async def model():
+        return {"name": "solomon"}
+
+    @router.get("/response")
+    def response():
+        return FastJSONResponse({"name": "solomon"})
+
+    app = FastAPI(default_response_class=FastJSONResponse)
+    app.include_router(router)
+    spans = {}
+
+    @app.middleware("http")
+    async def timed(request, call_next):
+        spans[request.url.path] = start_timing()
+        return await call_next(request)
+
+    with TestClient(app) as client:
+        assert client.get("/model").json() == {"name": "solomon"}
+        assert client.get("/response").json() == {"name": "solomon"}
+
+    seconds, count = spans["/model"]["encode"]
+    assert seconds >= 0.05 and count == 1
+    assert spans["/response"]["encode"][1] == 1
@@ -0,0 +1,142 @@
+import asyncio
+from contextlib import asynccontextmanager
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+from fastapi import HTTPException
+from fastapi.security import SecurityScopes
+import pytest
+
+from schemas.user import UserFromDB
+import utils.security
+from utils.scopes import UserScope
+from utils.security import (
+    PRINCIPAL_CACHE,
+    get_current_user,
+    get_password_hash,
+    invalidate_principal,
+    run_hashing,
+    verify_password,
+)
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def fresh_hashing_executor():
+    utils.security.shutdown_hashing_executor()
+    yield
+    utils.security.shutdown_hashing_executor()
+
+
+async def test_password_hashing_runs_off_the_event_loop():
+    event_loop_thread = threading.current_thread()
+    hashed = await get_password_hash("secret")
+
+    assert await verify_password("secret", hashed)
+    assert not await verify_password("not-the-secret", hashed)
+    assert await run_hashing(threading.current_thread) is not event_loop_thread
+
+
+async def test_password_hashing_concurrency_is_capped():
+    running = 0
+    most_running = 0
+    lock = threading.Lock()
+
+    def slow_hash():
+        nonlocal running, most_running
+        with lock:
+            running += 1
+            most_running = max(most_running, running)
+        time.sleep(0.05)
+        with lock:
+            running -= 1
+
+    with patch.object(utils.security, "PASSWORD_HASHING_WORKERS", 8), patch.object(
+        utils.security, "PASSWORD_HASHING_MAX_CONCURRENCY", 2
+    ):
+        await asyncio.gather(*(run_hashing(slow_hash) for _ in range(6)))
+
+    assert most_running == 2
+
+
+async def test_logins_do_not_wait_behind_a_bulk_import():
+    def slow_hash(*args):
+        time.sleep(0.1)
+        return "hashed"
+
+    with patch.object(utils.security, "PASSWORD_HASHING_WORKERS", 2), patch.object(
+        utils.security, "PASSWORD_HASHING_MAX_CONCURRENCY", 2
+    ), patch.object(utils.security, "PASSWORD_HASHING_BULK_CONCURRENCY", 1), patch(
+        "utils.security._hash_password", slow_hash
+    ), patch(
+        "utils.security._verify_password", slow_hash
+    ):
+        # two seconds of hashing with the import to itself
+        bulk_import = asyncio.gather(
+            *(get_password_hash("secret", bulk=True) for _ in range(20))
+        )
+        await asyncio.sleep(0.05)
+
+        started = time.perf_counter()
+        await verify_password("secret", "hashed")
+        login = time.perf_counter() - started
+        await bulk_import
+
+    assert login < 0.5
+
+
+user_from_db = UserFromDB(
+    username="solomon@gmail.com",
+    email="solomon@gmail.com",
+    full_name="Solomon",
+    disabled=False,
+    email_verified=True,
+    scopes=[UserScope.list_],
+    hashed_password="",
+)
+
+
+@pytest.fixture
+def mock_user_lookup():
+    @asynccontextmanager
+    async def read_session(request):
+        yield MagicMock()
+
+    PRINCIPAL_CACHE.clear()
+    with patch("utils.security.read_session", read_session), patch(
+        "jose.jwt.decode", return_value={"sub": user_from_db.email}
+    ), patch(
+        "utils.security.get_user_from_db", return_value=user_from_db
+    ) as get_user_from_db:
+        yield get_user_from_db
+    PRINCIPAL_CACHE.clear()
+
+
+async def test_get_current_user_caches_the_principal(mock_user_lookup):
+    scopes = SecurityScopes(scopes=[UserScope.list_])
+
+    first = await get_current_user(scopes, MagicMock(), token="token")
+    second = await get_current_user(scopes, MagicMock(), token="token")
+
+    assert first == second
+    assert second.scopes == [UserScope.list_]
+    assert second.disabled is False
+    mock_user_lookup.assert_awaited_once()
+
+    # a change to the user makes the next request look it up again
+    invalidate_principal(user_from_db.email)
+    await get_current_user(scopes, MagicMock(), token="token")
+    assert mock_user_lookup.await_count == 2
+
+
+async def test_cached_principal_still_needs_the_required_scopes(mock_user_lookup):
+    await get_current_user(SecurityScopes(), MagicMock(), token="token")
+
+    with pytest.raises(HTTPException) as error:
+        await get_current_user(
+            SecurityScopes(scopes=[UserScope.delete]), MagicMock(), token="token"
+        )
+    assert error.value.status_code == 403
+    mock_user_lookup.assert_awaited_once()
@@ -0,0 +1,43 @@
+import asyncio
+import contextvars
+
+import pytest
+
+from utils.timing import record, server_timing, span, start_timing
+
+pytestmark = pytest.mark.anyio
+
+
+def test_spans_are_only_recorded_for_timed_requests():
+    def request(timed: bool):
+        spans = start_timing() if timed else {}
+        with span("db"):
+            record("jwt", 1.0)
+        return spans
+
+    # fresh contexts, like requests that were and were not sampled
+    assert contextvars.Context().run(request, False) == {}
+    assert set(contextvars.Context().run(request, True)) == {"db", "jwt"}
+
+
+async def test_spans_add_up_across_tasks_and_threads():
+    async def timed():
+        spans = start_timing()
+        with span("db"):
+            await asyncio.sleep(0.01)
+        await asyncio.to_thread(record, "password", 0.25)
+        await asyncio.create_task(asyncio.to_thread(record, "password", 0.25))
+        return spans
+
+    spans = await asyncio.create_task(timed())
+
+    assert spans["db"][0] >= 0.01 and spans["db"][1] == 1
+    assert spans["password"] == [0.5, 2]
+
+
+def test_server_timing_header():
+    header = server_timing({"db": [0.0123, 3], "password": [0.41, 1]}, 0.5)
+
+    assert header == (
+        'db;dur=12.3;desc="x3", password;dur=410.0;desc="x1", total;dur=500.0'
+    )
@@ -0,0 +1,57 @@
+import hashlib
+from typing import Collection, Dict, Iterable, Set
+
+from fastapi import Request, Response
+
+# authenticated data, only the client may keep it and it must ask us again
+# before reusing it, which is what a conditional GET is for
+CACHE_CONTROL = "private, no-cache"
+
+
+class NotModified:
+    """Returned by a service instead of a resource the client already has."""
+
+    def __init__(self, version: str) -> None:
+        self.version = version
+
+
+def version_of(parts: Iterable) -> str:
+    """A short digest of everything a response is made of."""
+
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(repr(part).encode())
+        digest.update(b"\x1f")
+    return digest.hexdigest()
+
+
+def etag(version: str) -> str:
+    # weak, the same version may be serialized differently
+    return f'W/"{version}"'
+
+
+def known_versions(request: Request) -> Set[str]:
+    """The versions the client says it has in If-None-Match, compared the
+    weak way: W/ prefixes are ignored."""
+
+    header = request.headers.get("if-none-match", "")
+    versions = set()
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag:
+            versions.add(tag.strip('"'))
+    return versions
+
+
+def matches(version: str, known: Collection[str]) -> bool:
+    return version in known or "*" in known
+
+
+def version_headers(version: str) -> Dict[str, str]:
+    return {"ETag": etag(version), "Cache-Control": CACHE_CONTROL}
+
+
+def not_modified(version: str) -> Response:
+    return Response(status_code=304, headers=version_headers(version))
@@ -1,6 +1,7 @@
-from typing import List
+from typing import Callable, List, Tuple, Type
 
-from fastapi import HTTPException
+from fastapi import HTTPException, Query
+from pydantic import BaseModel
 
 
 def has_required_scopes(required_scopes: List[str], user_current_scopes: List[str]):
@@ -8,3 +9,32 @@ def has_required_scopes(required_scopes: List[str], user_current_scopes: List[st
     for scope in required_scopes:
         if scope not in user_current_scopes:
             raise HTTPException(status_code=403, detail="Not enough permissions")
+
+
+def sparse_fields(model: Type[BaseModel]) -> Callable[..., Tuple[str, ...] | None]:
+    """A dependency reading the `fields` query parameter, a comma separated
+    subset of `model`'s fields the client wants back. None when the client
+    wants them all."""
+
+    allowed = tuple(model.model_fields)
+
+    def dependency(
+        fields: str | None = Query(
+            None,
+            description=f"Comma separated fields to return, among {', '.join(allowed)}.",
+        ),
+    ) -> Tuple[str, ...] | None:
+        names = [name.strip() for name in (fields or "").split(",")]
+        requested = tuple(dict.fromkeys(name for name in names if name))
+        if not requested:
+            return None
+
+        unknown = [name for name in requested if name not in allowed]
+        if unknown:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown fields {', '.join(unknown)}, choose among {', '.join(allowed)}.",
+            )
+        return requested
+
+    return dependency
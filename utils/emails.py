@@ -1,6 +1,9 @@
 from email.mime.text import MIMEText
 import os
 import smtplib
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
 from email.mime.multipart import MIMEMultipart
 
 from loguru import logger
@@ -8,33 +11,267 @@ from loguru import logger
 from core.config import (
     EMAIL_ADDRESS,
     EMAIL_FROM_NAME,
+    EMAIL_HEALTH_CHECK_AFTER,
     EMAIL_HOST,
     EMAIL_PASSWORD,
+    EMAIL_POOL_SIZE,
     EMAIL_PORT,
+    EMAIL_STARTTLS,
+    EMAIL_TIMEOUT,
     TESTING,
 )
 from utils.errors import EmailException
+from utils.metrics import EMAILS_SENT
 
 
-def send_email(subject: str, to_email: str, body: str):
-    # get the latest value
-    under_testing = os.getenv("TESTING", TESTING)
-    if under_testing.lower() == "true":
-        logger.info(f"Subject: {subject}\nTo: {to_email}\nMessage: {body}")
-        return
-
+def build_message(subject: str, to_email: str, body: str) -> str:
     msg = MIMEMultipart()
     msg["From"] = f"{EMAIL_FROM_NAME} <{EMAIL_ADDRESS}>"
     msg["To"] = to_email
     msg["Subject"] = subject
     msg.attach(MIMEText(body, "plain"))
-    try:
-        server = smtplib.SMTP(EMAIL_HOST, EMAIL_PORT)
-        server.starttls()
-        server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        text = msg.as_string()
-        server.sendmail(EMAIL_ADDRESS, to_email, text)
-        server.quit()
-    except Exception as e:
-        logger.error(e)
-        raise EmailException("Failed to send email for email confirmation")
+    return msg.as_string()
+
+
+def email_failure(error: Exception) -> EmailException:
+    failure = EmailException("Failed to send email")
+    failure.__cause__ = error
+    return failure
+
+
+def connection_lost(error: OSError) -> bool:
+    # SMTPException is an OSError too, those are answers of a live server
+    return isinstance(error, smtplib.SMTPServerDisconnected) or not isinstance(
+        error, smtplib.SMTPException
+    )
+
+
+class SMTPSession:
+    """One connected and authenticated SMTP connection, with the messages it
+    sent and the seconds it spent sending them."""
+
+    def __init__(self, smtp: smtplib.SMTP) -> None:
+        self.smtp = smtp
+        self.opened_at = time.monotonic()
+        self.last_used = self.opened_at
+        self.messages = 0
+        self.sending = 0.0
+
+    def send(self, sender: str, to_email: str, message: str) -> None:
+        started = time.perf_counter()
+        try:
+            self.smtp.sendmail(sender, to_email, message)
+        finally:
+            self.sending += time.perf_counter() - started
+            self.last_used = time.monotonic()
+        self.messages += 1
+
+    def close(self) -> None:
+        try:
+            self.smtp.quit()
+        except Exception:
+            self.smtp.close()
+
+    def stats(self) -> Dict:
+        return {
+            "messages": self.messages,
+            "seconds_sending": self.sending,
+            "messages_per_second": (
+                self.messages / self.sending if self.sending else 0.0
+            ),
+            "age": time.monotonic() - self.opened_at,
+        }
+
+
+class SMTPPool:
+    """Keeps up to `max_size` authenticated SMTP connections open between
+    sends, so a message does not pay for connect, STARTTLS and AUTH.
+
+    A connection idle for more than `health_check_after` seconds is checked
+    with a NOOP before it is used again, and replaced when the server dropped
+    it. Used from worker threads, smtplib blocks.
+    """
+
+    def __init__(
+        self,
+        host: str = EMAIL_HOST,
+        port: int = EMAIL_PORT,
+        address: str = EMAIL_ADDRESS,
+        password: str = EMAIL_PASSWORD,
+        starttls: bool = EMAIL_STARTTLS.lower() == "true",
+        timeout: float = EMAIL_TIMEOUT,
+        max_size: int = EMAIL_POOL_SIZE,
+        health_check_after: float = EMAIL_HEALTH_CHECK_AFTER,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.address = address
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.max_size = max_size
+        self.health_check_after = health_check_after
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle: List[SMTPSession] = []
+        self._open: List[SMTPSession] = []
+        self.connects = 0
+        self.health_checks = 0
+        self.reconnects = 0
+        self.failures = 0
+
+    def _connect(self) -> SMTPSession:
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                smtp.starttls()
+            if self.password:
+                smtp.login(self.address, self.password)
+        except Exception:
+            smtp.close()
+            raise
+
+        session = SMTPSession(smtp)
+        with self._lock:
+            self._open.append(session)
+            self.connects += 1
+        return session
+
+    def _discard(self, session: SMTPSession) -> None:
+        with self._lock:
+            self._open.remove(session)
+        session.close()
+
+    def _healthy(self, session: SMTPSession) -> bool:
+        if time.monotonic() - session.last_used < self.health_check_after:
+            return True
+        with self._lock:
+            self.health_checks += 1
+        try:
+            return session.smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _checkout(self) -> SMTPSession:
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No SMTP connection free within {self.timeout}s")
+        try:
+            while True:
+                with self._lock:
+                    session = self._idle.pop() if self._idle else None
+                if session is None:
+                    return self._connect()
+                if self._healthy(session):
+                    return session
+                self._discard(session)
+                with self._lock:
+                    self.reconnects += 1
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _checkin(self, session: Optional[SMTPSession]) -> None:
+        if session is not None:
+            with self._lock:
+                self._idle.append(session)
+        self._slots.release()
+
+    def deliver(
+        self, messages: List[Tuple[str, str, str]]
+    ) -> List[EmailException | None]:
+        """Sends (subject, to_email, body) messages over a single connection
+        and returns None for every message sent, its EmailException
+        otherwise. A dropped connection is reopened once per message."""
+
+        outcomes: List[EmailException | None] = []
+        session: Optional[SMTPSession] = None
+        try:
+            session = self._checkout()
+        except Exception as error:
+            with self._lock:
+                self.failures += len(messages)
+            return [email_failure(error) for _ in messages]
+
+        try:
+            for subject, to_email, body in messages:
+                message = build_message(subject, to_email, body)
+                try:
+                    try:
+                        session.send(self.address, to_email, message)
+                    except OSError as error:
+                        if not connection_lost(error):
+                            raise
+                        self._discard(session)
+                        session = None
+                        with self._lock:
+                            self.reconnects += 1
+                        session = self._connect()
+                        session.send(self.address, to_email, message)
+                except Exception as error:
+                    logger.error(error)
+                    with self._lock:
+                        self.failures += 1
+                    outcomes.append(email_failure(error))
+                    if session is None:
+                        # the server is unreachable, don't retry for every message
+                        remaining = messages[len(outcomes) :]
+                        with self._lock:
+                            self.failures += len(remaining)
+                        outcomes.extend(email_failure(error) for _ in remaining)
+                        break
+                else:
+                    outcomes.append(None)
+        finally:
+            self._checkin(session)
+        return outcomes
+
+    def close(self) -> None:
+        with self._lock:
+            sessions, self._idle = self._idle, []
+            for session in sessions:
+                self._open.remove(session)
+        for session in sessions:
+            session.close()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            sessions = list(self._open)
+            idle = len(self._idle)
+        return {
+            "max_size": self.max_size,
+            "open": len(sessions),
+            "idle": idle,
+            "connects": self.connects,
+            "health_checks": self.health_checks,
+            "reconnects": self.reconnects,
+            "failures": self.failures,
+            "messages": sum(session.messages for session in sessions),
+            "connections": [session.stats() for session in sessions],
+        }
+
+
+SMTP_POOL = SMTPPool()
+
+
+def deliver(messages: List[Tuple[str, str, str]]) -> List[EmailException | None]:
+    """Sends (subject, to_email, body) messages through the SMTP pool, see
+    SMTPPool.deliver."""
+
+    # get the latest value
+    under_testing = os.getenv("TESTING", TESTING)
+    if under_testing.lower() == "true":
+        for subject, to_email, body in messages:
+            logger.info(f"Subject: {subject}\nTo: {to_email}\nMessage: {body}")
+        outcomes: List[EmailException | None] = [None] * len(messages)
+    else:
+        outcomes = SMTP_POOL.deliver(messages)
+
+    for failure in outcomes:
+        EMAILS_SENT.inc("sent" if failure is None else "failed")
+    return outcomes
+
+
+def send_email(subject: str, to_email: str, body: str):
+    (failure,) = deliver([(subject, to_email, body)])
+    if failure is not None:
+        raise failure
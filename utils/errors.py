@@ -1,5 +1,5 @@
 from loguru import logger
-import psycopg2
+import psycopg
 
 
 class EmailException(Exception):
@@ -42,7 +42,7 @@ def log_database_error(
     db_error: Exception,
     default_msg="There has been a database connection problem.",
 ):
-    # psycopg2.DatabaseError
+    # psycopg.DatabaseError
     # DataError: problems with the processed data, like invalid data type conversions
     # IntegrityError: problems related to database integrity such as constraint violations etc
     #                 common ones include insert or update data that would violate a primary key or
@@ -0,0 +1,13 @@
+from fastapi import Request, status
+from fastapi.responses import JSONResponse
+
+
+async def database_unavailable_handler(request: Request, exc: Exception):
+    """Answers with a 503 when no pooled connection could be had in time, so
+    clients back off instead of seeing a server error."""
+
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "The service is busy, please try again shortly."},
+        headers={"Retry-After": "1"},
+    )
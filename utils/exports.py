@@ -0,0 +1,56 @@
+import csv
+from enum import StrEnum
+import io
+from typing import AsyncIterator, List, Sequence
+
+from pydantic import BaseModel
+
+
+class ExportFormat(StrEnum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+MEDIA_TYPES = {
+    ExportFormat.ndjson: "application/x-ndjson",
+    ExportFormat.csv: "text/csv",
+}
+
+
+def ndjson_chunk(batch: Sequence[BaseModel]) -> str:
+    return "".join(f"{item.model_dump_json()}\n" for item in batch)
+
+
+def csv_chunk(batch: Sequence[BaseModel], header: Sequence[str] | None = None) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(header)
+    for item in batch:
+        # lists, the scopes, are space separated like in an OAuth scope string
+        writer.writerow(
+            " ".join(value) if isinstance(value, list) else value
+            for value in item.model_dump(mode="json").values()
+        )
+    return buffer.getvalue()
+
+
+async def encode_batches(
+    batches: AsyncIterator[List[BaseModel]],
+    export_format: ExportFormat,
+    fields: Sequence[str],
+) -> AsyncIterator[str]:
+    """Encodes every batch into one chunk of the response body, so only one
+    batch is ever held in memory."""
+
+    if export_format == ExportFormat.csv:
+        header: Sequence[str] | None = fields
+        async for batch in batches:
+            yield csv_chunk(batch, header)
+            header = None
+        if header:
+            # an empty export still gets its header row
+            yield csv_chunk([], header)
+    else:
+        async for batch in batches:
+            yield ndjson_chunk(batch)
@@ -0,0 +1,70 @@
+import csv
+from enum import StrEnum
+import io
+import json
+from typing import List, Tuple, Type, TypeVar
+
+from pydantic import BaseModel, ValidationError
+
+from schemas.user import BulkImportError
+
+M = TypeVar("M", bound=BaseModel)
+
+
+class ImportFormat(StrEnum):
+    csv = "csv"  # with a header row naming the fields
+    json = "json"  # an array of objects
+    ndjson = "ndjson"  # one object per line
+
+
+def _describe(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in detail['loc']) or 'record'}: {detail['msg']}"
+        for detail in error.errors()
+    )
+
+
+def parse_records(
+    data: str, import_format: ImportFormat, model: Type[M]
+) -> Tuple[List[Tuple[int, M]], List[BulkImportError]]:
+    """Reads the records of an uploaded file, numbered from 1 in the order
+    they appear. Records that are not valid `model`s are reported instead
+    of failing the whole file."""
+
+    if import_format == ImportFormat.csv:
+        raw_records = list(csv.DictReader(io.StringIO(data)))
+    elif import_format == ImportFormat.json:
+        try:
+            raw_records = json.loads(data)
+        except ValueError as error:
+            return [], [BulkImportError(row=1, detail=f"Invalid JSON: {error}")]
+        if not isinstance(raw_records, list):
+            return [], [BulkImportError(row=1, detail="Expected an array of users")]
+    else:
+        raw_records = []
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            try:
+                raw_records.append(json.loads(line))
+            except ValueError as error:
+                raw_records.append(error)
+
+    records: List[Tuple[int, M]] = []
+    errors: List[BulkImportError] = []
+    for row, raw in enumerate(raw_records, start=1):
+        if isinstance(raw, ValueError):
+            errors.append(BulkImportError(row=row, detail=f"Invalid JSON: {raw}"))
+            continue
+        try:
+            records.append((row, model.model_validate(raw)))
+        except ValidationError as error:
+            email = raw.get("email") if isinstance(raw, dict) else None
+            errors.append(
+                BulkImportError(
+                    row=row,
+                    email=email if isinstance(email, str) else None,
+                    detail=_describe(error),
+                )
+            )
+    return records, errors
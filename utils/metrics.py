@@ -0,0 +1,479 @@
+from abc import ABC, abstractmethod
+import asyncio
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+import fcntl
+import json
+import multiprocessing
+import os
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Tuple
+from uuid import uuid4
+
+import anyio
+from loguru import logger
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from core.config import METRICS_DIR, METRICS_FLUSH_INTERVAL
+
+Labels = Tuple[str, ...]
+
+# in METRICS_DIR, the samples of exited workers added up and the lock that
+# keeps scrapes from reading while they are being added
+AGGREGATE_FILE = "aggregate.json"
+LOCK_FILE = "metrics.lock"
+
+# Upper bounds, in seconds, good enough for pool waits and request timings.
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Histogram:
+    """A fixed bucket histogram of observed durations in seconds.
+
+    Observing is a bisect and two additions so it is cheap enough to call on
+    every request.
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        # the last slot counts observations above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> Dict:
+        """Returns the cumulative bucket counts, the same shape Prometheus
+        uses for its histograms."""
+
+        cumulative = {}
+        running = 0
+        for bound, count in zip(self.buckets, self.counts):
+            running += count
+            cumulative[str(bound)] = running
+        cumulative["+Inf"] = self.count
+
+        return {"count": self.count, "sum": self.sum, "buckets": cumulative}
+
+
+class Metric(ABC):
+    """A named metric of the /metrics endpoint, with one sample per
+    combination of `labels` values."""
+
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    @abstractmethod
+    def dump(self) -> List:
+        """The [label values, value] pairs of the samples, JSON friendly."""
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self.values: Dict[Labels, float] = defaultdict(float)
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self.values[labels] += amount
+
+    def dump(self) -> List:
+        return [[list(labels), value] for labels, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """Summed over the live workers only, a dead worker's in-flight requests
+    are gone with it."""
+
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1.0) -> None:
+        self.values[labels] -= amount
+
+
+class HistogramMetric(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[Labels, Histogram] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        histogram = self.values.get(labels)
+        if histogram is None:
+            histogram = self.values[labels] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def dump(self) -> List:
+        return [
+            [list(labels), {"counts": list(histogram.counts), "sum": histogram.sum}]
+            for labels, histogram in self.values.items()
+        ]
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _write_atomically(path: str, content: Dict) -> None:
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as file:
+        json.dump(content, file)
+    # readers only ever see a complete file
+    os.replace(temporary, path)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class MetricsRegistry:
+    """The metrics of this process, rendered in the Prometheus text format.
+
+    With `directory` set every worker writes its samples to a file of its own
+    there, every `flush_interval` seconds and before answering a scrape, and
+    the scrape adds up the files of all workers, including the counters of
+    workers that exited since. Left empty the process only reports itself.
+
+    The files are written and read off the event loop, from a dump taken on
+    it: the metrics are only ever changed by the loop's thread.
+    """
+
+    def __init__(
+        self,
+        directory: str = METRICS_DIR,
+        flush_interval: float = METRICS_FLUSH_INTERVAL,
+    ) -> None:
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.metrics: Dict[str, Metric] = {}
+        self._path: str | None = None
+        self._path_pid = 0
+        self._flusher: asyncio.Task | None = None
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))  # type: ignore
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labels))  # type: ignore
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> HistogramMetric:
+        return self.register(HistogramMetric(name, help, labels, buckets))  # type: ignore
+
+    def dump(self) -> Dict:
+        return {
+            "pid": os.getpid(),
+            "metrics": {name: metric.dump() for name, metric in self.metrics.items()},
+        }
+
+    def flush(self, dump: Dict | None = None) -> None:
+        if not self.directory:
+            return
+        if self._path_pid != os.getpid():
+            # a worker forked from a preloaded app gets a file of its own
+            self._path_pid = os.getpid()
+            self._path = os.path.join(
+                self.directory, f"{self._path_pid}-{uuid4().hex[:8]}.json"
+            )
+
+        os.makedirs(self.directory, exist_ok=True)
+        _write_atomically(self._path, dump or self.dump())  # type: ignore
+
+    @contextmanager
+    def _locked(self, operation: int) -> Iterator[bool]:
+        """Holds the directory's lock, shared by scrapes and exclusive for
+        compact, and yields whether it was taken."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LOCK_FILE), "a") as lock:
+            try:
+                fcntl.flock(lock, operation)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_dumps(self) -> List[Dict]:
+        aggregate: Dict = {"pid": None, "metrics": {}, "folded": []}
+        dumps = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as file:
+                    dump = json.load(file)
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError) as error:
+                logger.warning(f"Skipping unreadable metrics file {filename}: {error}")
+                continue
+            if filename == AGGREGATE_FILE:
+                aggregate = dump
+            else:
+                dump["filename"] = filename
+                dumps.append(dump)
+
+        # a file already added to the aggregate but not deleted yet
+        folded = set(aggregate["folded"])
+        return [aggregate] + [dump for dump in dumps if dump["filename"] not in folded]
+
+    def collect(self, dump: Dict | None = None) -> List[Dict]:
+        """The dumps of every worker, this one's up to date, or as of
+        `dump`."""
+
+        dump = dump or self.dump()
+        if not self.directory:
+            return [dump]
+
+        self.flush(dump)
+        with self._locked(fcntl.LOCK_SH):
+            return self._read_dumps()
+
+    def compact(self) -> None:
+        """Folds the files of exited workers into the aggregate file, so the
+        directory doesn't grow with every worker restart. Their gauges are
+        dropped, their counters and histograms live on in the aggregate."""
+
+        if not self.directory:
+            return
+        with self._locked(fcntl.LOCK_EX | fcntl.LOCK_NB) as locked:
+            if not locked:
+                # another worker is at it
+                return
+
+            aggregate, *dumps = self._read_dumps()
+            # left behind when a compaction was interrupted
+            self._remove(aggregate["folded"])
+
+            exited = [dump for dump in dumps if not _process_alive(dump["pid"])]
+            if not exited:
+                return
+            merged = self.merge([aggregate, *exited])
+            aggregate = {
+                "pid": None,
+                "metrics": {
+                    name: [[list(labels), value] for labels, value in samples.items()]
+                    for name, samples in merged.items()
+                    if self.metrics[name].kind != "gauge"
+                },
+                # skipped by readers until they are deleted, so a crash in
+                # between doesn't count them twice
+                "folded": [dump["filename"] for dump in exited],
+            }
+            _write_atomically(os.path.join(self.directory, AGGREGATE_FILE), aggregate)
+            self._remove(aggregate["folded"])
+
+    def _remove(self, filenames: List[str]) -> None:
+        for filename in filenames:
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+
+    def merge(self, dumps: List[Dict]) -> Dict[str, Dict[Labels, Any]]:
+        """Adds up the samples of every worker, histograms bucket by bucket.
+        Gauges of workers that are gone are left out."""
+
+        merged: Dict[str, Dict[Labels, Any]] = {name: {} for name in self.metrics}
+        for dump in dumps:
+            pid = dump["pid"]
+            alive = pid is not None and (pid == os.getpid() or _process_alive(pid))
+            for name, samples in dump["metrics"].items():
+                metric = self.metrics.get(name)
+                if metric is None or (metric.kind == "gauge" and not alive):
+                    continue
+                for labels, value in samples:
+                    totals, labels = merged[name], tuple(labels)
+                    if metric.kind != "histogram":
+                        totals[labels] = totals.get(labels, 0.0) + value
+                        continue
+                    total = totals.setdefault(
+                        labels, {"counts": [0] * len(value["counts"]), "sum": 0.0}
+                    )
+                    total["counts"] = [
+                        a + b for a, b in zip(total["counts"], value["counts"])
+                    ]
+                    total["sum"] += value["sum"]
+        return merged
+
+    def render(self, dump: Dict | None = None) -> str:
+        lines = []
+        for name, samples in self.merge(self.collect(dump)).items():
+            metric = self.metrics[name]
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for labels, value in sorted(samples.items()):
+                if not isinstance(metric, HistogramMetric):
+                    lines.append(f"{name}{_label_text(metric.labels, labels)} {value}")
+                    continue
+
+                running = 0
+                for bound, count in zip((*metric.buckets, "+Inf"), value["counts"]):
+                    running += count
+                    bucket_labels = _label_text(
+                        (*metric.labels, "le"), (*labels, str(bound))
+                    )
+                    lines.append(f"{name}_bucket{bucket_labels} {running}")
+                label_text = _label_text(metric.labels, labels)
+                lines.append(f"{name}_sum{label_text} {value['sum']}")
+                lines.append(f"{name}_count{label_text} {running}")
+        return "\n".join(lines) + "\n"
+
+    async def scrape(self) -> str:
+        """render, with the file writes, the lock and the merge in a worker
+        thread rather than on the event loop."""
+        return await anyio.to_thread.run_sync(self.render, self.dump())
+
+    def _flush_and_compact(self, dump: Dict) -> None:
+        self.flush(dump)
+        self.compact()
+
+    async def flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await anyio.to_thread.run_sync(self._flush_and_compact, self.dump())
+            except OSError as error:
+                logger.warning(f"Could not write the metrics file: {error}")
+
+    def start(self) -> None:
+        if not self.directory:
+            if multiprocessing.parent_process() is not None:
+                # uvicorn --workers runs each worker as a multiprocessing child
+                logger.warning(
+                    "METRICS_DIR is not set, /metrics only reports the worker "
+                    "that answers it. Set METRICS_DIR when running several "
+                    "workers."
+                )
+            return
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self.flush_periodically())
+
+    async def stop(self) -> None:
+        if self._flusher is None:
+            return
+        self._flusher.cancel()
+        try:
+            await self._flusher
+        except asyncio.CancelledError:
+            pass
+        self._flusher = None
+        # what happened since the last flush still counts
+        self.flush()
+
+
+METRICS = MetricsRegistry()
+
+HTTP_REQUESTS = METRICS.counter(
+    "http_requests_total", "Requests answered.", ("method", "route", "status")
+)
+HTTP_REQUEST_SECONDS = METRICS.histogram(
+    "http_request_duration_seconds",
+    "Time to answer a request.",
+    ("method", "route", "status"),
+)
+HTTP_REQUESTS_IN_PROGRESS = METRICS.gauge(
+    "http_requests_in_progress", "Requests being answered."
+)
+DB_QUERY_SECONDS = METRICS.histogram(
+    "db_query_duration_seconds", "Round trips of the statements sent to Postgres."
+)
+PASSWORD_HASHING_QUEUE = METRICS.gauge(
+    "password_hashing_queue_depth",
+    "Password hashes and checks waiting for a hashing worker.",
+)
+EMAILS_SENT = METRICS.counter(
+    "emails_sent_total", "Emails handed to the SMTP server.", ("outcome",)
+)
+
+
+class RequestMetricsMiddleware:
+    """Counts every request and times it by route template, /users/{user_id}
+    rather than one series per id. A plain ASGI middleware, it only wraps
+    `send` to catch the status."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        HTTP_REQUESTS_IN_PROGRESS.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # the router leaves the matched route in the scope
+            route = scope.get("route")
+            labels = (
+                scope["method"],
+                route.path if route is not None else "unmatched",
+                str(status_code),
+            )
+            HTTP_REQUESTS.inc(*labels)
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, *labels)
+            HTTP_REQUESTS_IN_PROGRESS.dec()
@@ -0,0 +1,37 @@
+import base64
+from datetime import datetime
+from enum import StrEnum
+import json
+from typing import Tuple
+from uuid import UUID
+
+from utils.errors import BadReqeustException
+
+INVALID_CURSOR_MESSAGE = "The pagination cursor is invalid."
+
+
+class CountStrategy(StrEnum):
+    """How the total of a listing is computed, cheapest last."""
+
+    exact = "exact"  # COUNT(*), a full scan
+    estimated = "estimated"  # pg_class.reltuples, as fresh as the last ANALYZE
+    counter = "counter"  # the row_counts table kept by triggers
+    none = "none"  # no total at all
+
+
+def encode_cursor(date_created: datetime, id: UUID) -> str:
+    """Encodes the position of the last row of a page into an opaque cursor,
+    clients only ever hand it back to us."""
+
+    raw = json.dumps([date_created.isoformat(), str(id)], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, UUID]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        date_created, id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(date_created), UUID(id)
+    except (ValueError, TypeError):
+        # binascii.Error and json.JSONDecodeError are both ValueErrors
+        raise BadReqeustException(INVALID_CURSOR_MESSAGE)
@@ -0,0 +1,82 @@
+import asyncio
+from contextvars import ContextVar
+import functools
+import time
+from typing import Any, Callable, List
+
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from pydantic_core import to_json
+
+from utils.timing import record, span
+
+# When the endpoint of the request being handled by a TimedRoute returned,
+# empty until it has. A list, the endpoint may run in a thread of its own.
+_RETURNED: ContextVar[List[float] | None] = ContextVar(
+    "endpoint_returned", default=None
+)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered by pydantic's serializer instead of `json.dumps`.
+
+    With a `response_model` FastAPI hands over the already dumped content, a
+    model returned as is gets serialized straight from its schema.
+    """
+
+    def render(self, content: Any) -> bytes:
+        if _RETURNED.get():
+            # TimedRoute times it along with the response_model dump
+            return to_json(content)
+        with span("encode"):
+            return to_json(content)
+
+
+def _mark_return(endpoint: Callable) -> Callable:
+    """Wraps `endpoint` to note when it returned, unless it returned a
+    response of its own, which FastAPI sends as is."""
+
+    def returned(result: Any) -> Any:
+        marks = _RETURNED.get()
+        if marks is not None and not isinstance(result, Response):
+            marks.append(time.perf_counter())
+        return result
+
+    if asyncio.iscoroutinefunction(endpoint):
+
+        @functools.wraps(endpoint)
+        async def marked(*args, **kwargs):
+            return returned(await endpoint(*args, **kwargs))
+
+    else:
+
+        @functools.wraps(endpoint)
+        def marked(*args, **kwargs):
+            return returned(endpoint(*args, **kwargs))
+
+    return marked
+
+
+class TimedRoute(APIRoute):
+    """An APIRoute that adds what FastAPI does once the endpoint returned,
+    validating and dumping the response_model then rendering, to the encode
+    span rather than leaving it unaccounted for."""
+
+    def get_route_handler(self) -> Callable:
+        # the handler calls the endpoint through the dependant
+        self.dependant.call = _mark_return(self.dependant.call)  # type: ignore
+        handler = super().get_route_handler()
+
+        async def timed_handler(request: Request) -> Response:
+            marks: List[float] = []
+            token = _RETURNED.set(marks)
+            try:
+                response = await handler(request)
+            finally:
+                _RETURNED.reset(token)
+            if marks:
+                record("encode", time.perf_counter() - marks[0])
+            return response
+
+        return timed_handler
@@ -1,49 +1,153 @@
-from typing import List, Union
-from fastapi import HTTPException, Depends, status
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from typing import Callable, List, TypeVar, Union
+from fastapi import HTTPException, Depends, Request, status
 from jose import JWTError, jwt
 from fastapi.security import OAuth2PasswordBearer, SecurityScopes
 from passlib.context import CryptContext
-from psycopg2 import sql
+from psycopg import sql
 
 from datetime import datetime, timedelta
 
-from core.config import ALGORITHM, SECRET_KEY
-from core.database import get_db
+from core.config import (
+    ALGORITHM,
+    PASSWORD_HASHING_BULK_CONCURRENCY,
+    PASSWORD_HASHING_EXECUTOR,
+    PASSWORD_HASHING_MAX_CONCURRENCY,
+    PASSWORD_HASHING_WORKERS,
+    PRINCIPAL_CACHE_SIZE,
+    PRINCIPAL_CACHE_TTL,
+    SECRET_KEY,
+)
+from core.database import DatabaseSession, read_session
+from core.invalidation import INVALIDATION_BUS
 from schemas.auth import TokenData
-from schemas.user import User, UserFromDB
+from schemas.user import USER_FROM_DB_ROWS, User, UserFromDB
+from utils.cache import TTLCache
 from utils.dependencies import has_required_scopes
-from psycopg2.extensions import connection as PsycopgConnection
+from utils.metrics import PASSWORD_HASHING_QUEUE
+from utils.timing import span
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
 
+USER_BY_EMAIL = sql.SQL(f"{USER_FROM_DB_ROWS.select} WHERE email = %s")
+
+# Principals resolved by get_current_user keyed by the token's subject, so hot
+# clients don't cost a users lookup per request. UserService invalidates an
+# entry whenever it changes that user.
+PRINCIPAL_CACHE: TTLCache[TokenData] = TTLCache(
+    max_size=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL
+)
+INVALIDATION_BUS.subscribe(
+    "principal", PRINCIPAL_CACHE.invalidate, PRINCIPAL_CACHE.clear
+)
+
+T = TypeVar("T")
+
+# bcrypt costs a few hundred milliseconds of CPU per call, it is run in these
+# workers so the event loop keeps serving other requests meanwhile.
+_hashing_executor: Executor | None = None
+_hashing_slots: asyncio.Semaphore | None = None
+# taken by bulk hashes before they queue for _hashing_slots
+_bulk_hashing_slots: asyncio.Semaphore | None = None
+
+
+def get_hashing_executor() -> Executor:
+    global _hashing_executor
+    if _hashing_executor is None:
+        if PASSWORD_HASHING_EXECUTOR == "process":
+            # spawned, a forked child would inherit the database sockets
+            _hashing_executor = ProcessPoolExecutor(
+                max_workers=PASSWORD_HASHING_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        else:
+            _hashing_executor = ThreadPoolExecutor(
+                max_workers=PASSWORD_HASHING_WORKERS,
+                thread_name_prefix="password-hashing",
+            )
+    return _hashing_executor
+
+
+def shutdown_hashing_executor() -> None:
+    global _hashing_executor, _hashing_slots, _bulk_hashing_slots
+    if _hashing_executor is not None:
+        _hashing_executor.shutdown(wait=True, cancel_futures=True)
+    _hashing_executor = None
+    _hashing_slots = None
+    _bulk_hashing_slots = None
+
+
+async def run_hashing(func: Callable[..., T], *args) -> T:
+    """Runs a password hashing function in the hashing executor, with at most
+    PASSWORD_HASHING_MAX_CONCURRENCY of them in flight."""
+
+    global _hashing_slots
+    if _hashing_slots is None:
+        _hashing_slots = asyncio.Semaphore(PASSWORD_HASHING_MAX_CONCURRENCY)
+
+    with span("password"):
+        PASSWORD_HASHING_QUEUE.inc()
+        try:
+            await _hashing_slots.acquire()
+        finally:
+            PASSWORD_HASHING_QUEUE.dec()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(get_hashing_executor(), func, *args)
+        finally:
+            _hashing_slots.release()
 
-def get_user_from_db(
-    db_instance: PsycopgConnection, email: str
+
+def invalidate_principal(email: str) -> None:
+    """Drops the cached principal of a user that was just changed."""
+    PRINCIPAL_CACHE.invalidate(email)
+
+
+def publish_principal_change(db: DatabaseSession, email: str) -> None:
+    """Has every other worker drop the user's cached principal once the
+    current transaction commits."""
+    INVALIDATION_BUS.publish(db, "principal", email)
+
+
+async def get_user_from_db(
+    db_instance: DatabaseSession, email: str
 ) -> Union[UserFromDB, Exception]:
-    db: PsycopgConnection = db_instance
+    db: DatabaseSession = db_instance
     cursor = db.cursor()
-    table_fields = list(UserFromDB.model_fields.keys())
-    tables_str = ", ".join(table_fields)
-    cursor.execute(
-        sql.SQL(f"SELECT {tables_str} FROM users WHERE email = %s"), (email,)
-    )
-    row = cursor.fetchone()
+    await cursor.execute(USER_BY_EMAIL, (email,))
+    row = await cursor.fetchone()
     if row:
-        user_dict = {}
-
-        for index, _table in enumerate(table_fields):
-            user_dict[_table] = row[index]
-
-        return UserFromDB(**user_dict)
+        return USER_FROM_DB_ROWS.one(row)
     return Exception("User not found")
 
 
-def get_password_hash(password):
+def _hash_password(password: str) -> str:
     return pwd_context.hash(password)
 
 
+def _verify_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+async def get_password_hash(password, bulk: bool = False):
+    """Hashes a password in the hashing executor. A `bulk` hash, one of an
+    import's, first waits for one of PASSWORD_HASHING_BULK_CONCURRENCY slots,
+    so an import never queues more than that many ahead of a login."""
+
+    if not bulk:
+        return await run_hashing(_hash_password, password)
+
+    global _bulk_hashing_slots
+    if _bulk_hashing_slots is None:
+        _bulk_hashing_slots = asyncio.Semaphore(PASSWORD_HASHING_BULK_CONCURRENCY)
+    async with _bulk_hashing_slots:
+        return await run_hashing(_hash_password, password)
+
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
     if expires_delta:
@@ -51,14 +155,15 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    with span("jwt"):
+        encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
 async def get_current_user(
     security_scopes: SecurityScopes,
+    request: Request,
     token: str = Depends(oauth2_scheme),
-    db=Depends(get_db),
 ):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -67,7 +172,8 @@ async def get_current_user(
     )
 
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with span("jwt"):
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
 
         username: str = str(payload.get("sub"))
 
@@ -77,16 +183,23 @@ async def get_current_user(
         if username is None:
             raise credentials_exception
 
-        user_db = get_user_from_db(db, email=username)
-
-        if isinstance(user_db, UserFromDB):
-            user_db_scopes = user_db.scopes
-        else:
-            raise credentials_exception
-
-        has_required_scopes(security_scopes.scopes, user_db_scopes)
-
-        token_data = TokenData(username=username, scopes=user_db_scopes)
+        token_data = PRINCIPAL_CACHE.get(username)
+        if token_data is None:
+            # only a cache miss needs a database connection
+            async with read_session(request) as db:
+                user_db = await get_user_from_db(db, email=username)
+
+            if isinstance(user_db, UserFromDB):
+                token_data = TokenData(
+                    username=username,
+                    scopes=user_db.scopes,
+                    disabled=user_db.disabled,
+                )
+            else:
+                raise credentials_exception
+            PRINCIPAL_CACHE.set(username, token_data)
+
+        has_required_scopes(security_scopes.scopes, token_data.scopes)
     except JWTError:
         raise credentials_exception
     return token_data
@@ -98,6 +211,6 @@ async def get_current_active_user(current_user: User = Depends(get_current_user)
     return current_user
 
 
-def verify_password(plain_password, hashed_password):
-    _result = pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    _result = await run_hashing(_verify_password, plain_password, hashed_password)
     return _result
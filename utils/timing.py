@@ -0,0 +1,54 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import time
+from typing import Dict, Iterator, List
+
+# The spans of the request being timed, name -> [seconds, count]. None when
+# the request was not sampled, spans are then not recorded at all.
+_SPANS: ContextVar[Dict[str, List[float]] | None] = ContextVar(
+    "timing_spans", default=None
+)
+
+
+def start_timing() -> Dict[str, List[float]]:
+    """Starts collecting the spans of the current request, tasks and threads
+    started from it afterwards add to the same spans."""
+    spans: Dict[str, List[float]] = {}
+    _SPANS.set(spans)
+    return spans
+
+
+def record(name: str, seconds: float) -> None:
+    spans = _SPANS.get()
+    if spans is None:
+        return
+    totals = spans.setdefault(name, [0.0, 0])
+    totals[0] += seconds
+    totals[1] += 1
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Adds the time spent in the block to the `name` span of the current
+    request, if it is being timed."""
+
+    if _SPANS.get() is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+def server_timing(spans: Dict[str, List[float]], total: float) -> str:
+    """The Server-Timing header value, durations in milliseconds."""
+
+    metrics = [
+        f'{name};dur={seconds * 1000:.1f};desc="x{int(count)}"'
+        for name, (seconds, count) in spans.items()
+    ]
+    metrics.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(metrics)